@@ -1,13 +1,16 @@
 import mediapipe as mp
 import cv2
 import numpy as np
-import pandas as pd
-import pickle
 import traceback
 
+from .evidence import EvidenceSelection
+from .inference import model_input
+from .model_store import load_model_artifact
+from .geometry import joint_angles, vertical_angles
 from .utils import (
-    calculate_angle,
     extract_important_keypoints,
+    get_landmark_indices,
+    LandmarksBuffer,
     get_static_file_url,
     get_drawing_color,
 )
@@ -20,6 +23,7 @@ class BicepPoseAnalysis:
     def __init__(
         self,
         side: str,
+        joint_indices: np.ndarray,
         stage_down_threshold: float,
         stage_up_threshold: float,
         peak_contraction_threshold: float,
@@ -34,6 +38,7 @@ class BicepPoseAnalysis:
         self.visibility_threshold = visibility_threshold
 
         self.side = side
+        self.joint_indices = joint_indices
         self.counter = 0
         self.stage = "down"
         self.is_visible = True
@@ -51,52 +56,40 @@ class BicepPoseAnalysis:
     def get_joints(self, landmarks) -> bool:
         """
         Check for joints' visibility then get joints coordinate
+
+        landmarks: array of the frame's landmarks, shape (33, 4)
         """
-        side = self.side.upper()
+        # Shoulder, elbow and wrist of the arm
+        joints = landmarks[self.joint_indices]
 
         # Check visibility
-        joints_visibility = [
-            landmarks[mp_pose.PoseLandmark[f"{side}_SHOULDER"].value].visibility,
-            landmarks[mp_pose.PoseLandmark[f"{side}_ELBOW"].value].visibility,
-            landmarks[mp_pose.PoseLandmark[f"{side}_WRIST"].value].visibility,
-        ]
-
-        is_visible = all([vis > self.visibility_threshold for vis in joints_visibility])
+        is_visible = bool((joints[:, 3] > self.visibility_threshold).all())
         self.is_visible = is_visible
 
         if not is_visible:
             return self.is_visible
 
         # Get joints' coordinates
-        self.shoulder = [
-            landmarks[mp_pose.PoseLandmark[f"{side}_SHOULDER"].value].x,
-            landmarks[mp_pose.PoseLandmark[f"{side}_SHOULDER"].value].y,
-        ]
-        self.elbow = [
-            landmarks[mp_pose.PoseLandmark[f"{side}_ELBOW"].value].x,
-            landmarks[mp_pose.PoseLandmark[f"{side}_ELBOW"].value].y,
-        ]
-        self.wrist = [
-            landmarks[mp_pose.PoseLandmark[f"{side}_WRIST"].value].x,
-            landmarks[mp_pose.PoseLandmark[f"{side}_WRIST"].value].y,
-        ]
+        self.shoulder, self.elbow, self.wrist = joints[:, :2].tolist()
 
         return self.is_visible
 
     def analyze_pose(
         self,
         landmarks,
+        angles,
         frame,
-        results,
+        evidence: EvidenceSelection,
         timestamp: int,
         lean_back_error: bool = False,
     ):
         """Analyze angles of an arm for error detection
 
         Args:
-            landmarks (): MediaPipe Pose landmarks
+            landmarks (np.ndarray): Array of MediaPipe Pose landmarks, shape (33, 4)
+            angles (np.ndarray): Curl angle and upper arm angle of the arm, measured by BicepCurlModel.measure
             frame (): OpenCV frame
-            results (): MediaPipe Pose results
+            evidence (EvidenceSelection): Errors kept as evidence, the detected errors are added to it
             timestamp (int): timestamp of the frame
             lean_back_error (bool, optional): If there is an lean back error detected, ignore the analysis. Defaults to False.
 
@@ -110,22 +103,16 @@ class BicepPoseAnalysis:
         if not self.is_visible:
             return (None, None, has_error)
 
-        # * Calculate curl angle for counter
-        bicep_curl_angle = int(calculate_angle(self.shoulder, self.elbow, self.wrist))
+        # * Curl angle for counter
+        bicep_curl_angle = int(angles[0])
         if bicep_curl_angle > self.stage_down_threshold:
             self.stage = "down"
         elif bicep_curl_angle < self.stage_up_threshold and self.stage == "down":
             self.stage = "up"
             self.counter += 1
 
-        # * Calculate the angle between the upper arm (shoulder & joint) and the Y axis
-        shoulder_projection = [
-            self.shoulder[0],
-            1,
-        ]  # Represent the projection of the shoulder to the X axis
-        ground_upper_arm_angle = int(
-            calculate_angle(self.elbow, self.shoulder, shoulder_projection)
-        )
+        # * Angle between the upper arm (shoulder & joint) and the Y axis
+        ground_upper_arm_angle = int(angles[1])
 
         # Stop analysis if lean back error is occur
         if lean_back_error:
@@ -134,34 +121,19 @@ class BicepPoseAnalysis:
         # * Evaluation for LOOSE UPPER ARM error
         if ground_upper_arm_angle > self.loose_upper_arm_angle_threshold:
             has_error = True
-            cv2.rectangle(frame, (350, 0), (600, 40), (245, 117, 16), -1)
-            cv2.putText(
-                frame,
-                "ARM ERROR",
-                (360, 12),
-                cv2.FONT_HERSHEY_COMPLEX,
-                0.5,
-                (0, 0, 0),
-                1,
-                cv2.LINE_AA,
-            )
-            cv2.putText(
-                frame,
-                "LOOSE UPPER ARM",
-                (355, 30),
-                cv2.FONT_HERSHEY_COMPLEX,
-                0.5,
-                (255, 255, 255),
-                1,
-                cv2.LINE_AA,
-            )
+            self.draw_error(frame, "LOOSE UPPER ARM")
 
             # Limit the saved frame
             if not self.loose_upper_arm:
                 self.loose_upper_arm = True
                 self.detected_errors["LOOSE_UPPER_ARM"] += 1
-                results.append(
-                    {"stage": "loose upper arm", "frame": frame, "timestamp": timestamp}
+                evidence.add(
+                    {
+                        "stage": "loose upper arm",
+                        "frame": frame,
+                        "timestamp": timestamp,
+                    },
+                    score=ground_upper_arm_angle - self.loose_upper_arm_angle_threshold,
                 )
         else:
             self.loose_upper_arm = False
@@ -177,35 +149,16 @@ class BicepPoseAnalysis:
                 self.peak_contraction_angle != 1000
                 and self.peak_contraction_angle >= self.peak_contraction_threshold
             ):
-                cv2.rectangle(frame, (350, 0), (600, 40), (245, 117, 16), -1)
-                cv2.putText(
-                    frame,
-                    "ARM ERROR",
-                    (360, 12),
-                    cv2.FONT_HERSHEY_COMPLEX,
-                    0.5,
-                    (0, 0, 0),
-                    1,
-                    cv2.LINE_AA,
-                )
-                cv2.putText(
-                    frame,
-                    "WEAK PEAK CONTRACTION",
-                    (355, 30),
-                    cv2.FONT_HERSHEY_COMPLEX,
-                    0.5,
-                    (255, 255, 255),
-                    1,
-                    cv2.LINE_AA,
-                )
+                self.draw_error(frame, "WEAK PEAK CONTRACTION")
 
                 self.detected_errors["PEAK_CONTRACTION"] += 1
-                results.append(
+                evidence.add(
                     {
                         "stage": "peak contraction",
                         "frame": frame,
                         "timestamp": timestamp,
-                    }
+                    },
+                    score=self.peak_contraction_angle - self.peak_contraction_threshold,
                 )
                 has_error = True
 
@@ -214,18 +167,49 @@ class BicepPoseAnalysis:
 
         return (bicep_curl_angle, ground_upper_arm_angle, has_error)
 
+    def draw_error(self, frame, error: str) -> None:
+        """Display an arm error on the frame, if the frame is drawn"""
+        if frame is None:
+            return
+
+        cv2.rectangle(frame, (350, 0), (600, 40), (245, 117, 16), -1)
+        cv2.putText(
+            frame,
+            "ARM ERROR",
+            (360, 12),
+            cv2.FONT_HERSHEY_COMPLEX,
+            0.5,
+            (0, 0, 0),
+            1,
+            cv2.LINE_AA,
+        )
+        cv2.putText(
+            frame,
+            error,
+            (355, 30),
+            cv2.FONT_HERSHEY_COMPLEX,
+            0.5,
+            (255, 255, 255),
+            1,
+            cv2.LINE_AA,
+        )
+
     def get_counter(self) -> int:
         return self.counter
 
-    def reset(self):
+    def reset(self, keep_stage: bool = False):
         self.counter = 0
-        self.stage = "down"
-        self.is_visible = True
         self.detected_errors = {
             "LOOSE_UPPER_ARM": 0,
             "PEAK_CONTRACTION": 0,
         }
 
+        if keep_stage:
+            return
+
+        self.stage = "down"
+        self.is_visible = True
+
         # Params for loose upper arm error detection
         self.loose_upper_arm = False
 
@@ -233,53 +217,18 @@ class BicepPoseAnalysis:
         self.peak_contraction_angle = 1000
 
 
-class BicepCurlDetection:
+class BicepCurlModel:
+    """
+    Machine learning model and landmarks of bicep curl detection, shared by every analysis
+    """
+
     ML_MODEL_PATH = get_static_file_url("model/bicep_curl_model.pkl")
     INPUT_SCALER = get_static_file_url("model/bicep_curl_input_scaler.pkl")
 
-    VISIBILITY_THRESHOLD = 0.65
-
-    # Params for counter
-    STAGE_UP_THRESHOLD = 100
-    STAGE_DOWN_THRESHOLD = 120
-
-    # Params to catch FULL RANGE OF MOTION error
-    PEAK_CONTRACTION_THRESHOLD = 60
-
-    # LOOSE UPPER ARM error detection
-    LOOSE_UPPER_ARM = False
-    LOOSE_UPPER_ARM_ANGLE_THRESHOLD = 40
-
-    # STANDING POSTURE error detection
-    POSTURE_ERROR_THRESHOLD = 0.95
-
     def __init__(self) -> None:
         self.init_important_landmarks()
         self.load_machine_learning_model()
 
-        self.left_arm_analysis = BicepPoseAnalysis(
-            side="left",
-            stage_down_threshold=self.STAGE_DOWN_THRESHOLD,
-            stage_up_threshold=self.STAGE_UP_THRESHOLD,
-            peak_contraction_threshold=self.PEAK_CONTRACTION_THRESHOLD,
-            loose_upper_arm_angle_threshold=self.LOOSE_UPPER_ARM_ANGLE_THRESHOLD,
-            visibility_threshold=self.VISIBILITY_THRESHOLD,
-        )
-
-        self.right_arm_analysis = BicepPoseAnalysis(
-            side="right",
-            stage_down_threshold=self.STAGE_DOWN_THRESHOLD,
-            stage_up_threshold=self.STAGE_UP_THRESHOLD,
-            peak_contraction_threshold=self.PEAK_CONTRACTION_THRESHOLD,
-            loose_upper_arm_angle_threshold=self.LOOSE_UPPER_ARM_ANGLE_THRESHOLD,
-            visibility_threshold=self.VISIBILITY_THRESHOLD,
-        )
-
-        self.stand_posture = 0
-        self.previous_stand_posture = 0
-        self.results = []
-        self.has_error = False
-
     def init_important_landmarks(self) -> None:
         """
         Determine Important landmarks for plank detection
@@ -297,6 +246,23 @@ class BicepCurlDetection:
             "RIGHT_HIP",
         ]
 
+        self.important_landmark_indices = get_landmark_indices(self.important_landmarks)
+
+        # Shoulder, elbow and wrist of each arm for the arm analysis
+        self.arm_landmark_indices = {
+            side: get_landmark_indices(
+                [f"{side}_SHOULDER", f"{side}_ELBOW", f"{side}_WRIST"]
+            )
+            for side in ["LEFT", "RIGHT"]
+        }
+
+        # Joints of the angles measured for each arm, left arm first:
+        # curl angle at the elbow and angle between the upper arm and the vertical axis at the shoulder
+        self.curl_angle_triplets = np.array(
+            [self.arm_landmark_indices[side] for side in ["LEFT", "RIGHT"]]
+        )
+        self.upper_arm_pairs = self.curl_angle_triplets[:, [1, 0]]
+
         # Generate all columns of the data frame
         self.headers = ["label"]  # Label column
 
@@ -316,48 +282,181 @@ class BicepCurlDetection:
             raise Exception("Cannot found plank model")
 
         try:
-            with open(self.ML_MODEL_PATH, "rb") as f:
-                self.model = pickle.load(f)
+            self.model = load_model_artifact(self.ML_MODEL_PATH)
 
-            with open(self.INPUT_SCALER, "rb") as f2:
-                self.input_scaler = pickle.load(f2)
+            self.input_scaler = load_model_artifact(self.INPUT_SCALER)
         except Exception as e:
             raise Exception(f"Error loading model, {e}")
 
-    def handle_detected_results(self, video_name: str) -> tuple:
+    def predict(self, rows) -> list:
+        """Predict classes of a batch of frames with a single model call
+
+        Args:
+            rows (np.ndarray): Keypoints of the important landmarks, one row per frame
+
+        Returns:
+            list: Predicted class and probabilities of all classes for each frame
         """
-        Save frame as evidence
+        X = self.input_scaler.transform(
+            model_input(self.input_scaler, rows, self.headers[1:])
+        )
+        prediction_probabilities = self.model.predict_proba(model_input(self.model, X))
+        predicted_classes = self.model.classes_[prediction_probabilities.argmax(axis=1)]
+
+        return list(zip(predicted_classes, prediction_probabilities))
+
+    def measure(self, landmarks) -> np.ndarray:
+        """Measure the angles of both arms in a single call
+
+        Args:
+            landmarks (np.ndarray): Landmarks of frames, shape (33, 4) or (frames, 33, 4)
+
+        Returns:
+            np.ndarray: Curl angle and upper arm angle of the left then the right arm, shape (2, 2) or (frames, 2, 2)
         """
-        file_name, _ = video_name.split(".")
-        save_folder = get_static_file_url("images")
-        for index, error in enumerate(self.results):
-            try:
-                image_name = f"{file_name}_{index}.jpg"
-                cv2.imwrite(f"{save_folder}/{file_name}_{index}.jpg", error["frame"])
-                self.results[index]["frame"] = image_name
-            except Exception as e:
-                print("ERROR cannot save frame: " + str(e))
-                self.results[index]["frame"] = None
+        points = landmarks[..., :2]
+
+        return np.stack(
+            [
+                joint_angles(points, self.curl_angle_triplets),
+                vertical_angles(points, self.upper_arm_pairs),
+            ],
+            axis=-1,
+        )
+
+
+class BicepCurlDetection:
+    VISIBILITY_THRESHOLD = 0.65
+
+    # Params for counter
+    STAGE_UP_THRESHOLD = 100
+    STAGE_DOWN_THRESHOLD = 120
+
+    # Params to catch FULL RANGE OF MOTION error
+    PEAK_CONTRACTION_THRESHOLD = 60
+
+    # LOOSE UPPER ARM error detection
+    LOOSE_UPPER_ARM = False
+    LOOSE_UPPER_ARM_ANGLE_THRESHOLD = 40
+
+    # STANDING POSTURE error detection
+    POSTURE_ERROR_THRESHOLD = 0.95
+
+    def __init__(self, ml_model: BicepCurlModel) -> None:
+        self.ml_model = ml_model
+        self.landmarks_buffer = LandmarksBuffer()
+
+        self.left_arm_analysis = BicepPoseAnalysis(
+            side="left",
+            joint_indices=ml_model.arm_landmark_indices["LEFT"],
+            stage_down_threshold=self.STAGE_DOWN_THRESHOLD,
+            stage_up_threshold=self.STAGE_UP_THRESHOLD,
+            peak_contraction_threshold=self.PEAK_CONTRACTION_THRESHOLD,
+            loose_upper_arm_angle_threshold=self.LOOSE_UPPER_ARM_ANGLE_THRESHOLD,
+            visibility_threshold=self.VISIBILITY_THRESHOLD,
+        )
+
+        self.right_arm_analysis = BicepPoseAnalysis(
+            side="right",
+            joint_indices=ml_model.arm_landmark_indices["RIGHT"],
+            stage_down_threshold=self.STAGE_DOWN_THRESHOLD,
+            stage_up_threshold=self.STAGE_UP_THRESHOLD,
+            peak_contraction_threshold=self.PEAK_CONTRACTION_THRESHOLD,
+            loose_upper_arm_angle_threshold=self.LOOSE_UPPER_ARM_ANGLE_THRESHOLD,
+            visibility_threshold=self.VISIBILITY_THRESHOLD,
+        )
 
+        self.stand_posture = 0
+        self.previous_stand_posture = 0
+        self.evidence = EvidenceSelection()
+        self.has_error = False
+
+    @property
+    def results(self) -> list:
+        """Errors kept as evidence, in detection order"""
+        return self.evidence.results
+
+    def handle_detected_results(self) -> tuple:
+        """
+        Results of the analysis, evidence frames are saved as images by an EvidenceWriter
+        """
         return self.results, {
             "left_counter": self.left_arm_analysis.get_counter(),
             "right_counter": self.right_arm_analysis.get_counter(),
         }
 
-    def clear_results(self) -> None:
-        self.stand_posture = 0
-        self.previous_stand_posture = 0
-        self.results = []
+    def clear_results(self, keep_stage: bool = False) -> None:
+        """Clear results and counters
+
+        Args:
+            keep_stage (bool, optional): Keep the current stage of the exercise, used when analysis resumes from a previous part of a video. Defaults to False.
+        """
+        self.evidence.clear()
         self.has_error = False
 
-        self.right_arm_analysis.reset()
-        self.left_arm_analysis.reset()
+        if not keep_stage:
+            self.stand_posture = 0
+            self.previous_stand_posture = 0
+
+        self.right_arm_analysis.reset(keep_stage=keep_stage)
+        self.left_arm_analysis.reset(keep_stage=keep_stage)
+
+    def get_state(self) -> dict:
+        """Current stage, counter and error state of the exercise, for live feedback"""
+        return {
+            "stage": {
+                "left": self.left_arm_analysis.stage,
+                "right": self.right_arm_analysis.stage,
+            },
+            "counter": {
+                "left_counter": self.left_arm_analysis.get_counter(),
+                "right_counter": self.right_arm_analysis.get_counter(),
+            },
+            "has_error": self.has_error,
+        }
+
+    def detect_batch(self, frames: list, landmarks=None) -> None:
+        """Bicep curl errors detection on consecutive frames, with a single model prediction for all of them
+
+        Args:
+            frames (list): List of (mp_results, image, timestamp) of consecutive frames. Image is None to skip drawing
+            landmarks (np.ndarray, optional): Landmarks of the frames, shape (frames, 33, 4). Defaults to None, converted from the MediaPipe results.
+        """
+        # Convert landmarks of all frames once, shared by the model and the pose analysis
+        if landmarks is None:
+            landmarks = self.landmarks_buffer.convert(
+                [mp_results.pose_landmarks for mp_results, _, _ in frames]
+            )
+        predictions = self.ml_model.predict(
+            extract_important_keypoints(
+                landmarks, self.ml_model.important_landmark_indices
+            )
+        )
+        angles = self.ml_model.measure(landmarks)
+
+        for (
+            (mp_results, image, timestamp),
+            frame_landmarks,
+            prediction,
+            frame_angles,
+        ) in zip(frames, landmarks, predictions, angles):
+            self.detect(
+                mp_results,
+                image,
+                timestamp,
+                landmarks=frame_landmarks,
+                prediction=prediction,
+                angles=frame_angles,
+            )
 
     def detect(
         self,
         mp_results,
         image,
         timestamp: int,
+        landmarks=None,
+        prediction: tuple = None,
+        angles=None,
     ) -> None:
         """Error detection
 
@@ -365,27 +464,31 @@ class BicepCurlDetection:
             mp_results (): MediaPipe results
             image (): OpenCV image
             timestamp (int): Current time of the frame
+            landmarks (np.ndarray, optional): Landmarks of this frame already converted by detect_batch. Defaults to None.
+            prediction (tuple, optional): Class and probabilities already predicted for this frame by detect_batch. Defaults to None.
+            angles (np.ndarray, optional): Angles of both arms already measured for this frame by detect_batch. Defaults to None.
         """
         self.has_error = False
 
         try:
-            video_dimensions = [image.shape[1], image.shape[0]]
-            landmarks = mp_results.pose_landmarks.landmark
+            if landmarks is None:
+                landmarks = self.landmarks_buffer.convert([mp_results.pose_landmarks])[
+                    0
+                ]
 
             # * Model prediction for Lean-back error
-            # Extract keypoints from frame for the input
-            row = extract_important_keypoints(mp_results, self.important_landmarks)
-            X = pd.DataFrame(
-                [
-                    row,
-                ],
-                columns=self.headers[1:],
-            )
-            X = pd.DataFrame(self.input_scaler.transform(X))
+            if prediction is None:
+                # Extract keypoints from frame for the input
+                row = extract_important_keypoints(
+                    landmarks, self.ml_model.important_landmark_indices
+                )
+                prediction = self.ml_model.predict(row[np.newaxis])[0]
+
+            if angles is None:
+                angles = self.ml_model.measure(landmarks)
 
             # Make prediction and its probability
-            predicted_class = self.model.predict(X)[0]
-            prediction_probabilities = self.model.predict_proba(X)[0]
+            predicted_class, prediction_probabilities = prediction
             class_prediction_probability = round(
                 prediction_probabilities[np.argmax(prediction_probabilities)], 2
             )
@@ -398,12 +501,13 @@ class BicepCurlDetection:
                 if self.previous_stand_posture == self.stand_posture:
                     pass
                 elif self.previous_stand_posture != self.stand_posture:
-                    self.results.append(
+                    self.evidence.add(
                         {
                             "stage": "lean too far back",
                             "frame": image,
                             "timestamp": timestamp,
-                        }
+                        },
+                        score=class_prediction_probability,
                     )
 
                 self.has_error = True
@@ -418,8 +522,9 @@ class BicepCurlDetection:
                 left_arm_error,
             ) = self.left_arm_analysis.analyze_pose(
                 landmarks=landmarks,
+                angles=angles[0],
                 frame=image,
-                results=self.results,
+                evidence=self.evidence,
                 timestamp=timestamp,
                 lean_back_error=(self.stand_posture == "L"),
             )
@@ -431,8 +536,9 @@ class BicepCurlDetection:
                 right_arm_error,
             ) = self.right_arm_analysis.analyze_pose(
                 landmarks=landmarks,
+                angles=angles[1],
                 frame=image,
-                results=self.results,
+                evidence=self.evidence,
                 timestamp=timestamp,
                 lean_back_error=(self.stand_posture == "L"),
             )
@@ -442,6 +548,11 @@ class BicepCurlDetection:
             )
 
             # Visualization
+            if image is None:
+                return
+
+            video_dimensions = [image.shape[1], image.shape[0]]
+
             # Draw landmarks and connections
             landmark_color, connection_color = get_drawing_color(self.has_error)
             mp_drawing.draw_landmarks(
@@ -0,0 +1,178 @@
+import os
+import shutil
+import subprocess
+import cv2
+import numpy as np
+from contextlib import closing
+from django.conf import settings
+
+
+class VideoDecoder:
+    """Decode the frames of a video as RGB images of a given size, ready for MediaPipe
+
+    Properties of the video are read once when the decoder is created.
+    """
+
+    def __init__(self, path: str, options: dict = None) -> None:
+        """
+        Args:
+            path (str): Path of the video
+            options (dict, optional): Overrides of VIDEO_DECODER. Defaults to None.
+        """
+        self.path = path
+        self.options = {**settings.VIDEO_DECODER, **(options or {})}
+
+        cap = cv2.VideoCapture(path)
+        self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = cap.get(cv2.CAP_PROP_FPS)
+        self.frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+
+    def read_frames(self, size: tuple, start_frame: int = 0, end_frame: int = None):
+        """Decode consecutive frames
+
+        Args:
+            size (tuple): Width and height of the returned frames
+            start_frame (int, optional): Index of the first frame to read. Defaults to 0.
+            end_frame (int, optional): Stop before this frame index. Defaults to None, read until the end of the video.
+
+        Yields:
+            np.ndarray: RGB frame, shape (height, width, 3)
+        """
+        raise NotImplementedError
+
+    def read_frame_at(self, timestamp: float, size: tuple) -> np.ndarray:
+        """Decode the frame shown at a timestamp (in second), None after the end of the video"""
+        start_frame = int(timestamp * self.fps)
+
+        # Closed right away so the capture or the ffmpeg process is released
+        with closing(self.read_frames(size, start_frame, start_frame + 1)) as frames:
+            return next(frames, None)
+
+
+class OpenCVVideoDecoder(VideoDecoder):
+    """Decode frames with cv2.VideoCapture at the source size, then resize them and convert them to RGB"""
+
+    def read_frames(self, size: tuple, start_frame: int = 0, end_frame: int = None):
+        cap = cv2.VideoCapture(self.path)
+        frame_index = start_frame
+
+        try:
+            if start_frame:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+            while end_frame is None or frame_index < end_frame:
+                ret, image = cap.read()
+                if not ret:
+                    break
+
+                frame_index += 1
+                image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+                yield cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        finally:
+            cap.release()
+
+
+def ffmpeg_frame_output_args(size: tuple) -> list:
+    """ffmpeg output arguments of raw RGB frames scaled to a size
+
+    Args:
+        size (tuple): Width and height of the frames
+
+    Returns:
+        list: Arguments before the output of ffmpeg
+    """
+    width, height = size
+
+    return [
+        "-an",
+        # One output frame per decoded frame, like OpenCV
+        "-vsync",
+        "passthrough",
+        "-vf",
+        f"scale={width}:{height}:flags=area",
+        "-pix_fmt",
+        "rgb24",
+        "-f",
+        "rawvideo",
+    ]
+
+
+class FFmpegVideoDecoder(VideoDecoder):
+    """Decode frames with an ffmpeg process writing raw RGB frames on its standard output
+
+    The codec decodes on the threads of VIDEO_DECODER, and frames are scaled and converted to
+    RGB in a single pass as they are decoded, so full size BGR frames are never copied to Python.
+    Seeking is frame accurate: ffmpeg decodes from the previous key frame and drops the frames
+    before the start.
+    """
+
+    def read_frames(self, size: tuple, start_frame: int = 0, end_frame: int = None):
+        width, height = size
+
+        args = [
+            shutil.which("ffmpeg"),
+            "-loglevel",
+            "error",
+            "-threads",
+            str(self.options["threads"]),
+        ]
+        if start_frame:
+            args += ["-ss", f"{start_frame / self.fps:.6f}"]
+        args += ["-i", self.path] + ffmpeg_frame_output_args(size)
+        if end_frame is not None:
+            args += ["-frames:v", str(max(end_frame - start_frame, 0))]
+        args.append("pipe:1")
+
+        process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        try:
+            while True:
+                image = np.empty((height, width, 3), np.uint8)
+                if process.stdout.readinto(memoryview(image).cast("B")) < image.nbytes:
+                    break
+
+                yield image
+
+            if process.wait() != 0:
+                raise Exception(
+                    f"Error decoding video, ffmpeg exited with {process.returncode}"
+                )
+        finally:
+            process.kill()
+            process.stdout.close()
+            process.wait()
+
+
+VIDEO_DECODER_BACKENDS = {
+    "opencv": OpenCVVideoDecoder,
+    "ffmpeg": FFmpegVideoDecoder,
+}
+
+
+def get_video_decoder_backend() -> str:
+    """Backend of VIDEO_DECODER, "auto" is ffmpeg if it is installed and OpenCV otherwise"""
+    backend = settings.VIDEO_DECODER["backend"]
+    if backend == "auto":
+        backend = "ffmpeg" if shutil.which("ffmpeg") else "opencv"
+
+    return backend
+
+
+def create_video_decoder(path: str) -> VideoDecoder:
+    """Create the decoder of a video with the backend of VIDEO_DECODER
+
+    Raises:
+        Exception: Unknown backend, or the video cannot be read
+    """
+    backend = get_video_decoder_backend()
+    decoder_class = VIDEO_DECODER_BACKENDS.get(backend)
+    if not decoder_class:
+        raise Exception(f"Unknown video decoder backend {backend}")
+
+    decoder = decoder_class(path)
+    # Missing or corrupted files are opened with a size of 0
+    if decoder.width <= 0 or decoder.height <= 0:
+        raise Exception(f"Cannot read video {os.path.basename(path)}")
+
+    return decoder
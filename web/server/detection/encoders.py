@@ -0,0 +1,187 @@
+import shutil
+import tempfile
+import subprocess
+import cv2
+import numpy as np
+from django.conf import settings
+
+
+class OpenCVVideoEncoder:
+    """Encode BGR frames with cv2.VideoWriter, using the fourcc of VIDEO_ENCODER"""
+
+    def __init__(self, path: str, fps: int, size: tuple, options: dict = None) -> None:
+        """
+        Args:
+            path (str): Path of the video
+            fps (int): Frames per second of the video
+            size (tuple): Width and height of the frames
+            options (dict, optional): Overrides of VIDEO_ENCODER. Defaults to None.
+
+        Raises:
+            Exception: The codec is not supported by this OpenCV build
+        """
+        self.options = {**settings.VIDEO_ENCODER, **(options or {})}
+        self.out = cv2.VideoWriter(
+            path, cv2.VideoWriter_fourcc(*self.options["fourcc"]), fps, size
+        )
+
+        # Some OpenCV builds cannot write avc1, fail instead of writing nothing
+        if not self.out.isOpened():
+            raise Exception(
+                f"Cannot encode video with OpenCV, fourcc {self.options['fourcc']} is not supported"
+            )
+
+    def write(self, image: np.ndarray) -> None:
+        self.out.write(image)
+
+    def release(self) -> None:
+        self.out.release()
+
+
+class FFmpegVideoEncoder:
+    """Encode BGR frames with an ffmpeg process fed raw frames on its standard input
+
+    Preset, quality (crf or bitrate), threads and faststart come from VIDEO_ENCODER.
+    Subclasses change the output format by overriding output_args.
+    """
+
+    def __init__(self, path: str, fps: int, size: tuple, options: dict = None) -> None:
+        """
+        Args:
+            path (str): Path of the video
+            fps (int): Frames per second of the video
+            size (tuple): Width and height of the frames
+            options (dict, optional): Overrides of VIDEO_ENCODER. Defaults to None.
+        """
+        self.options = {**settings.VIDEO_ENCODER, **(options or {})}
+        width, height = size
+        # Error messages of ffmpeg, reported if it fails
+        self.stderr = tempfile.TemporaryFile()
+
+        self.process = subprocess.Popen(
+            [
+                shutil.which("ffmpeg"),
+                "-y",
+                "-loglevel",
+                "error",
+                "-f",
+                "rawvideo",
+                "-pix_fmt",
+                "bgr24",
+                "-s",
+                f"{width}x{height}",
+                "-r",
+                str(fps),
+                "-i",
+                "-",
+                *self.encoding_args(),
+                *self.output_args(path, fps),
+            ],
+            stdin=subprocess.PIPE,
+            stderr=self.stderr,
+        )
+
+    def encoding_args(self) -> list:
+        """ffmpeg options of the video codec"""
+        args = [
+            # H.264 with yuv420p needs an even frame size
+            "-vf",
+            "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+            "-c:v",
+            self.options["codec"],
+            "-preset",
+            self.options["preset"],
+            "-pix_fmt",
+            "yuv420p",
+            "-threads",
+            str(self.options["threads"]),
+        ]
+
+        if self.options["bitrate"]:
+            args += ["-b:v", str(self.options["bitrate"])]
+        else:
+            args += ["-crf", str(self.options["crf"])]
+
+        return args
+
+    def output_args(self, path: str, fps: int) -> list:
+        """ffmpeg options of the output file, an MP4 video"""
+        if self.options["faststart"]:
+            # Move the moov atom to the front once the video is written
+            return ["-movflags", "+faststart", path]
+
+        return [path]
+
+    def write(self, image: np.ndarray) -> None:
+        """
+        Raises:
+            Exception: ffmpeg exited before the frame was written
+        """
+        try:
+            self.process.stdin.write(np.ascontiguousarray(image).tobytes())
+        except BrokenPipeError:
+            self.release()
+            raise
+
+    def release(self) -> None:
+        """Encode the last frames and close the output
+
+        Raises:
+            Exception: ffmpeg failed, with its exit code and error messages
+        """
+        if self.stderr.closed:
+            return
+
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            # ffmpeg exited before reading the last frames, its exit code tells why
+            pass
+
+        try:
+            if self.process.wait() != 0:
+                self.stderr.seek(0)
+                message = self.stderr.read().decode(errors="replace").strip()
+                raise Exception(
+                    f"Error encoding video, ffmpeg exited with {self.process.returncode}: {message}"
+                )
+        finally:
+            self.stderr.close()
+
+
+VIDEO_ENCODER_BACKENDS = {
+    "opencv": OpenCVVideoEncoder,
+    "ffmpeg": FFmpegVideoEncoder,
+}
+
+
+def get_video_encoder_backend() -> str:
+    """Backend of VIDEO_ENCODER, "auto" is ffmpeg if it is installed and OpenCV otherwise"""
+    backend = settings.VIDEO_ENCODER["backend"]
+    if backend == "auto":
+        return "ffmpeg" if shutil.which("ffmpeg") else "opencv"
+
+    return backend
+
+
+def create_video_encoder(path: str, fps: int, size: tuple, options: dict = None):
+    """Create the encoder of an analyzed video with the backend of VIDEO_ENCODER
+
+    Args:
+        path (str): Path of the video
+        fps (int): Frames per second of the video
+        size (tuple): Width and height of the frames
+        options (dict, optional): Overrides of VIDEO_ENCODER. Defaults to None.
+
+    Raises:
+        Exception: Unknown backend
+
+    Returns:
+        Encoder with the write(image) and release() methods
+    """
+    backend = get_video_encoder_backend()
+    encoder_class = VIDEO_ENCODER_BACKENDS.get(backend)
+    if not encoder_class:
+        raise Exception(f"Unknown video encoder backend {backend}")
+
+    return encoder_class(path, fps, size, options)
@@ -0,0 +1,214 @@
+import os
+import heapq
+import threading
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+from .utils import get_static_file_url
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_encoder_executor() -> ThreadPoolExecutor:
+    """Threads encoding evidence frames, shared by every analysis of the process"""
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.EVIDENCE_ENCODER_WORKERS,
+                thread_name_prefix="evidence-encoder",
+            )
+
+    return _executor
+
+
+def range_deviation(value: float, limits: list) -> float:
+    """Distance of a value outside of [lower limit, upper limit], 0 inside"""
+    lower, upper = limits
+    return float(max(lower - value, value - upper, 0))
+
+
+class EvidenceSelection:
+    """Errors kept as evidence, only the best scored ones of each error type
+
+    The policy of an error type (EVIDENCE_POLICIES, EVIDENCE_DEFAULT_POLICY otherwise) keeps
+    at most max_count errors, in a heap of their scores, and errors closer than min_gap seconds
+    are treated as one occurrence whose best scored error is kept. The number of kept errors
+    thus does not grow with the length of the video.
+
+    Every added error is counted in detected_counts, kept or not.
+    """
+
+    def __init__(self) -> None:
+        # Heap of (score, order, error) for each error type
+        self.heaps = {}
+        self.results = []
+        self.added = 0
+        # Number of detected errors of each error type
+        self.detected_counts = {}
+
+    def get_policy(self, error_type: str) -> dict:
+        return settings.EVIDENCE_POLICIES.get(
+            error_type, settings.EVIDENCE_DEFAULT_POLICY
+        )
+
+    def add(self, error: dict, score: float) -> list:
+        """Add a detected error, its score tells how clearly the frame shows the error
+
+        Args:
+            error (dict): Detected error, with its "stage" (error type) and "timestamp"
+            score (float): Classifier confidence or deviation from the limits of the error
+
+        Returns:
+            list: Errors dropped from the selection, including the added error if it is not kept
+        """
+        error["score"] = round(float(score), 2)
+        self.detected_counts[error["stage"]] = (
+            self.detected_counts.get(error["stage"], 0) + 1
+        )
+        policy = self.get_policy(error["stage"])
+        heap = self.heaps.setdefault(error["stage"], [])
+
+        # Errors closer than min_gap are the same occurrence, keep the best scored one
+        close = [
+            entry
+            for entry in heap
+            if abs(entry[2]["timestamp"] - error["timestamp"]) < policy["min_gap"]
+        ]
+        if any(entry[0] >= error["score"] for entry in close):
+            return [error]
+
+        others = [entry for entry in heap if all(entry is not c for c in close)]
+        heapq.heapify(others)
+        if len(others) >= policy["max_count"] and others[0][0] >= error["score"]:
+            return [error]
+
+        # Replace the close errors and, if the heap is full, the worst scored error
+        dropped = close
+        while others and len(others) >= policy["max_count"]:
+            dropped.append(heapq.heappop(others))
+
+        heapq.heappush(others, (error["score"], self.added, error))
+        self.heaps[error["stage"]] = others
+        self.added += 1
+
+        # Kept errors stay in detection order
+        dropped = [entry[2] for entry in dropped]
+        if dropped:
+            self.results = [
+                result
+                for result in self.results
+                if all(result is not d for d in dropped)
+            ]
+        self.results.append(error)
+
+        return dropped
+
+    def clear(self) -> None:
+        self.heaps = {}
+        self.results = []
+        self.detected_counts = {}
+
+
+def remove_evidence_images(results: list) -> None:
+    """Remove the saved images of errors no longer kept as evidence"""
+    save_folder = get_static_file_url("images")
+
+    for error in results:
+        if not isinstance(error["frame"], str):
+            continue
+
+        path = os.path.join(save_folder, error["frame"])
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class EvidenceWriter:
+    """Save the evidence frames of an analysis as JPEG images while the video is analyzed
+
+    A captured result keeps its frame only until the frame is encoded, then its "frame" is
+    replaced by the image name (None if the image cannot be saved). Frames waiting to be
+    encoded take at most max_memory bytes, capture blocks until enough of them are encoded.
+    """
+
+    def __init__(self, video_name: str, max_memory: int) -> None:
+        """
+        Args:
+            video_name (str): Name of the analyzed video, images are named after it
+            max_memory (int): Max number of bytes of frames waiting to be encoded
+        """
+        self.file_name = video_name.split(".")[0]
+        self.save_folder = get_static_file_url("images")
+        self.max_memory = max_memory
+
+        self.images_count = 0
+        # Captured results still kept as evidence, by id, with their image name and encoding
+        self.captured = {}
+        self.futures = []
+        self.pending_memory = 0
+        self._condition = threading.Condition()
+
+    def update(self, results: list) -> None:
+        """Save the frames of new results, their overlay must be finished, and remove the
+        images of results dropped from the evidence selection since the last update"""
+        kept = {id(result) for result in results}
+
+        for key in [key for key in self.captured if key not in kept]:
+            _, image_name, future = self.captured.pop(key)
+            future.add_done_callback(
+                lambda _, image_name=image_name: self._remove_image(image_name)
+            )
+
+        for result in results:
+            if id(result) not in self.captured and result["frame"] is not None:
+                self.capture(result)
+
+    def capture(self, result: dict) -> None:
+        frame = result["frame"]
+        image_name = f"{self.file_name}_{self.images_count}.jpg"
+        self.images_count += 1
+
+        # A frame larger than the limit is still encoded, alone
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.pending_memory == 0
+                or self.pending_memory + frame.nbytes <= self.max_memory
+            )
+            self.pending_memory += frame.nbytes
+
+        future = get_encoder_executor().submit(self._save, result, image_name)
+        self.captured[id(result)] = (result, image_name, future)
+        self.futures = [f for f in self.futures if not f.done()] + [future]
+
+    def _save(self, result: dict, image_name: str) -> None:
+        frame = result["frame"]
+
+        try:
+            ret, buffer = cv2.imencode(".jpg", frame)
+            if not ret:
+                raise ValueError("cannot encode frame")
+
+            with open(os.path.join(self.save_folder, image_name), "wb") as f:
+                f.write(buffer)
+            result["frame"] = image_name
+        except Exception as e:
+            print("ERROR cannot save frame: " + str(e))
+            result["frame"] = None
+        finally:
+            with self._condition:
+                self.pending_memory -= frame.nbytes
+                self._condition.notify_all()
+
+    def _remove_image(self, image_name: str) -> None:
+        path = os.path.join(self.save_folder, image_name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def close(self) -> None:
+        """Wait for every captured frame to be saved"""
+        for future in self.futures:
+            future.result()
+        self.futures = []
@@ -0,0 +1,64 @@
+import numpy as np
+
+# * Vectorized geometry of MediaPipe Pose landmarks
+# Points are arrays of shape (..., joints, 2), e.g. (33, 2) for a frame or (frames, 33, 2) for a batch.
+# Joints are selected with integer index tables so every measurement of an exercise is computed in one call.
+
+
+def _angles_at(point1, point2, point3) -> np.ndarray:
+    """Angle (in degree, 0 to 180) at point2 between point1 and point3"""
+    angles = np.arctan2(
+        point3[..., 1] - point2[..., 1], point3[..., 0] - point2[..., 0]
+    ) - np.arctan2(point1[..., 1] - point2[..., 1], point1[..., 0] - point2[..., 0])
+    angles = np.abs(np.degrees(angles))
+
+    return np.where(angles <= 180, angles, 360 - angles)
+
+
+def joint_angles(points: np.ndarray, triplets: np.ndarray) -> np.ndarray:
+    """Calculate the angle at the middle joint of each triplet of joints
+
+    Args:
+        points (np.ndarray): Joints' coordinates, shape (..., joints, 2)
+        triplets (np.ndarray): Indices of 3 joints, the angle is measured at the second one, shape (angles, 3)
+
+    Returns:
+        np.ndarray: Angles in degree, shape (..., angles)
+    """
+    return _angles_at(
+        points[..., triplets[:, 0], :],
+        points[..., triplets[:, 1], :],
+        points[..., triplets[:, 2], :],
+    )
+
+
+def vertical_angles(points: np.ndarray, pairs: np.ndarray) -> np.ndarray:
+    """Calculate the angle between each pair of joints and the vertical axis going down from the second joint
+
+    Args:
+        points (np.ndarray): Joints' coordinates, shape (..., joints, 2)
+        pairs (np.ndarray): Indices of 2 joints, the angle is measured at the second one, shape (angles, 2)
+
+    Returns:
+        np.ndarray: Angles in degree, shape (..., angles)
+    """
+    origins = points[..., pairs[:, 1], :]
+
+    # Projection of the origins to the bottom of the frame
+    projections = np.stack([origins[..., 0], np.ones_like(origins[..., 1])], axis=-1)
+
+    return _angles_at(points[..., pairs[:, 0], :], origins, projections)
+
+
+def joint_distances(points: np.ndarray, pairs: np.ndarray) -> np.ndarray:
+    """Calculate the distance between each pair of joints
+
+    Args:
+        points (np.ndarray): Joints' coordinates, shape (..., joints, 2)
+        pairs (np.ndarray): Indices of 2 joints, shape (distances, 2)
+
+    Returns:
+        np.ndarray: Distances, shape (..., distances)
+    """
+    vectors = points[..., pairs[:, 1], :] - points[..., pairs[:, 0], :]
+    return np.hypot(vectors[..., 0], vectors[..., 1])
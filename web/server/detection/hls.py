@@ -0,0 +1,126 @@
+import os
+import time
+import shutil
+import subprocess
+from django.conf import settings
+
+from .encoders import FFmpegVideoEncoder
+
+PLAYLIST_NAME = "index.m3u8"
+INIT_SEGMENT_NAME = "init.mp4"
+
+# Content types of the files of an HLS output
+HLS_CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".mp4": "video/mp4",
+    ".m4s": "video/iso.segment",
+}
+
+
+def hls_output_enabled() -> bool:
+    """Analyzed videos are written as HLS if VIDEO_OUTPUT_FORMAT is "hls" and ffmpeg is installed"""
+    return settings.VIDEO_OUTPUT_FORMAT == "hls" and shutil.which("ffmpeg") is not None
+
+
+def hls_output_dir(video_name: str) -> str:
+    """Folder of the playlist and segments of an analyzed video"""
+    return os.path.join(settings.HLS_DIR, os.path.splitext(video_name)[0])
+
+
+def hls_playlist_path(video_name: str) -> str:
+    """Path of the playlist of an analyzed video"""
+    return os.path.join(hls_output_dir(video_name), PLAYLIST_NAME)
+
+
+def remove_expired_hls_outputs(ttl: float) -> None:
+    """Remove the playlists and segments of videos whose last segment was written more than ttl seconds ago
+
+    A folder is modified each time a segment is written, the folders of videos being analyzed are kept.
+    """
+    if not os.path.isdir(settings.HLS_DIR):
+        return
+
+    now = time.time()
+    for entry in os.scandir(settings.HLS_DIR):
+        try:
+            expired = entry.is_dir() and now - entry.stat().st_mtime > ttl
+        except FileNotFoundError:
+            # Removed by another worker
+            continue
+
+        if expired:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+class HlsVideoWriter(FFmpegVideoEncoder):
+    """Encode BGR frames into HLS fragmented MP4 segments with ffmpeg
+
+    Same write / release interface as the other video encoders, with the codec options of
+    VIDEO_ENCODER. The playlist is an EVENT playlist updated after every segment, so players
+    start with the first segments while the next frames are still being analyzed, and the
+    playlist is ended once the writer is released.
+    """
+
+    def __init__(
+        self, playlist_path: str, fps: int, size: tuple, segment_seconds: int
+    ) -> None:
+        """
+        Args:
+            playlist_path (str): Path of the playlist, the segments are written next to it
+            fps (int): Frames per second of the video
+            size (tuple): Width and height of the frames
+            segment_seconds (int): Duration of a segment
+        """
+        os.makedirs(os.path.dirname(playlist_path), exist_ok=True)
+        self.segment_seconds = segment_seconds
+
+        super().__init__(playlist_path, fps, size)
+
+    def output_args(self, path: str, fps: int) -> list:
+        # A segment starts on a key frame, one key frame per segment
+        gop = max(int(fps * self.segment_seconds), 1)
+
+        return [
+            "-g",
+            str(gop),
+            "-keyint_min",
+            str(gop),
+            "-sc_threshold",
+            "0",
+            "-f",
+            "hls",
+            "-hls_time",
+            str(self.segment_seconds),
+            "-hls_playlist_type",
+            "event",
+            "-hls_segment_type",
+            "fmp4",
+            "-hls_fmp4_init_filename",
+            INIT_SEGMENT_NAME,
+            "-hls_segment_filename",
+            os.path.join(os.path.dirname(path), "segment_%05d.m4s"),
+            path,
+        ]
+
+
+def remux_hls_to_mp4(playlist_path: str, saved_path: str) -> None:
+    """Copy the segments of an HLS output into a single MP4 file, without re-encoding
+
+    The moov atom is written at the start of the file so it can be played before it is fully downloaded.
+    """
+    subprocess.run(
+        [
+            shutil.which("ffmpeg"),
+            "-y",
+            "-loglevel",
+            "error",
+            "-i",
+            playlist_path,
+            "-c",
+            "copy",
+            "-movflags",
+            "+faststart",
+            saved_path,
+        ],
+        check=True,
+    )
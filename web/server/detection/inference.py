@@ -0,0 +1,493 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+
+# Array bundle of a model: one .npy file per array, next to the parameters of the model
+BUNDLE_PARAMS_NAME = "model.json"
+
+# Version of the bundle layout, bundles of older versions are exported again
+BUNDLE_VERSION = 2
+
+
+class UnsupportedModel(Exception):
+    """The model cannot be exported to an array bundle"""
+
+
+class NumpyModel:
+    """Model evaluated with NumPy from the arrays of its bundle, as scikit-learn would evaluate it"""
+
+    kind = None
+
+    def __init__(self, params: dict, arrays: dict) -> None:
+        self.params = params
+        self.arrays = arrays
+
+        if "classes" in params:
+            self.classes_ = np.array(params["classes"])
+
+    @classmethod
+    def export(cls, estimator) -> tuple:
+        """Parameters and arrays of a fitted scikit-learn estimator
+
+        Returns:
+            tuple: Parameters, JSON serializable, and arrays of the model
+        """
+        raise NotImplementedError
+
+
+class NumpyScaler(NumpyModel):
+    """StandardScaler"""
+
+    kind = "standard_scaler"
+
+    @classmethod
+    def export(cls, estimator) -> tuple:
+        arrays = {}
+        if estimator.with_mean:
+            arrays["mean"] = np.asarray(estimator.mean_, np.float64)
+        if estimator.with_std:
+            arrays["scale"] = np.asarray(estimator.scale_, np.float64)
+
+        return {}, arrays
+
+    def transform(self, X) -> np.ndarray:
+        # Float inputs keep their precision, like in scikit-learn
+        X = np.array(X, dtype=None if np.asarray(X).dtype.kind == "f" else np.float64)
+
+        if "mean" in self.arrays:
+            X -= self.arrays["mean"]
+        if "scale" in self.arrays:
+            X /= self.arrays["scale"]
+
+        return X
+
+
+class NumpyLinearClassifier(NumpyModel):
+    """LogisticRegression, and SGDClassifier with a log loss"""
+
+    kind = "linear_classifier"
+
+    @classmethod
+    def export(cls, estimator) -> tuple:
+        estimator_class = type(estimator).__name__
+
+        if estimator_class == "LogisticRegression":
+            ovr = estimator.multi_class in ["ovr", "warn"] or (
+                estimator.multi_class == "auto"
+                and (len(estimator.classes_) <= 2 or estimator.solver == "liblinear")
+            )
+        elif estimator_class == "SGDClassifier" and estimator.loss in [
+            "log",
+            "log_loss",
+        ]:
+            ovr = True
+        else:
+            raise UnsupportedModel(f"{estimator_class} has no probabilities to export")
+
+        params = {"classes": estimator.classes_.tolist(), "ovr": ovr}
+        arrays = {
+            "coef": np.asarray(estimator.coef_, np.float64),
+            "intercept": np.asarray(estimator.intercept_, np.float64),
+        }
+
+        return params, arrays
+
+    def decision_function(self, X) -> np.ndarray:
+        scores = np.asarray(X) @ self.arrays["coef"].T + self.arrays["intercept"]
+        return scores.ravel() if scores.shape[1] == 1 else scores
+
+    def predict_proba(self, X) -> np.ndarray:
+        decision = self.decision_function(X)
+
+        if self.params["ovr"]:
+            prob = 1.0 / (1.0 + np.exp(-decision))
+            if prob.ndim == 1:
+                return np.vstack([1 - prob, prob]).T
+
+            return prob / prob.sum(axis=1).reshape((prob.shape[0], -1))
+
+        if decision.ndim == 1:
+            decision = np.c_[-decision, decision]
+
+        # Softmax
+        decision = decision - decision.max(axis=1).reshape((-1, 1))
+        np.exp(decision, decision)
+        decision /= decision.sum(axis=1).reshape((-1, 1))
+
+        return decision
+
+
+class NumpyForestClassifier(NumpyModel):
+    """RandomForestClassifier, and DecisionTreeClassifier as a forest of a single tree
+
+    Nodes of all trees are stored in the same arrays, the child indices are global.
+    """
+
+    kind = "forest_classifier"
+
+    @classmethod
+    def export(cls, estimator) -> tuple:
+        estimator_class = type(estimator).__name__
+        if estimator_class == "DecisionTreeClassifier":
+            trees = [estimator]
+        elif estimator_class == "RandomForestClassifier":
+            trees = estimator.estimators_
+        else:
+            raise UnsupportedModel(f"{estimator_class} is not a tree classifier")
+
+        if estimator.n_outputs_ != 1:
+            raise UnsupportedModel("Only forests with a single output are exported")
+
+        n_classes = len(estimator.classes_)
+        roots, left, right, feature, threshold, value = [], [], [], [], [], []
+        offset = 0
+
+        for tree in trees:
+            tree_ = tree.tree_
+            is_leaf = tree_.children_left == -1
+
+            roots.append(offset)
+            left.append(np.where(is_leaf, -1, tree_.children_left + offset))
+            right.append(np.where(is_leaf, -1, tree_.children_right + offset))
+            feature.append(np.where(is_leaf, 0, tree_.feature))
+            threshold.append(tree_.threshold)
+
+            # Probabilities of the leaves, as predict_proba of the tree normalizes them
+            leaf_value = np.array(tree_.value[:, 0, :n_classes], np.float64)
+            normalizer = leaf_value.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            value.append(leaf_value / normalizer)
+
+            offset += tree_.node_count
+
+        params = {"classes": estimator.classes_.tolist()}
+        arrays = {
+            "roots": np.array(roots, np.int64),
+            "left": np.concatenate(left).astype(np.int64),
+            "right": np.concatenate(right).astype(np.int64),
+            "feature": np.concatenate(feature).astype(np.int64),
+            "threshold": np.concatenate(threshold).astype(np.float64),
+            "value": np.concatenate(value),
+        }
+
+        return params, arrays
+
+    def apply(self, X) -> np.ndarray:
+        """Leaf reached by each sample in each tree, shape (samples, trees)"""
+        # Trees compare the features in single precision, like in scikit-learn
+        X = np.asarray(X, np.float32)
+        left, right = self.arrays["left"], self.arrays["right"]
+        feature, threshold = self.arrays["feature"], self.arrays["threshold"]
+
+        nodes = np.tile(self.arrays["roots"], (len(X), 1))
+        rows = np.arange(len(X))[:, np.newaxis]
+        active = left[nodes] != -1
+
+        while active.any():
+            goes_left = X[rows, feature[nodes]] <= threshold[nodes]
+            nodes = np.where(
+                active, np.where(goes_left, left[nodes], right[nodes]), nodes
+            )
+            active = left[nodes] != -1
+
+        return nodes
+
+    def predict_proba(self, X) -> np.ndarray:
+        leaves = self.apply(X)
+        value = self.arrays["value"]
+
+        # Summed tree by tree, in the order of scikit-learn
+        proba = np.zeros((len(leaves), value.shape[1]))
+        for tree in range(leaves.shape[1]):
+            proba += value[leaves[:, tree]]
+
+        proba /= leaves.shape[1]
+        return proba
+
+
+class NumpyKNeighborsClassifier(NumpyModel):
+    """KNeighborsClassifier with uniform or distance weights, searched in a spatial index
+
+    The training samples are partitioned at export by median splits along their widest feature,
+    like a k-d tree, into leaves of about sqrt(samples) samples. A query computes its distance
+    to the bounding box of every leaf, then visits the leaves closest box first and stops once
+    no remaining box can hold a closer neighbor. Both steps grow with sqrt(samples).
+
+    With a positive epsilon, a leaf is skipped unless its box is (1 + epsilon) times closer than
+    the k-th neighbor found so far: the k-th neighbor returned is then at most (1 + epsilon)
+    times farther than the exact one.
+    """
+
+    kind = "kneighbors_classifier"
+
+    METRICS = ["euclidean", "manhattan", "minkowski"]
+
+    # Smallest number of training samples per leaf of the index
+    MIN_LEAF_SIZE = 32
+
+    # Max number of (query, leaf, feature) bounds computed at once
+    BOUNDS_BLOCK_SIZE = 1 << 22
+
+    @classmethod
+    def export(cls, estimator) -> tuple:
+        metric = estimator.effective_metric_
+        if metric not in cls.METRICS or estimator.weights not in [
+            "uniform",
+            "distance",
+        ]:
+            raise UnsupportedModel(
+                f"KNN with {metric} metric and {estimator.weights} weights is not exported"
+            )
+
+        if estimator.outputs_2d_:
+            raise UnsupportedModel("Only KNN with a single output are exported")
+
+        params = {
+            "classes": estimator.classes_.tolist(),
+            "n_neighbors": estimator.n_neighbors,
+            "weights": estimator.weights,
+            "metric": metric,
+            "p": (estimator.effective_metric_params_ or {}).get("p", 2),
+        }
+        arrays = {
+            **cls.build_index(np.asarray(estimator._fit_X, np.float64)),
+            "y": np.asarray(estimator._y, np.int64),
+        }
+
+        return params, arrays
+
+    @classmethod
+    def build_index(cls, fit_X: np.ndarray) -> dict:
+        """Partition the training samples into leaves of the same size
+
+        Returns:
+            dict: Samples of each leaf, padded to the leaf size, their indices in the training set (-1 for padding) and the bounding box of each leaf
+        """
+        leaf_size = max(cls.MIN_LEAF_SIZE, int(np.ceil(np.sqrt(len(fit_X)))))
+        leaves = []
+        pending = [np.arange(len(fit_X))]
+
+        while pending:
+            indices = pending.pop()
+            if len(indices) <= leaf_size:
+                leaves.append(indices)
+                continue
+
+            samples = fit_X[indices]
+            widest = np.argmax(samples.max(axis=0) - samples.min(axis=0))
+            middle = len(indices) // 2
+            order = np.argpartition(samples[:, widest], middle)
+
+            # Depth first, neighbor leaves are stored next to each other
+            pending.append(indices[order[middle:]])
+            pending.append(indices[order[:middle]])
+
+        leaf_indices = np.full((len(leaves), leaf_size), -1, np.int64)
+        for leaf, indices in enumerate(leaves):
+            leaf_indices[leaf, : len(indices)] = indices
+
+        # Padding repeats the first sample of the leaf, it never changes the leaf bounds
+        padded_indices = np.where(leaf_indices == -1, leaf_indices[:, :1], leaf_indices)
+        leaf_samples = fit_X[padded_indices]
+
+        return {
+            "leaf_samples": leaf_samples,
+            "leaf_indices": leaf_indices,
+            "leaf_lower": leaf_samples.min(axis=1),
+            "leaf_upper": leaf_samples.max(axis=1),
+        }
+
+    def reduce_distances(self, differences: np.ndarray) -> np.ndarray:
+        """Distances from the absolute differences of the features, on the last axis"""
+        metric = self.params["metric"]
+
+        if metric == "euclidean":
+            return np.sqrt(np.einsum("...i,...i->...", differences, differences))
+        if metric == "manhattan":
+            return differences.sum(axis=-1)
+
+        p = self.params["p"]
+        return (differences**p).sum(axis=-1) ** (1 / p)
+
+    def kneighbors(self, X) -> tuple:
+        """Distances and training indices of the nearest training samples, closest first"""
+        X = np.asarray(X, np.float64)
+        k = self.params["n_neighbors"]
+        distances = np.empty((len(X), k))
+        indices = np.empty((len(X), k), np.int64)
+
+        # Queries are searched by blocks bounding the memory of the leaf bounds
+        leaf_lower = self.arrays["leaf_lower"]
+        block_size = max(1, self.BOUNDS_BLOCK_SIZE // leaf_lower.size)
+
+        for start in range(0, len(X), block_size):
+            block = slice(start, start + block_size)
+            distances[block], indices[block] = self.search(X[block])
+
+        return distances, indices
+
+    def search(self, X: np.ndarray) -> tuple:
+        k = self.params["n_neighbors"]
+        epsilon = self.params.get("epsilon", 0.0)
+        leaf_samples = self.arrays["leaf_samples"]
+        leaf_indices = self.arrays["leaf_indices"]
+
+        # Distance from each query to the bounding box of each leaf
+        gaps = np.maximum(
+            self.arrays["leaf_lower"] - X[:, np.newaxis],
+            X[:, np.newaxis] - self.arrays["leaf_upper"],
+        )
+        leaf_bounds = self.reduce_distances(np.maximum(gaps, 0)) * (1 + epsilon)
+        leaf_order = np.argsort(leaf_bounds, axis=1)
+        rows = np.arange(len(X))
+
+        best_distances = np.full((len(X), k), np.inf)
+        best_indices = np.full((len(X), k), -1, np.int64)
+
+        for visit in range(leaf_order.shape[1]):
+            leaves = leaf_order[:, visit]
+
+            # Leaves are visited closest box first, a query whose next box is too far is done
+            searching = rows[leaf_bounds[rows, leaves] <= best_distances[:, -1]]
+            if not len(searching):
+                break
+
+            leaves = leaves[searching]
+            candidate_distances = self.reduce_distances(
+                np.abs(leaf_samples[leaves] - X[searching, np.newaxis])
+            )
+            candidate_indices = leaf_indices[leaves]
+            candidate_distances[candidate_indices == -1] = np.inf
+
+            merged_distances = np.concatenate(
+                [best_distances[searching], candidate_distances], axis=1
+            )
+            merged_indices = np.concatenate(
+                [best_indices[searching], candidate_indices], axis=1
+            )
+            nearest = np.argsort(merged_distances, axis=1, kind="stable")[:, :k]
+            merged_rows = np.arange(len(searching))[:, np.newaxis]
+
+            best_distances[searching] = merged_distances[merged_rows, nearest]
+            best_indices[searching] = merged_indices[merged_rows, nearest]
+
+        return best_distances, best_indices
+
+    def predict_proba(self, X) -> np.ndarray:
+        distances, indices = self.kneighbors(X)
+
+        if self.params["weights"] == "distance":
+            with np.errstate(divide="ignore"):
+                weights = 1.0 / distances
+
+            # Samples on a training sample only get the votes of their exact matches
+            inf_mask = np.isinf(weights)
+            inf_row = np.any(inf_mask, axis=1)
+            weights[inf_row] = inf_mask[inf_row]
+        else:
+            weights = np.ones_like(distances)
+
+        labels = self.arrays["y"][indices]
+        rows = np.arange(len(labels))
+        proba = np.zeros((len(labels), len(self.classes_)))
+
+        for neighbor in range(labels.shape[1]):
+            proba[rows, labels[:, neighbor]] += weights[:, neighbor]
+
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        proba /= normalizer
+
+        return proba
+
+
+NUMPY_MODEL_CLASSES = {
+    "StandardScaler": NumpyScaler,
+    "LogisticRegression": NumpyLinearClassifier,
+    "SGDClassifier": NumpyLinearClassifier,
+    "DecisionTreeClassifier": NumpyForestClassifier,
+    "RandomForestClassifier": NumpyForestClassifier,
+    "KNeighborsClassifier": NumpyKNeighborsClassifier,
+}
+NUMPY_MODEL_KINDS = {
+    model_class.kind: model_class for model_class in NUMPY_MODEL_CLASSES.values()
+}
+
+
+def save_inference_bundle(bundle_path: str, estimator) -> None:
+    """Export a fitted scikit-learn estimator to an array bundle
+
+    The bundle is written aside then moved in place. If another process wrote it meanwhile,
+    its bundle is kept.
+
+    Raises:
+        UnsupportedModel: The estimator has no NumPy evaluator
+    """
+    estimator_class = type(estimator).__name__
+    model_class = NUMPY_MODEL_CLASSES.get(estimator_class)
+    if not model_class:
+        raise UnsupportedModel(f"{estimator_class} has no NumPy evaluator")
+
+    params, arrays = model_class.export(estimator)
+    parent_dir = os.path.dirname(bundle_path)
+    os.makedirs(parent_dir, exist_ok=True)
+    temp_path = tempfile.mkdtemp(dir=parent_dir, suffix=".tmp")
+
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_path, f"{name}.npy"), array)
+
+        with open(os.path.join(temp_path, BUNDLE_PARAMS_NAME), "w") as f:
+            json.dump({"kind": model_class.kind, "params": params}, f)
+
+        os.rename(temp_path, bundle_path)
+    except OSError:
+        if not os.path.isdir(bundle_path):
+            raise
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+
+def load_inference_bundle(
+    bundle_path: str, mmap_mode: str = None, params: dict = None
+) -> NumpyModel:
+    """Load the evaluator of an array bundle
+
+    Args:
+        bundle_path (str): Directory of the bundle
+        mmap_mode (str, optional): mmap mode of the arrays, see np.load. Defaults to None, arrays read in memory.
+        params (dict, optional): Evaluation parameters overriding the exported ones, e.g. epsilon of KNN. Defaults to None.
+    """
+    with open(os.path.join(bundle_path, BUNDLE_PARAMS_NAME)) as f:
+        bundle = json.load(f)
+
+    arrays = {
+        os.path.splitext(file_name)[0]: np.load(
+            os.path.join(bundle_path, file_name), mmap_mode=mmap_mode
+        )
+        for file_name in os.listdir(bundle_path)
+        if file_name.endswith(".npy")
+    }
+
+    return NUMPY_MODEL_KINDS[bundle["kind"]](
+        {**bundle["params"], **(params or {})}, arrays
+    )
+
+
+def model_input(model, X, columns: list = None):
+    """Samples in the form a model expects: a data frame for a scikit-learn model, the array itself otherwise
+
+    Args:
+        model: scikit-learn estimator, NumpyModel or OnnxModel
+        X (np.ndarray): Samples, one row per sample
+        columns (list, optional): Feature names the estimator was fitted with. Defaults to None.
+    """
+    if not type(model).__module__.startswith("sklearn."):
+        return X
+
+    # Only needed to serve scikit-learn models
+    import pandas as pd
+
+    return pd.DataFrame(X, columns=columns)
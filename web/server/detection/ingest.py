@@ -0,0 +1,321 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import itertools
+import threading
+import traceback
+import subprocess
+import numpy as np
+from django.conf import settings
+
+from .decoders import ffmpeg_frame_output_args, get_video_decoder_backend
+from .pose_cache import (
+    POSE_RECORD_DTYPE,
+    PoseCache,
+    pose_cache_key_from_digest,
+    record_pose_results,
+)
+from .pose_graphs import get_pose_pool
+from .resolution import get_policy_size
+from .utils import LandmarksBuffer
+
+# Suffix of an upload file until every byte is received
+PARTIAL_UPLOAD_SUFFIX = ".part"
+
+# Bytes of an upload are read by chunks of this size
+READ_CHUNK_SIZE = 64 * 1024
+
+# Number of seconds between 2 looks at an upload file which has not grown
+FOLLOW_INTERVAL = 0.2
+
+# Progress of an ingest is reported every this number of frames
+REPORT_INTERVAL_FRAMES = 100
+
+
+def streaming_ingest_enabled() -> bool:
+    """Bytes are decoded by ffmpeg and landmarks saved to the pose cache, both are needed
+
+    The analysis must decode videos with ffmpeg too, for the landmarks to be estimated on the same frames.
+    """
+    return (
+        settings.UPLOAD_STREAMING_INGEST
+        and settings.POSE_CACHE_MAX_SIZE > 0
+        and settings.UPLOAD_INGEST_WORKERS > 0
+        and get_video_decoder_backend() == "ffmpeg"
+        and shutil.which("ffmpeg") is not None
+        and shutil.which("ffprobe") is not None
+    )
+
+
+def partial_upload_path(upload_path: str) -> str:
+    """Path an upload is written to until every byte is received, it is then moved to upload_path"""
+    return upload_path + PARTIAL_UPLOAD_SUFFIX
+
+
+class PoseIngest:
+    """Estimate the pose landmarks of a video while it is still being uploaded
+
+    The upload is written to its partial file (see partial_upload_path), moved to the upload path
+    once every byte is received. The ingest reads the partial file as it grows: the first bytes
+    are probed by ffprobe for the size and frame rate of the video, then every byte is piped
+    into ffmpeg, which decodes the frames as they arrive into the same RGB frames of the
+    processing size as FFmpegVideoDecoder, and MediaPipe Pose runs on them. Once the upload is
+    complete, the landmarks are published to the pose cache under the key exercise_detection
+    computes from the whole file, so the analysis of the received video replays them instead
+    of running MediaPipe Pose again.
+
+    Ingests run in the video job workers, apart from the web server processes.
+
+    Only streamable videos (MP4 with the moov atom first, fragmented MP4, WebM, ...) can be
+    decoded before their end. Any other video fails the ingest, and is analyzed as usual.
+    """
+
+    def __init__(
+        self,
+        upload_path: str,
+        resolution_policy: dict,
+        pose_options: dict,
+        idle_timeout: float,
+    ) -> None:
+        """
+        Args:
+            upload_path (str): Path of the upload once it is complete
+            resolution_policy (dict): Resolution policy sizing the frames, see get_resolution_policy
+            pose_options (dict): Options of MediaPipe Pose
+            idle_timeout (float): Number of seconds without new bytes after which the upload is abandoned
+        """
+        self.upload_path = upload_path
+        self.resolution_policy = resolution_policy
+        self.pose_options = pose_options
+        self.idle_timeout = idle_timeout
+        # Size and frame rate of the frames, known once the video is probed
+        self.size = None
+        self.fps = None
+        self.pose_cache = PoseCache(
+            settings.POSE_CACHE_DIR, settings.POSE_CACHE_MAX_SIZE
+        )
+
+        self.digest = hashlib.sha256()
+        self.frames = 0
+        # Every byte of the upload has been read
+        self.is_complete = False
+
+        self.probe_process = None
+        self.process = None
+        self.probed = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self, on_frames_done=None) -> bool:
+        """Estimate the landmarks of the upload, published to the pose cache once it is complete
+
+        Args:
+            on_frames_done (callable, optional): Called with the number of frames whose landmarks are estimated. Defaults to None.
+
+        Returns:
+            bool: True if the landmarks have been published. False if the upload was complete before the ingest started, is abandoned or cannot be decoded
+        """
+        try:
+            upload = open(partial_upload_path(self.upload_path), "rb")
+        except FileNotFoundError:
+            return False
+
+        feeder = threading.Thread(
+            target=self._feed_decoder, args=(upload,), name="ingest-feed", daemon=True
+        )
+        feeder.start()
+
+        try:
+            self.probed.wait()
+            if not self.process:
+                return False
+
+            records = self._read_frames(on_frames_done)
+            if self.process.wait() != 0 or not self.is_complete or records is None:
+                return False
+
+            key = pose_cache_key_from_digest(self.digest, self.size, self.pose_options)
+            return self.pose_cache.save(key, records)
+        finally:
+            # ffmpeg blocks on a full output pipe once frames are not read anymore
+            self.stopped.set()
+            for process in [self.probe_process, self.process]:
+                if process:
+                    process.kill()
+            if self.process:
+                self.process.stdout.close()
+
+            feeder.join()
+            upload.close()
+
+    def _follow_upload(self, upload):
+        """Bytes of the upload as they are written, is_complete is set once every byte is read"""
+        partial_path = partial_upload_path(self.upload_path)
+        idle_since = time.monotonic()
+
+        while not self.stopped.is_set():
+            data = upload.read(READ_CHUNK_SIZE)
+            if data:
+                idle_since = time.monotonic()
+                self.digest.update(data)
+                yield data
+                continue
+
+            if not os.path.exists(partial_path):
+                # Moved once complete, the file is still read from its open descriptor
+                if os.path.exists(self.upload_path):
+                    for data in iter(lambda: upload.read(READ_CHUNK_SIZE), b""):
+                        self.digest.update(data)
+                        yield data
+                    self.is_complete = True
+                return
+
+            if time.monotonic() - idle_since > self.idle_timeout:
+                print(f"Upload {self.upload_path} abandoned, ingest stopped")
+                return
+
+            self.stopped.wait(FOLLOW_INTERVAL)
+
+    def _probe_video(self, chunks) -> list:
+        """Read the size and frame rate of the video with ffprobe, from its first bytes
+
+        Returns:
+            list: Chunks read while probing, to feed to the decoder
+        """
+        probed_chunks = []
+        probed_bytes = 0
+
+        self.probe_process = process = subprocess.Popen(
+            [
+                shutil.which("ffprobe"),
+                "-loglevel",
+                "error",
+                "-probesize",
+                str(settings.UPLOAD_INGEST_PROBE_SIZE),
+                "-select_streams",
+                "v:0",
+                "-show_entries",
+                "stream=width,height,r_frame_rate",
+                "-of",
+                "json",
+                "pipe:0",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+        # ffprobe exits once it has read the header, more bytes cannot be written then
+        for data in chunks:
+            probed_chunks.append(data)
+            probed_bytes += len(data)
+            try:
+                process.stdin.write(data)
+                process.stdin.flush()
+            except (BrokenPipeError, ValueError, OSError):
+                break
+
+            if probed_bytes >= settings.UPLOAD_INGEST_PROBE_SIZE:
+                break
+
+        output, _ = process.communicate()
+        if process.returncode != 0:
+            return probed_chunks
+
+        try:
+            stream = json.loads(output)["streams"][0]
+            rate_num, rate_den = (
+                int(value) for value in stream["r_frame_rate"].split("/")
+            )
+            width, height = int(stream["width"]), int(stream["height"])
+        except (ValueError, KeyError, IndexError):
+            return probed_chunks
+
+        if rate_den > 0 and rate_num >= rate_den and width > 0 and height > 0:
+            self.fps = int(rate_num / rate_den)
+            self.size = get_policy_size(width, height, self.resolution_policy)
+
+        return probed_chunks
+
+    def _feed_decoder(self, upload) -> None:
+        chunks = self._follow_upload(upload)
+        probed_chunks = []
+
+        try:
+            probed_chunks = self._probe_video(chunks)
+
+            if self.size and not self.stopped.is_set():
+                self.process = subprocess.Popen(
+                    [
+                        shutil.which("ffmpeg"),
+                        "-loglevel",
+                        "error",
+                        "-threads",
+                        str(settings.VIDEO_DECODER["threads"]),
+                        "-i",
+                        "pipe:0",
+                    ]
+                    # Same frames as FFmpegVideoDecoder, the decoder of read_video_frames
+                    + ffmpeg_frame_output_args(self.size) + ["pipe:1"],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                )
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.probed.set()
+
+        if not self.process:
+            return
+
+        for data in itertools.chain(probed_chunks, chunks):
+            try:
+                self.process.stdin.write(data)
+            except (BrokenPipeError, ValueError, OSError):
+                break
+
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+    def _read_frames(self, on_frames_done=None) -> np.ndarray:
+        """Run MediaPipe Pose on every frame decoded by ffmpeg
+
+        Returns:
+            np.ndarray: Pose records of the frames, None if no frame is decoded
+        """
+        stdout = self.process.stdout
+        width, height = self.size
+
+        records = np.empty(1024, POSE_RECORD_DTYPE)
+        landmarks_buffer = LandmarksBuffer()
+
+        with get_pose_pool().checkout(self.pose_options) as pose:
+            while True:
+                image = np.empty((height, width, 3), np.uint8)
+                if stdout.readinto(memoryview(image).cast("B")) < image.nbytes:
+                    break
+
+                image.flags.writeable = False
+
+                self.frames += 1
+                if self.frames > len(records):
+                    records = np.resize(records, len(records) * 2)
+
+                results = pose.process(image)
+                record_pose_results(
+                    records,
+                    self.frames,
+                    int(self.frames / self.fps),
+                    (
+                        landmarks_buffer.convert([results.pose_landmarks])[0]
+                        if results.pose_landmarks
+                        else None
+                    ),
+                )
+
+                if on_frames_done and self.frames % REPORT_INTERVAL_FRAMES == 0:
+                    on_frames_done(self.frames)
+
+        return records[: self.frames] if self.frames else None
@@ -1,11 +1,15 @@
-import cv2, pickle
+import cv2
 import mediapipe as mp
 import numpy as np
-import pandas as pd
 
+from .evidence import EvidenceSelection, range_deviation
+from .inference import model_input
+from .model_store import load_model_artifact
+from .geometry import joint_angles
 from .utils import (
-    calculate_angle,
     extract_important_keypoints,
+    get_landmark_indices,
+    LandmarksBuffer,
     get_static_file_url,
     get_drawing_color,
 )
@@ -14,8 +18,20 @@ mp_drawing = mp.solutions.drawing_utils
 mp_pose = mp.solutions.pose
 
 
+# Landmarks used by the knee angle analysis, in this order
+KNEE_ANGLE_LANDMARKS = [
+    "RIGHT_HIP",
+    "RIGHT_KNEE",
+    "RIGHT_ANKLE",
+    "LEFT_HIP",
+    "LEFT_KNEE",
+    "LEFT_ANKLE",
+]
+
+
 def analyze_knee_angle(
-    mp_results,
+    knee_angle_landmarks,
+    knee_angles,
     stage: str,
     angle_thresholds: list,
     knee_over_toe: bool = False,
@@ -24,52 +40,27 @@ def analyze_knee_angle(
     """Calculate angle of each knee while performer at the DOWN position
 
     Args:
-        mp_results (): MediaPipe Pose results
+        knee_angle_landmarks (np.ndarray): KNEE_ANGLE_LANDMARKS of a frame, shape (6, 4)
+        knee_angles (np.ndarray): Right then left knee angles of the frame, measured by LungeModel.measure
         stage (str): stage of the exercise
         angle_thresholds (list): lower and upper limits for the knee angles
         knee_over_toe (bool): if knee_over_toe error occur, ignore knee angles. Default to False
         draw_to_image (tuple, optional): Contains an OpenCV frame and its dimension. Defaults to None.
 
     Returns:
-        dict: Statistic from analyze knee angles
+        dict: Statistic from analyze knee angles, the deviation is the largest distance of a knee angle outside of the thresholds
     """
     results = {
         "error": None,
+        "deviation": 0,
         "right": {"error": None, "angle": None},
         "left": {"error": None, "angle": None},
     }
 
-    landmarks = mp_results.pose_landmarks.landmark
-
-    # Calculate right knee angle
-    right_hip = [
-        landmarks[mp_pose.PoseLandmark.RIGHT_HIP.value].x,
-        landmarks[mp_pose.PoseLandmark.RIGHT_HIP.value].y,
-    ]
-    right_knee = [
-        landmarks[mp_pose.PoseLandmark.RIGHT_KNEE.value].x,
-        landmarks[mp_pose.PoseLandmark.RIGHT_KNEE.value].y,
-    ]
-    right_ankle = [
-        landmarks[mp_pose.PoseLandmark.RIGHT_ANKLE.value].x,
-        landmarks[mp_pose.PoseLandmark.RIGHT_ANKLE.value].y,
-    ]
-    results["right"]["angle"] = calculate_angle(right_hip, right_knee, right_ankle)
-
-    # Calculate left knee angle
-    left_hip = [
-        landmarks[mp_pose.PoseLandmark.LEFT_HIP.value].x,
-        landmarks[mp_pose.PoseLandmark.LEFT_HIP.value].y,
-    ]
-    left_knee = [
-        landmarks[mp_pose.PoseLandmark.LEFT_KNEE.value].x,
-        landmarks[mp_pose.PoseLandmark.LEFT_KNEE.value].y,
-    ]
-    left_ankle = [
-        landmarks[mp_pose.PoseLandmark.LEFT_ANKLE.value].x,
-        landmarks[mp_pose.PoseLandmark.LEFT_ANKLE.value].y,
-    ]
-    results["left"]["angle"] = calculate_angle(left_hip, left_knee, left_ankle)
+    right_knee = knee_angle_landmarks[1, :2].tolist()
+    left_knee = knee_angle_landmarks[4, :2].tolist()
+
+    results["right"]["angle"], results["left"]["angle"] = knee_angles.tolist()
 
     # Draw to image
     if draw_to_image is not None and stage != "down":
@@ -106,6 +97,10 @@ def analyze_knee_angle(
 
     # Evaluation
     results["error"] = False
+    results["deviation"] = max(
+        range_deviation(results["right"]["angle"], angle_thresholds),
+        range_deviation(results["left"]["angle"], angle_thresholds),
+    )
 
     if angle_thresholds[0] <= results["right"]["angle"] <= angle_thresholds[1]:
         results["right"]["error"] = False
@@ -174,23 +169,19 @@ def analyze_knee_angle(
     return results
 
 
-class LungeDetection:
+class LungeModel:
+    """
+    Machine learning models and landmarks of lunge detection, shared by every analysis
+    """
+
     STAGE_ML_MODEL_PATH = get_static_file_url("model/lunge_stage_model.pkl")
     ERR_ML_MODEL_PATH = get_static_file_url("model/lunge_err_model.pkl")
     INPUT_SCALER_PATH = get_static_file_url("model/lunge_input_scaler.pkl")
 
-    PREDICTION_PROB_THRESHOLD = 0.8
-    KNEE_ANGLE_THRESHOLD = [60, 125]
-
     def __init__(self) -> None:
         self.init_important_landmarks()
         self.load_machine_learning_model()
 
-        self.current_stage = ""
-        self.counter = 0
-        self.results = []
-        self.has_error = False
-
     def init_important_landmarks(self) -> None:
         """
         Determine Important landmarks for lunge detection
@@ -212,6 +203,12 @@ class LungeDetection:
             "RIGHT_FOOT_INDEX",
         ]
 
+        self.important_landmark_indices = get_landmark_indices(self.important_landmarks)
+        self.knee_angle_landmark_indices = get_landmark_indices(KNEE_ANGLE_LANDMARKS)
+
+        # Hip, knee and ankle of the right then the left leg, the angles are measured at the knees
+        self.knee_angle_triplets = self.knee_angle_landmark_indices.reshape(2, 3)
+
         # Generate all columns of the data frame
         self.headers = ["label"]  # Label column
 
@@ -235,96 +232,278 @@ class LungeDetection:
             raise Exception("Cannot found lunge files for prediction")
 
         try:
-            with open(self.ERR_ML_MODEL_PATH, "rb") as f:
-                self.err_model = pickle.load(f)
+            self.err_model = load_model_artifact(self.ERR_ML_MODEL_PATH)
 
-            with open(self.STAGE_ML_MODEL_PATH, "rb") as f:
-                self.stage_model = pickle.load(f)
+            self.stage_model = load_model_artifact(self.STAGE_ML_MODEL_PATH)
 
-            with open(self.INPUT_SCALER_PATH, "rb") as f2:
-                self.input_scaler = pickle.load(f2)
+            self.input_scaler = load_model_artifact(self.INPUT_SCALER_PATH)
         except Exception as e:
             raise Exception(f"Error loading model, {e}")
 
-    def handle_detected_results(self, video_name: str) -> tuple:
+    def scale(self, rows) -> np.ndarray:
+        """Scale the keypoints of a batch of frames for both models
+
+        Args:
+            rows (np.ndarray): Keypoints of the important landmarks, one row per frame
+
+        Returns:
+            np.ndarray: Input of predict_stages and predict_errors
         """
-        Save frame as evidence
+        return self.input_scaler.transform(
+            model_input(self.input_scaler, rows, self.headers[1:])
+        )
+
+    def predict_stages(self, X) -> list:
+        """Predict stages of a batch of frames with a single model call
+
+        Returns:
+            list: Predicted stage class and probabilities of all stages for each frame
         """
-        file_name, _ = video_name.split(".")
-        save_folder = get_static_file_url("images")
-        for index, error in enumerate(self.results):
-            try:
-                image_name = f"{file_name}_{index}.jpg"
-                cv2.imwrite(f"{save_folder}/{file_name}_{index}.jpg", error["frame"])
-                self.results[index]["frame"] = image_name
-            except Exception as e:
-                print("ERROR cannot save frame: " + str(e))
-                self.results[index]["frame"] = None
+        prediction_probabilities = self.stage_model.predict_proba(
+            model_input(self.stage_model, X)
+        )
+        predicted_classes = self.stage_model.classes_[
+            prediction_probabilities.argmax(axis=1)
+        ]
+
+        return list(zip(predicted_classes, prediction_probabilities))
+
+    def predict_errors(self, X) -> list:
+        """Predict knee over toe errors of a batch of frames with a single model call
+
+        Returns:
+            list: Predicted error class and probabilities of all classes for each frame
+        """
+        if not len(X):
+            return []
+
+        prediction_probabilities = self.err_model.predict_proba(
+            model_input(self.err_model, X)
+        )
+        predicted_classes = self.err_model.classes_[
+            prediction_probabilities.argmax(axis=1)
+        ]
+
+        return list(zip(predicted_classes, prediction_probabilities))
+
+    def measure(self, landmarks) -> np.ndarray:
+        """Measure the angles of both knees in a single call
+
+        Args:
+            landmarks (np.ndarray): Landmarks of frames, shape (33, 4) or (frames, 33, 4)
+
+        Returns:
+            np.ndarray: Right then left knee angles, shape (2,) or (frames, 2)
+        """
+        return joint_angles(landmarks[..., :2], self.knee_angle_triplets)
+
+
+class LungeDetection:
+    PREDICTION_PROB_THRESHOLD = 0.8
+    KNEE_ANGLE_THRESHOLD = [60, 125]
+
+    def __init__(self, ml_model: LungeModel) -> None:
+        self.ml_model = ml_model
+        self.landmarks_buffer = LandmarksBuffer()
+
+        self.current_stage = ""
+        self.counter = 0
+        self.evidence = EvidenceSelection()
+        # Error types detected in the current rep, whether they are kept as evidence or not
+        self.rep_errors = set()
+        self.has_error = False
+
+    @property
+    def results(self) -> list:
+        """Errors kept as evidence, in detection order"""
+        return self.evidence.results
 
+    def handle_detected_results(self) -> tuple:
+        """
+        Results of the analysis, evidence frames are saved as images by an EvidenceWriter
+        """
         return self.results, self.counter
 
-    def clear_results(self) -> None:
-        self.results = []
+    def clear_results(self, keep_stage: bool = False) -> None:
+        """Clear results and counter
+
+        Args:
+            keep_stage (bool, optional): Keep the current stage of the exercise, used when analysis resumes from a previous part of a video. Defaults to False.
+        """
+        self.evidence.clear()
+        self.rep_errors = set()
         self.counter = 0
-        self.current_stage = ""
         self.has_error = False
 
-    def detect(self, mp_results, image, timestamp) -> None:
+        if not keep_stage:
+            self.current_stage = ""
+
+    def get_state(self) -> dict:
+        """Current stage, counter and error state of the exercise, for live feedback"""
+        return {
+            "stage": self.current_stage,
+            "counter": self.counter,
+            "has_error": self.has_error,
+        }
+
+    def detect_batch(self, frames: list, landmarks=None) -> None:
+        """Lunge errors detection on consecutive frames, with a single model prediction for all of them
+
+        Args:
+            frames (list): List of (mp_results, image, timestamp) of consecutive frames. Image is None to skip drawing
+            landmarks (np.ndarray, optional): Landmarks of the frames, shape (frames, 33, 4). Defaults to None, converted from the MediaPipe results.
+        """
+        # Convert landmarks of all frames once, shared by the model and the pose analysis
+        if landmarks is None:
+            landmarks = self.landmarks_buffer.convert(
+                [mp_results.pose_landmarks for mp_results, _, _ in frames]
+            )
+        try:
+            predictions = self.predict_batch(
+                extract_important_keypoints(
+                    landmarks, self.ml_model.important_landmark_indices
+                )
+            )
+        except Exception as e:
+            # Each frame predicts its own stage and errors, failing frames are skipped
+            print(f"Error while predicting lunge batch: {e}")
+            predictions = [None] * len(frames)
+
+        knee_angles = self.ml_model.measure(landmarks)
+
+        for (
+            (mp_results, image, timestamp),
+            frame_landmarks,
+            prediction,
+            frame_knee_angles,
+        ) in zip(frames, landmarks, predictions, knee_angles):
+            self.detect(
+                mp_results,
+                image,
+                timestamp,
+                landmarks=frame_landmarks,
+                prediction=prediction,
+                knee_angles=frame_knee_angles,
+            )
+
+    def next_stage(self, stage: str, predicted_class: str, probability: float) -> str:
+        """Stage of the exercise after a frame, from the stage predicted for the frame
+
+        Args:
+            stage (str): Stage before the frame
+            predicted_class (str): Stage class predicted for the frame
+            probability (float): Probability of the predicted class, rounded to 2 decimals
+
+        Returns:
+            str: Stage after the frame
+        """
+        if probability < self.PREDICTION_PROB_THRESHOLD:
+            return stage
+
+        return {"I": "init", "M": "mid", "D": "down"}.get(predicted_class, stage)
+
+    def predict_batch(self, rows) -> list:
+        """Predict stages of consecutive frames, then errors of the frames at the down stage only
+
+        Args:
+            rows (np.ndarray): Keypoints of the important landmarks, one row per frame
+
+        Returns:
+            list: Predicted stage class, stage probabilities, error class and error probabilities for each frame. The error ones are None out of the down stage
+        """
+        X = self.ml_model.scale(rows)
+        stage_predictions = self.ml_model.predict_stages(X)
+
+        # Follow the stage from frame to frame, as detect() does
+        stage = self.current_stage
+        down_rows = []
+        for predicted_class, prediction_probabilities in stage_predictions:
+            stage = self.next_stage(
+                stage,
+                predicted_class,
+                round(prediction_probabilities[prediction_probabilities.argmax()], 2),
+            )
+            down_rows.append(stage == "down")
+
+        down_rows = np.array(down_rows, dtype=bool)
+        err_predictions = iter(self.ml_model.predict_errors(X[down_rows]))
+
+        return [
+            stage_prediction + (next(err_predictions) if down else (None, None))
+            for stage_prediction, down in zip(stage_predictions, down_rows)
+        ]
+
+    def detect(
+        self,
+        mp_results,
+        image,
+        timestamp,
+        landmarks=None,
+        prediction: tuple = None,
+        knee_angles=None,
+    ) -> None:
         """
         Make Lunge Errors detection
+
+        landmarks, prediction, knee_angles: landmarks array, model predictions and knee angles of this frame already computed by detect_batch
         """
         try:
-            video_dimensions = [image.shape[1], image.shape[0]]
+            if landmarks is None:
+                landmarks = self.landmarks_buffer.convert([mp_results.pose_landmarks])[
+                    0
+                ]
 
             # * Model prediction for LUNGE counter
-            # Extract keypoints from frame for the input
-            row = extract_important_keypoints(mp_results, self.important_landmarks)
-            X = pd.DataFrame([row], columns=self.headers[1:])
-            X = pd.DataFrame(self.input_scaler.transform(X))
+            if prediction is None:
+                # Extract keypoints from frame for the input
+                row = extract_important_keypoints(
+                    landmarks, self.ml_model.important_landmark_indices
+                )
+                X = self.ml_model.scale(row[np.newaxis])
+                prediction = self.ml_model.predict_stages(X)[0] + (None, None)
+            else:
+                X = None
 
             # Make prediction and its probability
-            stage_predicted_class = self.stage_model.predict(X)[0]
-            stage_prediction_probabilities = self.stage_model.predict_proba(X)[0]
+            (
+                stage_predicted_class,
+                stage_prediction_probabilities,
+                err_predicted_class,
+                err_prediction_probabilities,
+            ) = prediction
             stage_prediction_probability = round(
                 stage_prediction_probabilities[stage_prediction_probabilities.argmax()],
                 2,
             )
 
             # Evaluate stage prediction for counter
-            if (
-                stage_predicted_class == "I"
-                and stage_prediction_probability >= self.PREDICTION_PROB_THRESHOLD
-            ):
-                self.current_stage = "init"
-            elif (
-                stage_predicted_class == "M"
-                and stage_prediction_probability >= self.PREDICTION_PROB_THRESHOLD
-            ):
-                self.current_stage = "mid"
-            elif (
-                stage_predicted_class == "D"
-                and stage_prediction_probability >= self.PREDICTION_PROB_THRESHOLD
-            ):
-                if self.current_stage in ["init", "mid"]:
-                    self.counter += 1
-
-                self.current_stage = "down"
-
-            # Check out errors from a rep to reduce repeated warning
-            errors_from_this_rep = map(
-                lambda el: el["stage"],
-                filter(lambda el: el["counter"] == self.counter, self.results),
+            next_stage = self.next_stage(
+                self.current_stage, stage_predicted_class, stage_prediction_probability
             )
+            if next_stage == "down" and self.current_stage in ["init", "mid"]:
+                self.counter += 1
+                self.rep_errors = set()
+
+            self.current_stage = next_stage
+
+            # Errors are only predicted at the DOWN stage
+            if self.current_stage == "down" and err_prediction_probabilities is None:
+                if X is None:
+                    row = extract_important_keypoints(
+                        landmarks, self.ml_model.important_landmark_indices
+                    )
+                    X = self.ml_model.scale(row[np.newaxis])
+
+                (
+                    err_predicted_class,
+                    err_prediction_probabilities,
+                ) = self.ml_model.predict_errors(X)[0]
 
             # Analyze lunge pose
             # Knee over toe
             k_o_t_error = None
-            err_predicted_class = None
-            err_prediction_probabilities = None
             err_prediction_probability = None
             if self.current_stage == "down":
-                err_predicted_class = self.err_model.predict(X)[0]
-                err_prediction_probabilities = self.err_model.predict_proba(X)[0]
                 err_prediction_probability = round(
                     err_prediction_probabilities[err_prediction_probabilities.argmax()],
                     2,
@@ -338,17 +517,16 @@ class LungeDetection:
                     self.has_error = True
 
                     # Limit save error frames saved in a rep
-                    if (
-                        len(self.results) == 0
-                        or "knee over toe" not in errors_from_this_rep
-                    ):
-                        self.results.append(
+                    if "knee over toe" not in self.rep_errors:
+                        self.rep_errors.add("knee over toe")
+                        self.evidence.add(
                             {
                                 "stage": f"knee over toe",
                                 "frame": image,
                                 "timestamp": timestamp,
                                 "counter": self.counter,
-                            }
+                            },
+                            score=err_prediction_probability,
                         )
 
                 elif (
@@ -358,16 +536,28 @@ class LungeDetection:
                     k_o_t_error = "Correct"
                     self.has_error = False
             else:
+                # Errors are only evaluated at the DOWN stage
+                err_predicted_class = None
                 self.has_error = False
 
             # Analyze lunge pose
             # * Knee angle
+            if knee_angles is None:
+                knee_angles = self.ml_model.measure(landmarks)
+
             analyzed_results = analyze_knee_angle(
-                mp_results=mp_results,
+                knee_angle_landmarks=landmarks[
+                    self.ml_model.knee_angle_landmark_indices
+                ],
+                knee_angles=knee_angles,
                 stage=self.current_stage,
                 angle_thresholds=self.KNEE_ANGLE_THRESHOLD,
                 knee_over_toe=(k_o_t_error == "Incorrect"),
-                draw_to_image=(image, video_dimensions),
+                draw_to_image=(
+                    (image, [image.shape[1], image.shape[0]])
+                    if image is not None
+                    else None
+                ),
             )
 
             # Stage management for saving results
@@ -376,17 +566,22 @@ class LungeDetection:
             )
             if analyzed_results["error"]:
                 # Limit save error frames saved in a rep
-                if len(self.results) == 0 or "knee angle" not in errors_from_this_rep:
-                    self.results.append(
+                if "knee angle" not in self.rep_errors:
+                    self.rep_errors.add("knee angle")
+                    self.evidence.add(
                         {
                             "stage": f"knee angle",
                             "frame": image,
                             "timestamp": timestamp,
                             "counter": self.counter,
-                        }
+                        },
+                        score=analyzed_results["deviation"],
                     )
 
             # Visualization
+            if image is None:
+                return
+
             # Draw landmarks and connections
             landmark_color, connection_color = get_drawing_color(self.has_error)
             mp_drawing.draw_landmarks(
@@ -1,76 +1,285 @@
 import mediapipe as mp
 import cv2
+import numpy as np
+import os
+import shutil
+import subprocess
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, wait
 from django.conf import settings
 
-from .plank import PlankDetection
-from .bicep_curl import BicepCurlDetection
-from .squat import SquatDetection
-from .lunge import LungeDetection
-from .utils import rescale_frame
+from .plank import PlankModel, PlankDetection
+from .bicep_curl import BicepCurlModel, BicepCurlDetection
+from .squat import SquatModel, SquatDetection
+from .lunge import LungeModel, LungeDetection
+from .decoders import create_video_decoder
+from .encoders import OpenCVVideoEncoder, create_video_encoder
+from .evidence import EvidenceSelection, EvidenceWriter, remove_evidence_images
+from .hls import HlsVideoWriter, hls_output_enabled, hls_playlist_path, remux_hls_to_mp4
+from .pipeline import BatchStage, FramePipeline
+from .registry import ModelRegistry
+from .pose_graphs import get_pose_options, get_pose_pool
+from .resolution import get_policy_size, get_resolution_policy
+from .utils import LandmarksBuffer
+from .pose_cache import (
+    PoseCache,
+    pose_cache_key,
+    record_pose_results,
+    replay_pose_results,
+)
 
 # Drawing helpers
 mp_drawing = mp.solutions.drawing_utils
 mp_pose = mp.solutions.pose
 
-EXERCISE_DETECTIONS = None
+# Models are loaded once per process and shared, each analysis gets its own detection state
+EXERCISE_MODEL_CLASSES = {
+    "plank": PlankModel,
+    "bicep_curl": BicepCurlModel,
+    "squat": SquatModel,
+    "lunge": LungeModel,
+}
+EXERCISE_DETECTION_CLASSES = {
+    "plank": PlankDetection,
+    "bicep_curl": BicepCurlDetection,
+    "squat": SquatDetection,
+    "lunge": LungeDetection,
+}
+MODEL_REGISTRY = ModelRegistry(EXERCISE_MODEL_CLASSES)
 
+# Max number of frames waiting between 2 stages of the processing pipeline
+PIPELINE_QUEUE_SIZE = 8
 
-def load_machine_learning_models():
-    """Load all machine learning models"""
-    global EXERCISE_DETECTIONS
+# Number of analyzed frames between 2 progress reports
+PROGRESS_INTERVAL = 30
 
-    if EXERCISE_DETECTIONS is not None:
+
+def load_machine_learning_models(exercise_types: list = None) -> None:
+    """Load the machine learning models of exercises ahead of their first analysis
+
+    Args:
+        exercise_types (list, optional): exercise types. Defaults to None, all exercises.
+    """
+    MODEL_REGISTRY.warm_up(exercise_types)
+
+
+def create_exercise_detection(exercise_type: str):
+    """Create a new detection of an exercise, sharing the loaded machine learning model
+
+    Args:
+        exercise_type (str): exercise type
+
+    Returns:
+        Detection of the exercise, None if the exercise is not supported
+    """
+    detection_class = EXERCISE_DETECTION_CLASSES.get(exercise_type)
+    if not detection_class:
+        return None
+
+    return detection_class(MODEL_REGISTRY.get(exercise_type))
+
+
+def get_exercise_resolution_policy(
+    exercise_type: str = None, pose_options: dict = None
+) -> dict:
+    """Resolution policy of an exercise analyzed with MediaPipe Pose options, those of its profile by default"""
+    pose_options = pose_options or get_pose_options(exercise_type)
+    return get_resolution_policy(exercise_type, pose_options.get("model_complexity", 1))
+
+
+def get_processing_size(
+    decoder,
+    exercise_type: str = None,
+    rescale_percent: float = None,
+    pose_options: dict = None,
+) -> tuple:
+    """Size the frames of a video are analyzed at
+
+    Args:
+        decoder (VideoDecoder): Decoder of the video
+        exercise_type (str, optional): exercise type, whose resolution policy sizes the frames. Defaults to None, the default policy.
+        rescale_percent (float, optional): Percentage to scale back from the original video size instead of the resolution policy. Defaults to None.
+        pose_options (dict, optional): Options of MediaPipe Pose, whose model complexity selects the resolution policy. Defaults to None, those of the profile of the exercise.
+
+    Returns:
+        tuple: Width and height of the frames
+    """
+    if rescale_percent:
+        return (
+            int(decoder.width * rescale_percent / 100),
+            int(decoder.height * rescale_percent / 100),
+        )
+
+    return get_policy_size(
+        decoder.width,
+        decoder.height,
+        get_exercise_resolution_policy(exercise_type, pose_options),
+    )
+
+
+def read_video_frames(
+    decoder, size: tuple, start_frame: int = 0, end_frame: int = None
+):
+    """Decode frames of a video as RGB frames of the processing size for MediaPipe
+
+    Args:
+        decoder (VideoDecoder): Decoder of the video
+        size (tuple): Width and height of the frames
+        start_frame (int, optional): Index of the first frame to read. Defaults to 0.
+        end_frame (int, optional): Stop before this frame index. Defaults to None, read until the end of the video.
+
+    Yields:
+        tuple: frame count (1-based position in the video), timestamp of the frame (in second) and the RGB frame
+    """
+    fps = int(decoder.fps)
+    frame_count = start_frame
+
+    for image in decoder.read_frames(size, start_frame, end_frame):
+        # Calculate timestamp
+        frame_count += 1
+        timestamp = int(frame_count / fps)
+
+        image.flags.writeable = False
+
+        yield frame_count, timestamp, image
+
+
+def split_frame_ranges(total_frames: int, workers: int, min_chunk_frames: int) -> list:
+    """Split the frames of a video into contiguous ranges, one for each worker
+
+    Args:
+        total_frames (int): Number of frames of the video
+        workers (int): Max number of ranges
+        min_chunk_frames (int): Min number of frames in a range
+
+    Returns:
+        list: List of (start_frame, end_frame) ranges, the last range ends with None
+    """
+    chunks = max(1, min(workers, total_frames // max(min_chunk_frames, 1)))
+    bounds = [round(index * total_frames / chunks) for index in range(chunks)]
+    bounds.append(None)
+
+    return [(bounds[index], bounds[index + 1]) for index in range(chunks)]
+
+
+def merge_counters(counters: list):
+    """Merge counters from consecutive parts of a video
+
+    Numbers are summed, dictionaries are merged by key and any other value is taken from the last part.
+    """
+    first = counters[0]
+
+    if isinstance(first, dict):
+        return {key: merge_counters([c[key] for c in counters]) for key in first}
+    elif isinstance(first, (int, float)) and not isinstance(first, bool):
+        return sum(counters)
+
+    return counters[-1]
+
+
+def merge_results(results_list: list) -> list:
+    """Merge errors from consecutive parts of a video into a single evidence selection
+
+    Images of the errors dropped by the selection are removed.
+    """
+    selection = EvidenceSelection()
+    dropped = []
+
+    for results in results_list:
+        for error in results:
+            dropped += selection.add(error, error["score"])
+
+    remove_evidence_images(dropped)
+    return selection.results
+
+
+def concatenate_videos(video_paths: list, saved_path: str, fps: int, size: tuple):
+    """Join video files which have the same format into a single video
+
+    Use ffmpeg to copy streams without re-encoding, fall back on OpenCV if ffmpeg is not installed.
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg:
+        list_path = f"{saved_path}.txt"
+        with open(list_path, "w") as f:
+            f.writelines(f"file '{path}'\n" for path in video_paths)
+
+        try:
+            subprocess.run(
+                [
+                    ffmpeg,
+                    "-y",
+                    "-loglevel",
+                    "error",
+                    "-f",
+                    "concat",
+                    "-safe",
+                    "0",
+                    "-i",
+                    list_path,
+                    "-c",
+                    "copy",
+                    "-movflags",
+                    "+faststart",
+                    saved_path,
+                ],
+                check=True,
+            )
+        finally:
+            os.remove(list_path)
         return
 
-    print("Loading ML models ...")
-    EXERCISE_DETECTIONS = {
-        "plank": PlankDetection(),
-        "bicep_curl": BicepCurlDetection(),
-        "squat": SquatDetection(),
-        "lunge": LungeDetection(),
-    }
+    out = OpenCVVideoEncoder(saved_path, fps, size)
+    try:
+        for path in video_paths:
+            cap = cv2.VideoCapture(path)
+            while cap.isOpened():
+                ret, image = cap.read()
+                if not ret:
+                    break
+                out.write(image)
+            cap.release()
+    finally:
+        out.release()
 
 
 def pose_detection(
-    video_file_path: str, video_name_to_save: str, rescale_percent: float = 40
+    video_file_path: str,
+    video_name_to_save: str,
+    rescale_percent: float = None,
+    pose_profile: str = None,
 ):
     """Pose detection with MediaPipe Pose
 
     Args:
         video_file_path (str): path to video
         video_name_to_save (str): path to save analyzed video
-        rescale_percent (float, optional): Percentage to scale back from the original video size. Defaults to 40.
+        rescale_percent (float, optional): Percentage to scale back from the original video size. Defaults to None, sized by the default resolution policy.
+        pose_profile (str, optional): Profile of MediaPipe Pose, see POSE_PROFILES. Defaults to None, POSE_DEFAULT_PROFILE.
 
     """
-    cap = cv2.VideoCapture(video_file_path)
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH) * rescale_percent / 100)
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) * rescale_percent / 100)
-    size = (width, height)
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
+    decoder = create_video_decoder(video_file_path)
+    pose_options = get_pose_options(profile=pose_profile)
+    size = get_processing_size(
+        decoder, rescale_percent=rescale_percent, pose_options=pose_options
+    )
+    fps = int(decoder.fps)
 
-    fourcc = cv2.VideoWriter_fourcc(*"avc1")
     save_to_path = f"{settings.MEDIA_ROOT}/{video_name_to_save}"
-    out = cv2.VideoWriter(save_to_path, fourcc, fps, size)
+    out = create_video_encoder(save_to_path, fps, size)
 
     print("PROCESSING VIDEO ...")
-    with mp_pose.Pose(
-        min_detection_confidence=0.8, min_tracking_confidence=0.8
-    ) as pose:
-        while cap.isOpened():
-            ret, image = cap.read()
-
-            if not ret:
-                break
+    with get_pose_pool().checkout(pose_options) as pose:
 
-            image = rescale_frame(image, rescale_percent)
+        def estimate_pose(frame):
+            _, _, image = frame
+            return image, pose.process(image)
 
-            # Recolor image from BGR to RGB for mediapipe
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            image.flags.writeable = False
+        def draw_pose(frame):
+            image, results = frame
 
-            results = pose.process(image)
-
-            # Recolor image from BGR to RGB for mediapipe
+            # Recolor image from RGB to BGR for OpenCV
             image.flags.writeable = True
             image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
 
@@ -85,85 +294,599 @@ def pose_detection(
                     color=(245, 66, 230), thickness=2, circle_radius=1
                 ),
             )
-
-            out.write(image)
+            return image
+
+        try:
+            FramePipeline(
+                source=read_video_frames(decoder, size),
+                stages=[
+                    ("pose", estimate_pose),
+                    ("draw", draw_pose),
+                    ("encode", out.write),
+                ],
+                queue_size=PIPELINE_QUEUE_SIZE,
+            ).run()
+        finally:
+            out.release()
 
     print(f"PROCESSED, save to {save_to_path}.")
     return
 
 
+def detect_video_frames(
+    exercise_detection,
+    video_file_path: str,
+    saved_path: str,
+    size: tuple,
+    start_frame: int = 0,
+    end_frame: int = None,
+    warmup_frames: int = 0,
+    pose_records_path: str = None,
+    replay_pose: bool = False,
+    on_frames_done=None,
+    render: bool = True,
+    evidence_writer: EvidenceWriter = None,
+    playlist_path: str = None,
+    pose_options: dict = None,
+    encoder_options: dict = None,
+) -> int:
+    """Run error detection on a range of frames of a video and save the analyzed frames
+
+    Decoding, pose estimation, error detection and encoding run on their own threads so
+    OpenCV I/O overlaps with MediaPipe inference.
+
+    Args:
+        exercise_detection (): Detection of the exercise
+        video_file_path (str): path to video
+        saved_path (str): path to save analyzed frames, unused if render is False
+        size (tuple): Width and height the frames are analyzed at
+        start_frame (int, optional): Index of the first frame to analyze. Defaults to 0.
+        end_frame (int, optional): Stop before this frame index. Defaults to None, analyze until the end of the video.
+        warmup_frames (int, optional): Number of frames before start_frame analyzed to restore the exercise stage, their results are dropped. Defaults to 0.
+        pose_records_path (str, optional): Pose records file of the video, filled with the landmarks of the analyzed frames. Defaults to None.
+        replay_pose (bool, optional): Read the landmarks from the pose records instead of running MediaPipe Pose. Defaults to False.
+        on_frames_done (callable, optional): Called with the number of analyzed frames every PROGRESS_INTERVAL frames and at the end. Defaults to None.
+        render (bool, optional): Draw the analysis on the frames and encode them. Defaults to True, if False only the results are computed.
+        evidence_writer (EvidenceWriter, optional): Saves the evidence frames of the results once their overlay is drawn. Defaults to None.
+        playlist_path (str, optional): Write the analyzed frames as an HLS playlist and segments instead of saved_path. Defaults to None.
+        pose_options (dict, optional): Options of MediaPipe Pose. Defaults to None, those of POSE_DEFAULT_PROFILE.
+        encoder_options (dict, optional): Overrides of VIDEO_ENCODER for saved_path. Defaults to None.
+
+    Returns:
+        int: Number of the last frame read
+    """
+    pose_records = None
+    if pose_records_path:
+        pose_records = np.load(
+            pose_records_path, mmap_mode="r" if replay_pose else "r+"
+        )
+    last_frame = 0
+
+    decoder = create_video_decoder(video_file_path)
+
+    out = None
+    if render:
+        fps = int(decoder.fps)
+
+        if playlist_path:
+            out = HlsVideoWriter(playlist_path, fps, size, settings.HLS_SEGMENT_SECONDS)
+        else:
+            out = create_video_encoder(saved_path, fps, size, encoder_options)
+
+    frames_done = 0
+
+    pose_graph = (
+        nullcontext()
+        if replay_pose
+        else get_pose_pool().checkout(pose_options or get_pose_options())
+    )
+
+    with pose_graph as pose:
+
+        def estimate_pose(frame):
+            nonlocal last_frame
+            frame_count, timestamp, image = frame
+            last_frame = frame_count
+
+            if replay_pose:
+                return (
+                    frame_count,
+                    timestamp,
+                    image,
+                    replay_pose_results(pose_records, frame_count),
+                )
+
+            return frame_count, timestamp, image, pose.process(image)
+
+        landmarks_buffer = LandmarksBuffer(settings.EXERCISE_DETECTION_BATCH_SIZE)
+
+        # Error detection is stateful, it must run on a single thread in frame order.
+        # Frames are detected in batches to make a single model prediction for all of them.
+        def detect_errors(frames: list) -> list:
+            nonlocal frames_done
+            images = []
+            warmup_frames_to_detect = []
+            warmup_indices = []
+            frames_to_detect = []
+            indices_to_detect = []
+
+            # Landmarks are converted once, shared by the pose records and the detection
+            batch_landmarks = landmarks_buffer.convert(
+                [
+                    results.pose_landmarks
+                    for _, _, _, results in frames
+                    if results.pose_landmarks
+                ]
+            )
+            pose_index = 0
+
+            for frame_count, timestamp, image, results in frames:
+                if render:
+                    # Recolor image from RGB to BGR for OpenCV
+                    image.flags.writeable = True
+                    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+                    if frame_count > start_frame:
+                        images.append(image)
+                else:
+                    # Nothing is drawn
+                    image = None
+
+                landmarks = None
+                if results.pose_landmarks:
+                    landmarks = batch_landmarks[pose_index]
+                    pose_index += 1
+
+                # Warm-up frames belong to the previous part of the video, recorded by its own analysis
+                if (
+                    pose_records is not None
+                    and not replay_pose
+                    and frame_count > start_frame
+                ):
+                    record_pose_results(pose_records, frame_count, timestamp, landmarks)
+
+                if landmarks is None:
+                    continue
+
+                if frame_count > start_frame:
+                    frames_to_detect.append((results, image, timestamp))
+                    indices_to_detect.append(pose_index - 1)
+                else:
+                    warmup_frames_to_detect.append((results, image, timestamp))
+                    warmup_indices.append(pose_index - 1)
+
+            if warmup_frames_to_detect:
+                exercise_detection.detect_batch(
+                    warmup_frames_to_detect, landmarks=batch_landmarks[warmup_indices]
+                )
+
+            # Results of warm-up frames belong to the previous part of the video
+            if start_frame and frames[0][0] <= start_frame + 1 <= frames[-1][0]:
+                exercise_detection.clear_results(keep_stage=True)
+
+            if frames_to_detect:
+                exercise_detection.detect_batch(
+                    frames_to_detect, landmarks=batch_landmarks[indices_to_detect]
+                )
+
+            # Overlays of the batch are drawn, hand the new evidence frames to the encoder
+            if evidence_writer:
+                evidence_writer.update(exercise_detection.results)
+
+            previous_frames_done = frames_done
+            frames_done += sum(1 for frame in frames if frame[0] > start_frame)
+            if (
+                on_frames_done
+                and frames_done // PROGRESS_INTERVAL
+                != previous_frames_done // PROGRESS_INTERVAL
+            ):
+                on_frames_done(frames_done)
+
+            return images
+
+        stages = [
+            ("pose", estimate_pose),
+            (
+                "detect",
+                BatchStage(
+                    detect_errors,
+                    batch_size=settings.EXERCISE_DETECTION_BATCH_SIZE,
+                ),
+            ),
+        ]
+        if render:
+            stages.append(("encode", out.write))
+
+        try:
+            FramePipeline(
+                source=read_video_frames(
+                    decoder,
+                    size,
+                    start_frame=max(0, start_frame - warmup_frames),
+                    end_frame=end_frame,
+                ),
+                stages=stages,
+                queue_size=PIPELINE_QUEUE_SIZE,
+            ).run()
+        finally:
+            if out is not None:
+                out.release()
+
+            if on_frames_done:
+                on_frames_done(frames_done)
+
+            if pose_records is not None and not replay_pose:
+                pose_records.flush()
+
+    return last_frame
+
+
+def detect_video_chunk(
+    video_file_path: str,
+    video_name_to_save: str,
+    exercise_type: str,
+    size: tuple,
+    start_frame: int,
+    end_frame: int,
+    warmup_frames: int,
+    pose_records_path: str,
+    replay_pose: bool,
+    progress_counts=None,
+    chunk_index: int = 0,
+    render: bool = True,
+    evidence_max_memory: int = None,
+    pose_options: dict = None,
+    encoder_options: dict = None,
+) -> tuple:
+    """Analyze a part of a video in a worker process with its own detection
+
+    The number of analyzed frames of the part is reported to progress_counts[chunk_index],
+    a list shared with the main process.
+
+    Returns:
+        tuple: Results of the part, with evidence frames saved as images, and its counters. Then the number of the last frame read
+    """
+    # Loaded once by each worker process, then shared by its next chunks
+    exercise_detection = EXERCISE_DETECTION_CLASSES[exercise_type](
+        MODEL_REGISTRY.get(exercise_type)
+    )
+
+    def report_frames_done(frames_done: int):
+        progress_counts[chunk_index] = frames_done
+
+    evidence_writer = (
+        EvidenceWriter(
+            video_name_to_save,
+            max_memory=evidence_max_memory or settings.EVIDENCE_MAX_MEMORY,
+        )
+        if render
+        else None
+    )
+
+    try:
+        last_frame = detect_video_frames(
+            exercise_detection,
+            video_file_path=video_file_path,
+            saved_path=f"{settings.MEDIA_ROOT}/{video_name_to_save}",
+            size=size,
+            start_frame=start_frame,
+            end_frame=end_frame,
+            warmup_frames=warmup_frames,
+            pose_records_path=pose_records_path,
+            replay_pose=replay_pose,
+            on_frames_done=report_frames_done if progress_counts is not None else None,
+            render=render,
+            evidence_writer=evidence_writer,
+            pose_options=pose_options,
+            encoder_options=encoder_options,
+        )
+    finally:
+        if evidence_writer:
+            evidence_writer.close()
+
+    return exercise_detection.handle_detected_results(), last_frame
+
+
+def detect_video(
+    exercise_detection,
+    video_file_path: str,
+    video_name_to_save: str,
+    exercise_type: str,
+    size: tuple,
+    pose_records_path: str = None,
+    replay_pose: bool = False,
+    progress=None,
+    render: bool = True,
+    playlist_path: str = None,
+    pose_options: dict = None,
+) -> tuple:
+    """Analyze a video, split into parts analyzed in parallel by worker processes if it is long
+
+    With an HLS playlist, the video is analyzed in a single process so its segments are written
+    in order while analyzing, they are then copied into the saved MP4 video.
+
+    Returns:
+        tuple: Processed results of the video, then the number of the last frame read
+    """
+    decoder = create_video_decoder(video_file_path)
+    fps = int(decoder.fps)
+    total_frames = decoder.frame_count
+
+    saved_path = f"{settings.MEDIA_ROOT}/{video_name_to_save}"
+    chunks = split_frame_ranges(
+        total_frames,
+        workers=1 if playlist_path else settings.EXERCISE_DETECTION_WORKERS,
+        min_chunk_frames=settings.EXERCISE_DETECTION_MIN_CHUNK_SECONDS * fps,
+    )
+
+    def report_frames_done(frames_done: int):
+        progress("analyzing", frames_done, total_frames)
+
+    print("PROCESSING VIDEO ...")
+    if len(chunks) == 1:
+        evidence_writer = (
+            EvidenceWriter(video_name_to_save, max_memory=settings.EVIDENCE_MAX_MEMORY)
+            if render
+            else None
+        )
+
+        try:
+            last_frame = detect_video_frames(
+                exercise_detection,
+                video_file_path=video_file_path,
+                saved_path=saved_path,
+                size=size,
+                pose_records_path=pose_records_path,
+                replay_pose=replay_pose,
+                on_frames_done=report_frames_done if progress else None,
+                render=render,
+                evidence_writer=evidence_writer,
+                playlist_path=playlist_path,
+                pose_options=pose_options,
+            )
+
+            if progress:
+                progress("saving", total_frames, total_frames)
+
+            if playlist_path:
+                remux_hls_to_mp4(playlist_path, saved_path)
+        finally:
+            # Wait for the evidence frames still being encoded
+            if evidence_writer:
+                evidence_writer.close()
+
+        processed_results = exercise_detection.handle_detected_results()
+        print(f"PROCESSED. Save path: {saved_path}")
+        return processed_results, last_frame
+
+    # Analyze each part of the video in its own process
+    file_name, extension = video_name_to_save.split(".")
+    chunk_names = [
+        f"{file_name}_part{index}.{extension}" for index in range(len(chunks))
+    ]
+    warmup_frames = settings.EXERCISE_DETECTION_CHUNK_WARMUP_SECONDS * fps
+    # The encoders of the parts of the VIDEO_JOB_WORKERS videos share the CPUs
+    encoder_options = {
+        "threads": max(
+            (os.cpu_count() or 1) // (settings.VIDEO_JOB_WORKERS * len(chunks)), 1
+        )
+    }
+
+    mp_context = multiprocessing.get_context("spawn")
+    manager = mp_context.Manager() if progress else None
+    progress_counts = manager.list([0] * len(chunks)) if manager else None
+
+    with ProcessPoolExecutor(
+        max_workers=len(chunks), mp_context=mp_context
+    ) as executor:
+        futures = [
+            executor.submit(
+                detect_video_chunk,
+                video_file_path,
+                chunk_name,
+                exercise_type,
+                size,
+                start_frame,
+                end_frame,
+                warmup_frames,
+                pose_records_path,
+                replay_pose,
+                progress_counts,
+                chunk_index,
+                render,
+                settings.EVIDENCE_MAX_MEMORY // len(chunks),
+                pose_options,
+                encoder_options,
+            )
+            for chunk_index, (chunk_name, (start_frame, end_frame)) in enumerate(
+                zip(chunk_names, chunks)
+            )
+        ]
+
+        # Report the progress of all parts until they are done
+        try:
+            while progress:
+                _, not_done = wait(futures, timeout=1)
+                progress("analyzing", sum(progress_counts), total_frames)
+                if not not_done:
+                    break
+        finally:
+            if manager:
+                manager.shutdown()
+
+        chunk_results = [future.result()[0] for future in futures]
+        last_frame = futures[-1].result()[1]
+
+    if render:
+        if progress:
+            progress("merging", total_frames, total_frames)
+
+        chunk_paths = [f"{settings.MEDIA_ROOT}/{name}" for name in chunk_names]
+        try:
+            concatenate_videos(chunk_paths, saved_path, fps, size)
+        finally:
+            for path in chunk_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    print(f"PROCESSED {len(chunks)} parts. Save path: {saved_path}")
+
+    results = merge_results([chunk_result[0] for chunk_result in chunk_results])
+    other_data = [
+        merge_counters([chunk_result[index] for chunk_result in chunk_results])
+        for index in range(1, len(chunk_results[0]))
+    ]
+    return (results, *other_data), last_frame
+
+
 def exercise_detection(
     video_file_path: str,
     video_name_to_save: str,
     exercise_type: str,
-    rescale_percent: float = 40,
+    rescale_percent: float = None,
+    progress=None,
+    render: bool = True,
+    pose_profile: str = None,
 ) -> dict:
     """Analyzed Exercise Video
 
+    Long videos are split into parts analyzed in parallel by worker processes, the results
+    and the analyzed parts are then merged back together.
+
+    Landmarks of every frame are cached by video content and pose settings, so analyzing the
+    same video again replays them instead of running MediaPipe Pose.
+
+    Without rendering, nothing is drawn and no video or evidence image is saved. If the
+    landmarks are cached, the video is not even decoded.
+
+    If VIDEO_OUTPUT_FORMAT is "hls", the analyzed frames are also written as an HLS playlist
+    (see hls_playlist_path) which can be played while the video is still being analyzed.
+
     Args:
         video_file_path (str): path to video
         video_name_to_save (str): path to save analyzed video
         exercise_type (str): exercise type
-        rescale_percent (float, optional): Percentage to scale back from the original video size. Defaults to 40.
+        rescale_percent (float, optional): Percentage to scale back from the original video size. Defaults to None, sized by the resolution policy of the exercise.
+        progress (callable, optional): Called with the current stage, the number of analyzed frames and the total number of frames. Defaults to None.
+        render (bool, optional): Save the analyzed video and the evidence frames. Defaults to True.
+        pose_profile (str, optional): Profile of MediaPipe Pose, see POSE_PROFILES. Defaults to None, the profile of the exercise.
 
     Raises:
         Exception: Not supported exercise type
+        UnknownPoseProfile: The profile does not exist
 
     Returns:
         dict: Dictionary of analyzed stats from the video
     """
-    exercise_detection = EXERCISE_DETECTIONS.get(exercise_type)
+    exercise_detection = create_exercise_detection(exercise_type)
     if not exercise_detection:
         raise Exception("Not supported exercise.")
 
-    cap = cv2.VideoCapture(video_file_path)
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH) * rescale_percent / 100)
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) * rescale_percent / 100)
-    size = (width, height)
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
-    frame_count = 0
+    pose_cache = PoseCache(settings.POSE_CACHE_DIR, settings.POSE_CACHE_MAX_SIZE)
+    pose_records_path = None
+    pose_records = None
+
+    if progress:
+        progress("preparing", 0, 0)
+
+    pose_options = get_pose_options(exercise_type, pose_profile)
+    decoder = create_video_decoder(video_file_path)
+    size = get_processing_size(decoder, exercise_type, rescale_percent, pose_options)
+
+    if pose_cache.enabled:
+        cache_key = pose_cache_key(video_file_path, size, pose_options)
+        pose_records = pose_cache.lookup(cache_key)
+
+        if pose_records is not None:
+            pose_records_path = pose_cache.get_path(cache_key)
+        else:
+            total_frames = decoder.frame_count
+            if total_frames > 0:
+                pose_records_path = pose_cache.create(cache_key, total_frames)
+
+    replay_pose = pose_records is not None
+    if replay_pose:
+        print("Replaying cached pose landmarks ...")
+
+    # Nothing to draw, analyze the cached landmarks without decoding the video
+    if replay_pose and not render:
+        detect_landmarks(
+            exercise_detection, pose_records["timestamp"], pose_records["landmarks"]
+        )
+
+        return exercise_detection.handle_detected_results()
+
+    try:
+        processed_results, last_frame = detect_video(
+            exercise_detection,
+            video_file_path=video_file_path,
+            video_name_to_save=video_name_to_save,
+            exercise_type=exercise_type,
+            size=size,
+            pose_records_path=pose_records_path,
+            replay_pose=replay_pose,
+            progress=progress,
+            render=render,
+            pose_options=pose_options,
+            playlist_path=(
+                hls_playlist_path(video_name_to_save)
+                if render and hls_output_enabled()
+                else None
+            ),
+        )
+    except BaseException:
+        if pose_records_path and not replay_pose:
+            pose_cache.discard(pose_records_path)
+        raise
+
+    if pose_records_path and not replay_pose:
+        pose_cache.publish(cache_key, pose_records_path, frames_read=last_frame)
 
-    fourcc = cv2.VideoWriter_fourcc(*"avc1")
-    saved_path = f"{settings.MEDIA_ROOT}/{video_name_to_save}"
-    out = cv2.VideoWriter(saved_path, fourcc, fps, size)
+    return processed_results
 
-    print("PROCESSING VIDEO ...")
-    with mp_pose.Pose(
-        min_detection_confidence=0.8, min_tracking_confidence=0.8
-    ) as pose:
-        while cap.isOpened():
-            ret, image = cap.read()
 
-            if not ret:
-                break
+def detect_landmarks(exercise_detection, timestamps, landmarks) -> None:
+    """Run error detection on pose landmarks of consecutive frames, without drawing
 
-            # Calculate timestamp
-            frame_count += 1
-            timestamp = int(frame_count / fps)
+    Args:
+        exercise_detection (): Detection of the exercise
+        timestamps (np.ndarray): Timestamp of each frame (in second), shape (frames,)
+        landmarks (np.ndarray): x, y, z and visibility of the MediaPipe Pose landmarks of each frame, NaN if no pose is detected, shape (frames, 33, 4)
+    """
+    has_pose = ~np.isnan(landmarks).any(axis=(1, 2))
+    landmarks = landmarks[has_pose].astype(np.float32)
+    timestamps = timestamps[has_pose].astype(int)
 
-            image = rescale_frame(image, rescale_percent)
+    batch_size = settings.EXERCISE_DETECTION_BATCH_SIZE
+    for start in range(0, len(landmarks), batch_size):
+        exercise_detection.detect_batch(
+            [
+                (None, None, timestamp)
+                for timestamp in timestamps[start : start + batch_size].tolist()
+            ],
+            landmarks=landmarks[start : start + batch_size],
+        )
 
-            # Recolor image from BGR to RGB for mediapipe
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            image.flags.writeable = False
 
-            results = pose.process(image)
+def landmarks_detection(exercise_type: str, timestamps, landmarks) -> tuple:
+    """Analyze pose landmarks estimated by the client, without any video
 
-            # Recolor image from BGR to RGB for mediapipe
-            image.flags.writeable = True
-            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    Only the models and the rules of the exercise run, no frame is drawn or saved.
 
-            if results.pose_landmarks:
-                exercise_detection.detect(
-                    mp_results=results, image=image, timestamp=timestamp
-                )
+    Args:
+        exercise_type (str): exercise type
+        timestamps (np.ndarray): Timestamp of each frame (in second), shape (frames,)
+        landmarks (np.ndarray): x, y, z and visibility of the MediaPipe Pose landmarks of each frame, NaN if no pose is detected, shape (frames, 33, 4)
 
-            out.write(image)
+    Raises:
+        Exception: Not supported exercise type
 
-    print(f"PROCESSED. Save path: {saved_path}")
+    Returns:
+        tuple: Same results as exercise_detection, without evidence frames
+    """
+    exercise_detection = create_exercise_detection(exercise_type)
+    if not exercise_detection:
+        raise Exception("Not supported exercise.")
 
-    processed_results = exercise_detection.handle_detected_results(
-        video_name=video_name_to_save
-    )
-    exercise_detection.clear_results()
-    return processed_results
+    detect_landmarks(exercise_detection, timestamps, landmarks)
+    return exercise_detection.handle_detected_results()
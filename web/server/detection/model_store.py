@@ -0,0 +1,148 @@
+import os
+import re
+import pickle
+import shutil
+import tempfile
+from django.conf import settings
+
+from .inference import (
+    BUNDLE_VERSION,
+    UnsupportedModel,
+    load_inference_bundle,
+    save_inference_bundle,
+)
+from .onnx_models import load_keras_model
+
+
+def get_model_store_path(model_path: str) -> str:
+    """Path of the memory-mappable version of a pickled model in MODEL_STORE_DIR"""
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(settings.MODEL_STORE_DIR, f"{name}.joblib")
+
+
+def export_model_artifact(model_path: str) -> str:
+    """Convert a pickled model to an uncompressed joblib file, whose arrays can be memory-mapped
+
+    The file is written aside then moved in place, processes exporting the same model at the
+    same time do not read a partial file.
+
+    Returns:
+        str: Path of the converted model
+    """
+    import joblib
+
+    with open(model_path, "rb") as f:
+        model = pickle.load(f)
+
+    store_path = get_model_store_path(model_path)
+    os.makedirs(settings.MODEL_STORE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=settings.MODEL_STORE_DIR, suffix=".tmp")
+    os.close(fd)
+
+    try:
+        joblib.dump(model, temp_path)
+        os.replace(temp_path, store_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    return store_path
+
+
+def get_inference_bundle_path(model_path: str) -> str:
+    """Path of the array bundle of a pickled model in MODEL_STORE_DIR, specific to this version of the pickle"""
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(
+        settings.MODEL_STORE_DIR,
+        f"{name}-{os.stat(model_path).st_mtime_ns}.v{BUNDLE_VERSION}.bundle",
+    )
+
+
+def export_inference_bundle(model_path: str) -> str:
+    """Export a pickled scikit-learn model to an array bundle, the only step needing scikit-learn
+
+    Raises:
+        UnsupportedModel: The model has no NumPy evaluator
+
+    Returns:
+        str: Path of the bundle
+    """
+    with open(model_path, "rb") as f:
+        model = pickle.load(f)
+
+    bundle_path = get_inference_bundle_path(model_path)
+    save_inference_bundle(bundle_path, model)
+    remove_stale_inference_bundles(model_path)
+
+    return bundle_path
+
+
+def remove_stale_inference_bundles(model_path: str) -> None:
+    """Remove the bundles of the previous versions of a pickled model, and those of older bundle layouts
+
+    Processes still using a removed bundle keep their memory-mapped arrays until they load it again.
+    """
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    bundle_re = re.compile(rf"{re.escape(name)}-\d+\.v\d+\.bundle")
+    current_bundle = os.path.basename(get_inference_bundle_path(model_path))
+
+    for file_name in os.listdir(settings.MODEL_STORE_DIR):
+        if file_name != current_bundle and bundle_re.fullmatch(file_name):
+            shutil.rmtree(
+                os.path.join(settings.MODEL_STORE_DIR, file_name), ignore_errors=True
+            )
+
+
+def load_model_artifact(model_path: str):
+    """Load a pickled model, with its arrays memory-mapped from the model store (see MODEL_MMAP_MODE)
+
+    The pages of a memory-mapped array are read from the page cache, so every process of the
+    node loading the model shares one physical copy of it. The model is converted to the store
+    on its first load, and again whenever the pickle is updated.
+
+    With the numpy inference engine (see MODEL_INFERENCE_ENGINE) the model is evaluated from its
+    array bundle, models without a NumPy evaluator are served by scikit-learn. A model replaced
+    by a deep learning model (see DL_MODELS) is served by ONNX Runtime.
+
+    Args:
+        model_path (str): Path of the pickled model
+
+    Returns:
+        OnnxModel, NumpyModel or unpickled model
+    """
+    dl_model = settings.DL_MODELS.get(os.path.basename(model_path))
+    if dl_model:
+        return load_keras_model(
+            os.path.join(os.path.dirname(model_path), dl_model["path"]),
+            dl_model["classes"],
+        )
+
+    if settings.MODEL_INFERENCE_ENGINE == "numpy":
+        bundle_path = get_inference_bundle_path(model_path)
+
+        try:
+            if not os.path.isdir(bundle_path):
+                export_inference_bundle(model_path)
+
+            return load_inference_bundle(
+                bundle_path,
+                mmap_mode=settings.MODEL_MMAP_MODE,
+                params={"epsilon": settings.KNN_INDEX_EPSILON},
+            )
+        except UnsupportedModel as e:
+            print(f"{os.path.basename(model_path)} served by scikit-learn: {e}")
+
+    if not settings.MODEL_MMAP_MODE:
+        with open(model_path, "rb") as f:
+            return pickle.load(f)
+
+    store_path = get_model_store_path(model_path)
+    if not os.path.exists(store_path) or os.path.getmtime(
+        store_path
+    ) < os.path.getmtime(model_path):
+        export_model_artifact(model_path)
+
+    # Only needed to serve scikit-learn models
+    import joblib
+
+    return joblib.load(store_path, mmap_mode=settings.MODEL_MMAP_MODE)
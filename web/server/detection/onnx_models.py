@@ -0,0 +1,114 @@
+import os
+import pickle
+import tempfile
+import numpy as np
+from django.conf import settings
+
+# Name of the input of the converted networks
+ONNX_INPUT_NAME = "landmarks"
+
+
+class OnnxModel:
+    """Deep learning classifier run on CPU with ONNX Runtime
+
+    Behaves as a scikit-learn classifier for the detections: predict_proba() and classes_.
+    """
+
+    def __init__(self, onnx_path: str, classes: list) -> None:
+        """
+        Args:
+            onnx_path (str): Path of the ONNX network, whose output is the probability of each class
+            classes (list): Classes in the order of the network output
+        """
+        # Only needed to serve deep learning models
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = settings.ONNX_INTRA_OP_THREADS
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+
+        self.session = onnxruntime.InferenceSession(
+            onnx_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.classes_ = np.array(classes)
+
+    def predict_proba(self, X) -> np.ndarray:
+        """Probabilities of the classes for a batch of frames, run by batches of ONNX_MAX_BATCH_SIZE frames"""
+        X = np.ascontiguousarray(X, np.float32)
+        batch_size = settings.ONNX_MAX_BATCH_SIZE
+
+        proba = [
+            self.session.run(None, {self.input_name: X[start : start + batch_size]})[0]
+            for start in range(0, len(X), batch_size)
+        ]
+
+        return np.concatenate(proba).astype(np.float64)
+
+
+def get_onnx_model_path(keras_model_path: str) -> str:
+    """Path of the ONNX version of a pickled Keras model in MODEL_STORE_DIR, specific to this version of the pickle"""
+    name = os.path.splitext(os.path.basename(keras_model_path))[0]
+    return os.path.join(
+        settings.MODEL_STORE_DIR,
+        f"{name}-{os.stat(keras_model_path).st_mtime_ns}.onnx",
+    )
+
+
+def convert_keras_model(keras_model_path: str) -> str:
+    """Convert a Keras model pickled by the notebooks to ONNX, the only step needing TensorFlow and tf2onnx
+
+    Returns:
+        str: Path of the ONNX network
+    """
+    import tensorflow as tf
+    import tf2onnx
+
+    with open(keras_model_path, "rb") as f:
+        model = pickle.load(f)
+
+    onnx_path = get_onnx_model_path(keras_model_path)
+    os.makedirs(settings.MODEL_STORE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=settings.MODEL_STORE_DIR, suffix=".tmp")
+    os.close(fd)
+
+    try:
+        # Any number of frames per run
+        input_signature = [
+            tf.TensorSpec(
+                (None,) + tuple(model.input_shape[1:]), tf.float32, ONNX_INPUT_NAME
+            )
+        ]
+        tf2onnx.convert.from_keras(
+            model,
+            input_signature=input_signature,
+            opset=settings.ONNX_OPSET,
+            output_path=temp_path,
+        )
+        os.replace(temp_path, onnx_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    return onnx_path
+
+
+def load_keras_model(keras_model_path: str, classes: list) -> OnnxModel:
+    """Load a pickled Keras model to run with ONNX Runtime, converted on its first load
+
+    Args:
+        keras_model_path (str): Path of the pickled Keras model
+        classes (list): Classes in the order of the model output
+
+    Returns:
+        OnnxModel: Model of the ONNX version
+    """
+    onnx_path = get_onnx_model_path(keras_model_path)
+    if not os.path.exists(onnx_path):
+        convert_keras_model(keras_model_path)
+
+    return OnnxModel(onnx_path, classes)
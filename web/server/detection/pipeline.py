@@ -0,0 +1,162 @@
+import queue
+import threading
+import traceback
+
+# Marker pushed through the queues once the source is exhausted
+END_OF_STREAM = object()
+
+
+class BatchStage:
+    """Pipeline stage collecting items into batches handled by a single call
+
+    The function receives a list of consecutive items and returns the list of items to hand
+    to the next stage. An incomplete batch is handled when the source is exhausted.
+    """
+
+    def __init__(self, func, batch_size: int) -> None:
+        self.func = func
+        self.batch_size = max(batch_size, 1)
+        self.items = []
+
+    def add(self, item) -> list:
+        """Add an item to the batch, handle the batch once it is full"""
+        self.items.append(item)
+
+        if len(self.items) < self.batch_size:
+            return []
+
+        return self.flush()
+
+    def flush(self) -> list:
+        """Handle the items collected so far"""
+        if not self.items:
+            return []
+
+        items, self.items = self.items, []
+        return self.func(items)
+
+
+class FramePipeline:
+    """Run the processing stages of a video on their own threads, joined by bounded queues
+
+    The source (e.g. a frame decoder) is iterated on its own thread and every item is handed
+    to the first stage, whose output is handed to the next stage and so on. Each stage runs
+    on exactly one thread, so items are processed in the order the source produced them.
+
+    A stage returning None drops the item. The return value of the last stage is ignored.
+    A stage can also be a BatchStage to handle several consecutive items at once.
+    """
+
+    def __init__(self, source, stages: list, queue_size: int = 8) -> None:
+        """
+        Args:
+            source (iterable): Items to process, iterated on the decoder thread
+            stages (list): List of (name, callable or BatchStage) tuples, run in order
+            queue_size (int, optional): Max number of items waiting between 2 stages. Defaults to 8.
+        """
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size
+
+        self._stopped = threading.Event()
+        self._error = None
+
+    def run(self) -> None:
+        """Process every item of the source, block until all stages are done
+
+        Raises:
+            Exception: The first error raised by the source or any stage
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        threads = [
+            threading.Thread(
+                target=self._run_source,
+                args=(queues[0],),
+                name="pipeline-source",
+                daemon=True,
+            )
+        ]
+        for index, (name, func) in enumerate(self.stages):
+            output_queue = queues[index + 1] if index + 1 < len(queues) else None
+            threads.append(
+                threading.Thread(
+                    target=self._run_stage,
+                    args=(func, queues[index], output_queue),
+                    name=f"pipeline-{name}",
+                    daemon=True,
+                )
+            )
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+    def _fail(self, error: Exception) -> None:
+        """Record the first error then stop feeding new items to the stages"""
+        traceback.print_exc()
+        if self._error is None:
+            self._error = error
+        self._stopped.set()
+
+    def _run_source(self, output_queue: queue.Queue) -> None:
+        items = iter(self.source)
+
+        try:
+            for item in items:
+                if self._stopped.is_set():
+                    break
+
+                output_queue.put(item)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            # A generator source stopped early, e.g. after a stage failed, releases its decoder
+            if hasattr(items, "close"):
+                try:
+                    items.close()
+                except Exception as e:
+                    self._fail(e)
+
+            output_queue.put(END_OF_STREAM)
+
+    def _run_stage(self, func, input_queue: queue.Queue, output_queue) -> None:
+        is_batch = isinstance(func, BatchStage)
+
+        while True:
+            item = input_queue.get()
+            if item is END_OF_STREAM:
+                break
+
+            # Keep draining the input after a failure so upstream stages never block
+            if self._stopped.is_set():
+                continue
+
+            try:
+                results = func.add(item) if is_batch else [func(item)]
+            except Exception as e:
+                self._fail(e)
+                continue
+
+            self._put_results(results, output_queue)
+
+        if is_batch and not self._stopped.is_set():
+            try:
+                self._put_results(func.flush(), output_queue)
+            except Exception as e:
+                self._fail(e)
+
+        if output_queue is not None:
+            output_queue.put(END_OF_STREAM)
+
+    def _put_results(self, results: list, output_queue) -> None:
+        if output_queue is None:
+            return
+
+        for result in results:
+            if result is not None:
+                output_queue.put(result)
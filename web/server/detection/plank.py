@@ -1,28 +1,34 @@
 import cv2
 import numpy as np
-import pandas as pd
-import pickle
 import mediapipe as mp
 
-from .utils import extract_important_keypoints, get_static_file_url, get_drawing_color
+from .evidence import EvidenceSelection
+from .inference import model_input
+from .model_store import load_model_artifact
+from .utils import (
+    extract_important_keypoints,
+    get_landmark_indices,
+    LandmarksBuffer,
+    get_static_file_url,
+    get_drawing_color,
+)
 
 mp_drawing = mp.solutions.drawing_utils
 mp_pose = mp.solutions.pose
 
 
-class PlankDetection:
+class PlankModel:
+    """
+    Machine learning model and landmarks of plank detection, shared by every analysis
+    """
+
     ML_MODEL_PATH = get_static_file_url("model/plank_model.pkl")
     INPUT_SCALER_PATH = get_static_file_url("model/plank_input_scaler.pkl")
-    PREDICTION_PROBABILITY_THRESHOLD = 0.6
 
     def __init__(self) -> None:
         self.init_important_landmarks()
         self.load_machine_learning_model()
 
-        self.previous_stage = "unknown"
-        self.results = []
-        self.has_error = False
-
     def init_important_landmarks(self) -> None:
         """
         Determine Important landmarks for plank detection
@@ -48,6 +54,8 @@ class PlankDetection:
             "RIGHT_FOOT_INDEX",
         ]
 
+        self.important_landmark_indices = get_landmark_indices(self.important_landmarks)
+
         # Generate all columns of the data frame
         self.headers = ["label"]  # Label column
 
@@ -67,48 +75,129 @@ class PlankDetection:
             raise Exception("Cannot found plank model file or input scaler file")
 
         try:
-            with open(self.ML_MODEL_PATH, "rb") as f:
-                self.model = pickle.load(f)
-            with open(self.INPUT_SCALER_PATH, "rb") as f2:
-                self.input_scaler = pickle.load(f2)
+            self.model = load_model_artifact(self.ML_MODEL_PATH)
+            self.input_scaler = load_model_artifact(self.INPUT_SCALER_PATH)
         except Exception as e:
             raise Exception(f"Error loading model, {e}")
 
-    def handle_detected_results(self, video_name: str) -> None:
-        """
-        Save frame as evidence
+    def predict(self, rows) -> list:
+        """Predict classes of a batch of frames with a single model call
+
+        Args:
+            rows (np.ndarray): Keypoints of the important landmarks, one row per frame
+
+        Returns:
+            list: Predicted class and probabilities of all classes for each frame
         """
-        file_name, _ = video_name.split(".")
-        save_folder = get_static_file_url("images")
-        for index, error in enumerate(self.results):
-            try:
-                image_name = f"{file_name}_{index}.jpg"
-                cv2.imwrite(f"{save_folder}/{file_name}_{index}.jpg", error["frame"])
-                self.results[index]["frame"] = image_name
-            except Exception as e:
-                print("ERROR cannot save frame: " + str(e))
-                self.results[index]["frame"] = None
+        X = self.input_scaler.transform(
+            model_input(self.input_scaler, rows, self.headers[1:])
+        )
+        prediction_probabilities = self.model.predict_proba(model_input(self.model, X))
+        predicted_classes = self.model.classes_[prediction_probabilities.argmax(axis=1)]
 
-        return self.results, self.previous_stage
+        return list(zip(predicted_classes, prediction_probabilities))
+
+
+class PlankDetection:
+    PREDICTION_PROBABILITY_THRESHOLD = 0.6
+
+    def __init__(self, ml_model: PlankModel) -> None:
+        self.ml_model = ml_model
+        self.landmarks_buffer = LandmarksBuffer()
 
-    def clear_results(self) -> None:
         self.previous_stage = "unknown"
-        self.results = []
+        self.evidence = EvidenceSelection()
+        self.has_error = False
+
+    @property
+    def results(self) -> list:
+        """Errors kept as evidence, in detection order"""
+        return self.evidence.results
+
+    def handle_detected_results(self) -> tuple:
+        """
+        Results of the analysis, evidence frames are saved as images by an EvidenceWriter
+        """
+        return self.results, self.previous_stage
+
+    def clear_results(self, keep_stage: bool = False) -> None:
+        """Clear results
+
+        Args:
+            keep_stage (bool, optional): Keep the current stage of the exercise, used when analysis resumes from a previous part of a video. Defaults to False.
+        """
+        self.evidence.clear()
         self.has_error = False
 
-    def detect(self, mp_results, image, timestamp) -> None:
+        if not keep_stage:
+            self.previous_stage = "unknown"
+
+    def get_state(self) -> dict:
+        """Current stage, counter and error state of the exercise, for live feedback"""
+        return {
+            "stage": self.previous_stage,
+            "counter": None,
+            "has_error": self.has_error,
+        }
+
+    def detect_batch(self, frames: list, landmarks=None) -> None:
+        """Plank errors detection on consecutive frames, with a single model prediction for all of them
+
+        Args:
+            frames (list): List of (mp_results, image, timestamp) of consecutive frames. Image is None to skip drawing
+            landmarks (np.ndarray, optional): Landmarks of the frames, shape (frames, 33, 4). Defaults to None, converted from the MediaPipe results.
+        """
+        # Convert landmarks of all frames once, shared by the model and the pose analysis
+        if landmarks is None:
+            landmarks = self.landmarks_buffer.convert(
+                [mp_results.pose_landmarks for mp_results, _, _ in frames]
+            )
+        predictions = self.ml_model.predict(
+            extract_important_keypoints(
+                landmarks, self.ml_model.important_landmark_indices
+            )
+        )
+
+        for (mp_results, image, timestamp), frame_landmarks, prediction in zip(
+            frames, landmarks, predictions
+        ):
+            self.detect(
+                mp_results,
+                image,
+                timestamp,
+                landmarks=frame_landmarks,
+                prediction=prediction,
+            )
+
+    def detect(
+        self,
+        mp_results,
+        image,
+        timestamp,
+        landmarks=None,
+        prediction: tuple = None,
+    ) -> None:
         """
         Make Plank Errors detection
+
+        landmarks, prediction: landmarks array and model prediction of this frame already computed by detect_batch
         """
         try:
-            # Extract keypoints from frame for the input
-            row = extract_important_keypoints(mp_results, self.important_landmarks)
-            X = pd.DataFrame([row], columns=self.headers[1:])
-            X = pd.DataFrame(self.input_scaler.transform(X))
+            if landmarks is None:
+                landmarks = self.landmarks_buffer.convert([mp_results.pose_landmarks])[
+                    0
+                ]
 
             # Make prediction and its probability
-            predicted_class = self.model.predict(X)[0]
-            prediction_probability = self.model.predict_proba(X)[0]
+            if prediction is None:
+                # Extract keypoints from frame for the input
+                row = extract_important_keypoints(
+                    landmarks, self.ml_model.important_landmark_indices
+                )
+                prediction = self.ml_model.predict(row[np.newaxis])[0]
+
+            predicted_class, prediction_probability = prediction
+            class_probability = prediction_probability[prediction_probability.argmax()]
 
             # Evaluate model prediction
             if (
@@ -139,8 +228,13 @@ class PlankDetection:
                     pass
                 # Stage from correct to error
                 elif self.previous_stage != current_stage:
-                    self.results.append(
-                        {"stage": current_stage, "frame": image, "timestamp": timestamp}
+                    self.evidence.add(
+                        {
+                            "stage": current_stage,
+                            "frame": image,
+                            "timestamp": timestamp,
+                        },
+                        score=class_probability,
                     )
                     self.has_error = True
             else:
@@ -149,6 +243,9 @@ class PlankDetection:
             self.previous_stage = current_stage
 
             # Visualization
+            if image is None:
+                return
+
             # Draw landmarks and connections
             landmark_color, connection_color = get_drawing_color(self.has_error)
             mp_drawing.draw_landmarks(
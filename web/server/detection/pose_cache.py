@@ -0,0 +1,231 @@
+import os
+import glob
+import time
+import uuid
+import hashlib
+import numpy as np
+import mediapipe as mp
+from types import SimpleNamespace
+from mediapipe.framework.formats import landmark_pb2
+
+mp_pose = mp.solutions.pose
+
+# One little-endian record per frame: its timestamp (-1 until the frame is recorded)
+# and its landmarks (NaN if no pose is detected). Also the binary format of the landmarks API.
+POSE_RECORD_DTYPE = np.dtype(
+    [
+        ("timestamp", "<i4"),
+        ("landmarks", "<f4", (len(mp_pose.PoseLandmark), 4)),
+    ]
+)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Temporary files not published after this number of seconds were left by a process which stopped
+TEMPORARY_FILE_TTL = 24 * 60 * 60
+
+
+def pose_cache_key(video_file_path: str, size: tuple, pose_options: dict) -> str:
+    """Key of the pose landmarks of a video, from the video bytes and the settings affecting the landmarks
+
+    Args:
+        video_file_path (str): path to video
+        size (tuple): Width and height the frames are analyzed at
+        pose_options (dict): Options of MediaPipe Pose
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha256()
+
+    with open(video_file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return pose_cache_key_from_digest(digest, size, pose_options)
+
+
+def pose_cache_key_from_digest(digest, size: tuple, pose_options: dict) -> str:
+    """Key of the pose landmarks of a video whose bytes have been hashed by a SHA-256 digest
+
+    Lets a video received by chunks be hashed on the fly, see pose_cache_key.
+    """
+    digest.update(
+        repr((tuple(size), sorted(pose_options.items()), mp.__version__)).encode()
+    )
+    return digest.hexdigest()
+
+
+def record_pose_results(records, frame_count: int, timestamp: int, landmarks) -> None:
+    """Save the landmarks of a frame to its record
+
+    Args:
+        records (np.ndarray): Pose records of the video
+        frame_count (int): 1-based position of the frame in the video
+        timestamp (int): timestamp of the frame
+        landmarks (np.ndarray): Landmarks of the frame converted by LandmarksBuffer, shape (33, 4). None if no pose is detected
+    """
+    # The frame count reported by OpenCV can be too low, the video is then not cached
+    if frame_count > len(records):
+        return
+
+    index = frame_count - 1
+    records["landmarks"][index] = np.nan if landmarks is None else landmarks
+    records["timestamp"][index] = timestamp
+
+
+def replay_pose_results(records, frame_count: int):
+    """Rebuild MediaPipe Pose results of a frame from its record
+
+    Args:
+        records (np.ndarray): Pose records of the video
+        frame_count (int): 1-based position of the frame in the video
+
+    Returns:
+        Object with the pose_landmarks attribute of MediaPipe Pose results, None if no pose was detected
+    """
+    # Frames missing from the records, e.g. decoded by another decoder, have no pose
+    if frame_count > len(records):
+        return SimpleNamespace(pose_landmarks=None)
+
+    landmarks = records[frame_count - 1]["landmarks"]
+    if np.isnan(landmarks[0, 0]):
+        return SimpleNamespace(pose_landmarks=None)
+
+    return SimpleNamespace(
+        pose_landmarks=landmark_pb2.NormalizedLandmarkList(
+            landmark=[
+                landmark_pb2.NormalizedLandmark(x=x, y=y, z=z, visibility=v)
+                for x, y, z, v in landmarks.tolist()
+            ]
+        )
+    )
+
+
+class PoseCache:
+    """Pose landmarks of analyzed videos, saved as memory-mapped record files
+
+    Files are evicted from the least recently used one once their total size goes over max_size.
+    """
+
+    def __init__(self, directory: str, max_size: int) -> None:
+        """
+        Args:
+            directory (str): Folder of the cache files
+            max_size (int): Max total size of the cache files in bytes, 0 disables the cache
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def lookup(self, key: str) -> np.ndarray:
+        """Memory-mapped records of a key, None if they are not cached
+
+        The file may be evicted by another process meanwhile, it is then a miss. Once mapped, the
+        records stay readable after the file is removed.
+        """
+        path = self.get_path(key)
+
+        try:
+            # Mark the file as recently used
+            os.utime(path)
+            return np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+    def create(self, key: str, frames: int) -> str:
+        """Create a temporary records file to fill, published with publish()
+
+        Returns:
+            str: Path of the temporary file
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        path = os.path.join(self.directory, f"{key}.{uuid.uuid4().hex}.tmp")
+        records = np.lib.format.open_memmap(
+            path, mode="w+", dtype=POSE_RECORD_DTYPE, shape=(frames,)
+        )
+        records["timestamp"] = -1
+        records.flush()
+        del records
+
+        return path
+
+    def publish(self, key: str, temporary_path: str, frames_read: int) -> bool:
+        """Publish a filled temporary file if every frame of the video has been recorded, discard it otherwise
+
+        Args:
+            key (str): Key of the records
+            temporary_path (str): Path returned by create()
+            frames_read (int): Number of frames decoded from the video
+
+        Returns:
+            bool: True if the records have been published
+        """
+        records = np.load(temporary_path, mmap_mode="r")
+        is_complete = frames_read == len(records) and bool(
+            (records["timestamp"] >= 0).all()
+        )
+        del records
+
+        if not is_complete:
+            self.discard(temporary_path)
+            return False
+
+        os.replace(temporary_path, self.get_path(key))
+        self.evict()
+        return True
+
+    def save(self, key: str, records: np.ndarray) -> bool:
+        """Publish records filled in memory, every frame of the video must be recorded
+
+        Returns:
+            bool: True if the records have been published
+        """
+        path = self.create(key, len(records))
+        cached_records = np.load(path, mmap_mode="r+")
+        cached_records[:] = records
+        cached_records.flush()
+        del cached_records
+
+        return self.publish(key, path, frames_read=len(records))
+
+    def discard(self, temporary_path: str) -> None:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    def evict(self) -> None:
+        """Remove the least recently used files until the cache fits in its max size, and the
+        temporary files left for TEMPORARY_FILE_TTL seconds"""
+        now = time.time()
+        for path in glob.glob(os.path.join(self.directory, "*.tmp")):
+            try:
+                if now - os.path.getmtime(path) > TEMPORARY_FILE_TTL:
+                    os.remove(path)
+            except OSError:
+                continue
+
+        files = []
+        for path in glob.glob(os.path.join(self.directory, "*.npy")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
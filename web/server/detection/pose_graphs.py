@@ -0,0 +1,127 @@
+import threading
+import numpy as np
+import mediapipe as mp
+from contextlib import contextmanager
+from django.conf import settings
+
+mp_pose = mp.solutions.pose
+
+
+class UnknownPoseProfile(Exception):
+    """The requested MediaPipe Pose profile is not in POSE_PROFILES"""
+
+
+def get_pose_options(exercise_type: str = None, profile: str = None) -> dict:
+    """Options of MediaPipe Pose of a profile
+
+    Args:
+        exercise_type (str, optional): exercise type, whose profile (POSE_EXERCISE_PROFILES) is used if no profile is given. Defaults to None.
+        profile (str, optional): Name of a profile of POSE_PROFILES. Defaults to None, the profile of the exercise or POSE_DEFAULT_PROFILE.
+
+    Raises:
+        UnknownPoseProfile: The profile does not exist
+
+    Returns:
+        dict: Keyword arguments of mp_pose.Pose
+    """
+    profile = (
+        profile
+        or settings.POSE_EXERCISE_PROFILES.get(exercise_type)
+        or settings.POSE_DEFAULT_PROFILE
+    )
+
+    if profile not in settings.POSE_PROFILES:
+        raise UnknownPoseProfile(f"Unknown pose profile {profile}")
+
+    return dict(settings.POSE_PROFILES[profile])
+
+
+class PosePool:
+    """MediaPipe Pose graphs of the process, reused by the analyses instead of built for each one
+
+    A graph is checked out by a single analysis at a time, then reset and kept for the next
+    analysis with the same options. At most max_idle graphs of each options are kept.
+    """
+
+    def __init__(self, max_idle: int) -> None:
+        self.max_idle = max_idle
+        self.idle_graphs = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(options: dict) -> tuple:
+        return tuple(sorted(options.items()))
+
+    def acquire(self, options: dict):
+        """Check out an idle graph with these options, build a new one if there is none
+
+        Returns:
+            mp_pose.Pose: Graph to hand back with release()
+        """
+        with self._lock:
+            graphs = self.idle_graphs.get(self.get_key(options))
+            if graphs:
+                return graphs.pop()
+
+        return mp_pose.Pose(**options)
+
+    def release(self, pose, options: dict, discard: bool = False) -> None:
+        """Hand back a checked out graph, reset for the next analysis
+
+        Args:
+            pose (mp_pose.Pose): Graph returned by acquire()
+            options (dict): Options the graph was acquired with
+            discard (bool, optional): Close the graph instead of keeping it, e.g. after an error. Defaults to False.
+        """
+        if not discard:
+            # Forget the landmarks tracked from the previous frames
+            pose.reset()
+
+            with self._lock:
+                graphs = self.idle_graphs.setdefault(self.get_key(options), [])
+                if len(graphs) < self.max_idle:
+                    graphs.append(pose)
+                    return
+
+        pose.close()
+
+    @contextmanager
+    def checkout(self, options: dict):
+        """Context manager version of acquire() and release()"""
+        pose = self.acquire(options)
+
+        try:
+            yield pose
+        except BaseException:
+            self.release(pose, options, discard=True)
+            raise
+
+        self.release(pose, options)
+
+    def warm_up(self, options: dict, count: int) -> None:
+        """Build graphs ahead of the first analyses, up to count idle graphs with these options"""
+        image = np.zeros((256, 256, 3), np.uint8)
+
+        with self._lock:
+            missing = count - len(self.idle_graphs.get(self.get_key(options), []))
+
+        for _ in range(max(missing, 0)):
+            pose = mp_pose.Pose(**options)
+            # The first frame loads the models of the graph
+            pose.process(image)
+            self.release(pose, options)
+
+
+POSE_POOL = None
+_pose_pool_lock = threading.Lock()
+
+
+def get_pose_pool() -> PosePool:
+    """Pose graphs of the process, created on first use"""
+    global POSE_POOL
+
+    with _pose_pool_lock:
+        if POSE_POOL is None:
+            POSE_POOL = PosePool(max_idle=settings.POSE_POOL_MAX_IDLE)
+
+    return POSE_POOL
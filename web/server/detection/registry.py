@@ -0,0 +1,78 @@
+import time
+import threading
+
+
+class ModelRegistry:
+    """Machine learning models of the exercises, each one loaded on its first use or by warm_up()
+
+    Loaded models are shared by every analysis of the process. A model is loaded only once even
+    if several analyses of the exercise start at the same time.
+    """
+
+    def __init__(self, model_classes: dict) -> None:
+        """
+        Args:
+            model_classes (dict): Model class of each exercise type, built without argument
+        """
+        self.model_classes = model_classes
+        self.models = {}
+        self.load_times = {}
+        self.errors = {}
+        self._locks = {
+            exercise_type: threading.Lock() for exercise_type in model_classes
+        }
+
+    def get(self, exercise_type: str):
+        """Model of an exercise, loaded if it is not yet
+
+        Raises:
+            Exception: The model cannot be loaded
+        """
+        model = self.models.get(exercise_type)
+        if model is not None:
+            return model
+
+        with self._locks[exercise_type]:
+            if exercise_type not in self.models:
+                self.models[exercise_type] = self._load(exercise_type)
+
+        return self.models[exercise_type]
+
+    def _load(self, exercise_type: str):
+        print(f"Loading {exercise_type} model ...")
+        started_at = time.perf_counter()
+
+        try:
+            model = self.model_classes[exercise_type]()
+        except Exception as e:
+            self.errors[exercise_type] = f"Error: {e}"
+            raise
+
+        self.load_times[exercise_type] = time.perf_counter() - started_at
+        self.errors.pop(exercise_type, None)
+        print(f"Loaded {exercise_type} model in {self.load_times[exercise_type]:.2f}s")
+
+        return model
+
+    def warm_up(self, exercise_types: list = None) -> None:
+        """Load the models of exercises ahead of their first analysis, all of them by default"""
+        for exercise_type in exercise_types or self.model_classes:
+            self.get(exercise_type)
+
+    def is_loaded(self, exercise_types: list = None) -> bool:
+        """Whether the models of exercises are loaded, all of them by default"""
+        return all(
+            exercise_type in self.models
+            for exercise_type in exercise_types or self.model_classes
+        )
+
+    def status(self) -> dict:
+        """Load state, load time (in second) and load error of each model"""
+        return {
+            exercise_type: {
+                "loaded": exercise_type in self.models,
+                "load_time": self.load_times.get(exercise_type),
+                "error": self.errors.get(exercise_type),
+            }
+            for exercise_type in self.model_classes
+        }
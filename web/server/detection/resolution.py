@@ -0,0 +1,52 @@
+import math
+from django.conf import settings
+
+
+def get_resolution_policy(exercise_type: str = None, model_complexity: int = 1) -> dict:
+    """Resolution policy of an exercise analyzed with a MediaPipe Pose model complexity
+
+    RESOLUTION_DEFAULT_POLICY is overridden by the policy of the model complexity
+    (RESOLUTION_MODEL_COMPLEXITY_POLICIES), then by the policy of the exercise (RESOLUTION_POLICIES).
+
+    Returns:
+        dict: max_pixels and short_side of the frames, None if not limited
+    """
+    return {
+        **settings.RESOLUTION_DEFAULT_POLICY,
+        **settings.RESOLUTION_MODEL_COMPLEXITY_POLICIES.get(model_complexity, {}),
+        **settings.RESOLUTION_POLICIES.get(exercise_type, {}),
+    }
+
+
+def get_policy_scale(width: int, height: int, policy: dict) -> float:
+    """Scale of the frames of a video so they fit in the pixel count and shorter side of a policy, never above 1
+
+    Raises:
+        ValueError: The size of the video is not positive
+    """
+    if width <= 0 or height <= 0:
+        raise ValueError(f"Invalid video size {width}x{height}")
+
+    scale = 1.0
+
+    if policy.get("max_pixels"):
+        scale = min(scale, math.sqrt(policy["max_pixels"] / (width * height)))
+    if policy.get("short_side"):
+        scale = min(scale, policy["short_side"] / min(width, height))
+
+    return scale
+
+
+def get_policy_size(width: int, height: int, policy: dict) -> tuple:
+    """Size of the frames of a video scaled by a resolution policy
+
+    Args:
+        width (int): Width of the video
+        height (int): Height of the video
+        policy (dict): Resolution policy, see get_resolution_policy
+
+    Returns:
+        tuple: Width and height of the scaled frames
+    """
+    scale = get_policy_scale(width, height, policy)
+    return max(int(width * scale), 1), max(int(height * scale), 1)
@@ -1,12 +1,15 @@
 import cv2
 import mediapipe as mp
 import numpy as np
-import pandas as pd
-import pickle
 
+from .evidence import EvidenceSelection, range_deviation
+from .inference import model_input
+from .model_store import load_model_artifact
+from .geometry import joint_distances
 from .utils import (
-    calculate_distance,
     extract_important_keypoints,
+    get_landmark_indices,
+    LandmarksBuffer,
     get_static_file_url,
     get_drawing_color,
 )
@@ -15,8 +18,20 @@ mp_pose = mp.solutions.pose
 mp_drawing = mp.solutions.drawing_utils
 
 
+# Landmarks used by the foot and knee placement analysis, in this order
+PLACEMENT_LANDMARKS = [
+    "LEFT_SHOULDER",
+    "RIGHT_SHOULDER",
+    "LEFT_FOOT_INDEX",
+    "RIGHT_FOOT_INDEX",
+    "LEFT_KNEE",
+    "RIGHT_KNEE",
+]
+
+
 def analyze_foot_knee_placement(
-    results,
+    placement_landmarks,
+    placement_ratios,
     stage: str,
     foot_shoulder_ratio_thresholds: list,
     knee_foot_ratio_thresholds: dict,
@@ -27,30 +42,34 @@ def analyze_foot_knee_placement(
 
     Calculate the ratio between the knee and foot for KNEE PLACEMENT analysis
 
+    placement_landmarks: array of the PLACEMENT_LANDMARKS of a frame, shape (6, 4)
+    placement_ratios: foot / shoulder and knee / foot width ratios of the frame, measured by SquatModel.measure
+
     Return result explanation:
         -1: Unknown result due to poor visibility
         0: Correct knee placement
         1: Placement too tight
         2: Placement too wide
+
+    The deviations are the distances of the ratios outside of their thresholds, the score of the errors
     """
     analyzed_results = {
         "foot_placement": -1,
         "knee_placement": -1,
+        "foot_placement_deviation": 0,
+        "knee_placement_deviation": 0,
     }
 
-    landmarks = results.pose_landmarks.landmark
+    (
+        _,
+        _,
+        left_foot_index_vis,
+        right_foot_index_vis,
+        left_knee_vis,
+        right_knee_vis,
+    ) = placement_landmarks[:, 3].tolist()
 
     # * Visibility check of important landmarks for foot placement analysis
-    left_foot_index_vis = landmarks[
-        mp_pose.PoseLandmark.LEFT_FOOT_INDEX.value
-    ].visibility
-    right_foot_index_vis = landmarks[
-        mp_pose.PoseLandmark.RIGHT_FOOT_INDEX.value
-    ].visibility
-
-    left_knee_vis = landmarks[mp_pose.PoseLandmark.LEFT_KNEE.value].visibility
-    right_knee_vis = landmarks[mp_pose.PoseLandmark.RIGHT_KNEE.value].visibility
-
     # If visibility of any keypoints is low cancel the analysis
     if (
         left_foot_index_vis < visibility_threshold
@@ -60,30 +79,8 @@ def analyze_foot_knee_placement(
     ):
         return analyzed_results
 
-    # * Calculate shoulder width
-    left_shoulder = [
-        landmarks[mp_pose.PoseLandmark.LEFT_SHOULDER.value].x,
-        landmarks[mp_pose.PoseLandmark.LEFT_SHOULDER.value].y,
-    ]
-    right_shoulder = [
-        landmarks[mp_pose.PoseLandmark.RIGHT_SHOULDER.value].x,
-        landmarks[mp_pose.PoseLandmark.RIGHT_SHOULDER.value].y,
-    ]
-    shoulder_width = calculate_distance(left_shoulder, right_shoulder)
-
-    # * Calculate 2-foot width
-    left_foot_index = [
-        landmarks[mp_pose.PoseLandmark.LEFT_FOOT_INDEX.value].x,
-        landmarks[mp_pose.PoseLandmark.LEFT_FOOT_INDEX.value].y,
-    ]
-    right_foot_index = [
-        landmarks[mp_pose.PoseLandmark.RIGHT_FOOT_INDEX.value].x,
-        landmarks[mp_pose.PoseLandmark.RIGHT_FOOT_INDEX.value].y,
-    ]
-    foot_width = calculate_distance(left_foot_index, right_foot_index)
-
-    # * Calculate foot and shoulder ratio
-    foot_shoulder_ratio = round(foot_width / shoulder_width, 1)
+    # * Foot and shoulder ratio
+    foot_shoulder_ratio = round(float(placement_ratios[0]), 1)
 
     # * Analyze FOOT PLACEMENT
     min_ratio_foot_shoulder, max_ratio_foot_shoulder = foot_shoulder_ratio_thresholds
@@ -93,29 +90,18 @@ def analyze_foot_knee_placement(
         analyzed_results["foot_placement"] = 1
     elif foot_shoulder_ratio > max_ratio_foot_shoulder:
         analyzed_results["foot_placement"] = 2
+    analyzed_results["foot_placement_deviation"] = range_deviation(
+        foot_shoulder_ratio, foot_shoulder_ratio_thresholds
+    )
 
     # * Visibility check of important landmarks for knee placement analysis
-    left_knee_vis = landmarks[mp_pose.PoseLandmark.LEFT_KNEE.value].visibility
-    right_knee_vis = landmarks[mp_pose.PoseLandmark.RIGHT_KNEE.value].visibility
-
     # If visibility of any keypoints is low cancel the analysis
     if left_knee_vis < visibility_threshold or right_knee_vis < visibility_threshold:
         print("Cannot see foot")
         return analyzed_results
 
-    # * Calculate 2 knee width
-    left_knee = [
-        landmarks[mp_pose.PoseLandmark.LEFT_KNEE.value].x,
-        landmarks[mp_pose.PoseLandmark.LEFT_KNEE.value].y,
-    ]
-    right_knee = [
-        landmarks[mp_pose.PoseLandmark.RIGHT_KNEE.value].x,
-        landmarks[mp_pose.PoseLandmark.RIGHT_KNEE.value].y,
-    ]
-    knee_width = calculate_distance(left_knee, right_knee)
-
-    # * Calculate foot and shoulder ratio
-    knee_foot_ratio = round(knee_width / foot_width, 1)
+    # * Knee and foot ratio
+    knee_foot_ratio = round(float(placement_ratios[1]), 1)
 
     # * Analyze KNEE placement
     up_min_ratio_knee_foot, up_max_ratio_knee_foot = knee_foot_ratio_thresholds.get(
@@ -151,34 +137,25 @@ def analyze_foot_knee_placement(
         elif knee_foot_ratio > down_max_ratio_knee_foot:
             analyzed_results["knee_placement"] = 2
 
+    if stage in knee_foot_ratio_thresholds:
+        analyzed_results["knee_placement_deviation"] = range_deviation(
+            knee_foot_ratio, knee_foot_ratio_thresholds[stage]
+        )
+
     return analyzed_results
 
 
-class SquatDetection:
-    ML_MODEL_PATH = get_static_file_url("model/squat_model.pkl")
+class SquatModel:
+    """
+    Machine learning model and landmarks of squat detection, shared by every analysis
+    """
 
-    PREDICTION_PROB_THRESHOLD = 0.7
-    VISIBILITY_THRESHOLD = 0.6
-    FOOT_SHOULDER_RATIO_THRESHOLDS = [1.2, 2.8]
-    KNEE_FOOT_RATIO_THRESHOLDS = {
-        "up": [0.5, 1.0],
-        "middle": [0.7, 1.0],
-        "down": [0.7, 1.1],
-    }
+    ML_MODEL_PATH = get_static_file_url("model/squat_model.pkl")
 
     def __init__(self) -> None:
         self.init_important_landmarks()
         self.load_machine_learning_model()
 
-        self.current_stage = ""
-        self.previous_stage = {
-            "feet": "",
-            "knee": "",
-        }
-        self.counter = 0
-        self.results = []
-        self.has_error = False
-
     def init_important_landmarks(self) -> None:
         """
         Determine Important landmarks for squat detection
@@ -196,6 +173,12 @@ class SquatDetection:
             "RIGHT_ANKLE",
         ]
 
+        self.important_landmark_indices = get_landmark_indices(self.important_landmarks)
+        self.placement_landmark_indices = get_landmark_indices(PLACEMENT_LANDMARKS)
+
+        # Shoulder width, 2-foot width and 2-knee width for the placement ratios
+        self.placement_distance_pairs = self.placement_landmark_indices.reshape(3, 2)
+
         # Generate all columns of the data frame
         self.headers = ["label"]  # Label column
 
@@ -215,51 +198,165 @@ class SquatDetection:
             raise Exception("Cannot found squat model")
 
         try:
-            with open(self.ML_MODEL_PATH, "rb") as f:
-                self.model = pickle.load(f)
+            self.model = load_model_artifact(self.ML_MODEL_PATH)
         except Exception as e:
             raise Exception(f"Error loading model, {e}")
 
-    def handle_detected_results(self, video_name: str) -> tuple:
+    def predict(self, rows) -> list:
+        """Predict classes of a batch of frames with a single model call
+
+        Args:
+            rows (np.ndarray): Keypoints of the important landmarks, one row per frame
+
+        Returns:
+            list: Predicted class and probabilities of all classes for each frame
         """
-        Save error frame as evidence
+        prediction_probabilities = self.model.predict_proba(
+            model_input(self.model, rows, self.headers[1:])
+        )
+        predicted_classes = self.model.classes_[prediction_probabilities.argmax(axis=1)]
+
+        return list(zip(predicted_classes, prediction_probabilities))
+
+    def measure(self, landmarks) -> np.ndarray:
+        """Measure the foot / shoulder and knee / foot width ratios in a single call
+
+        Args:
+            landmarks (np.ndarray): Landmarks of frames, shape (33, 4) or (frames, 33, 4)
+
+        Returns:
+            np.ndarray: Foot / shoulder ratio then knee / foot ratio, shape (2,) or (frames, 2)
         """
-        file_name, _ = video_name.split(".")
-        save_folder = get_static_file_url("images")
-        for index, error in enumerate(self.results):
-            try:
-                image_name = f"{file_name}_{index}.jpg"
-                cv2.imwrite(f"{save_folder}/{file_name}_{index}.jpg", error["frame"])
-                self.results[index]["frame"] = image_name
-            except Exception as e:
-                print("ERROR cannot save frame: " + str(e))
-                self.results[index]["frame"] = None
+        widths = joint_distances(landmarks[..., :2], self.placement_distance_pairs)
+
+        # A zero width gives an infinite ratio, analyzed as a too wide placement
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return widths[..., 1:] / widths[..., :2]
 
-        return self.results, self.counter
 
-    def clear_results(self) -> None:
+class SquatDetection:
+    PREDICTION_PROB_THRESHOLD = 0.7
+    VISIBILITY_THRESHOLD = 0.6
+    FOOT_SHOULDER_RATIO_THRESHOLDS = [1.2, 2.8]
+    KNEE_FOOT_RATIO_THRESHOLDS = {
+        "up": [0.5, 1.0],
+        "middle": [0.7, 1.0],
+        "down": [0.7, 1.1],
+    }
+
+    def __init__(self, ml_model: SquatModel) -> None:
+        self.ml_model = ml_model
+        self.landmarks_buffer = LandmarksBuffer()
+
         self.current_stage = ""
         self.previous_stage = {
             "feet": "",
             "knee": "",
         }
         self.counter = 0
-        self.results = []
+        self.evidence = EvidenceSelection()
+        self.has_error = False
+
+    @property
+    def results(self) -> list:
+        """Errors kept as evidence, in detection order"""
+        return self.evidence.results
+
+    def handle_detected_results(self) -> tuple:
+        """
+        Results of the analysis, evidence frames are saved as images by an EvidenceWriter
+        """
+        return self.results, self.counter
+
+    def clear_results(self, keep_stage: bool = False) -> None:
+        """Clear results and counter
+
+        Args:
+            keep_stage (bool, optional): Keep the current stage of the exercise, used when analysis resumes from a previous part of a video. Defaults to False.
+        """
+        if not keep_stage:
+            self.current_stage = ""
+            self.previous_stage = {
+                "feet": "",
+                "knee": "",
+            }
+
+        self.counter = 0
+        self.evidence.clear()
         self.has_error = False
 
-    def detect(self, mp_results, image, timestamp) -> None:
+    def get_state(self) -> dict:
+        """Current stage, counter and error state of the exercise, for live feedback"""
+        return {
+            "stage": self.current_stage,
+            "counter": self.counter,
+            "has_error": self.has_error,
+        }
+
+    def detect_batch(self, frames: list, landmarks=None) -> None:
+        """Squat errors detection on consecutive frames, with a single model prediction for all of them
+
+        Args:
+            frames (list): List of (mp_results, image, timestamp) of consecutive frames. Image is None to skip drawing
+            landmarks (np.ndarray, optional): Landmarks of the frames, shape (frames, 33, 4). Defaults to None, converted from the MediaPipe results.
+        """
+        # Convert landmarks of all frames once, shared by the model and the pose analysis
+        if landmarks is None:
+            landmarks = self.landmarks_buffer.convert(
+                [mp_results.pose_landmarks for mp_results, _, _ in frames]
+            )
+        predictions = self.ml_model.predict(
+            extract_important_keypoints(
+                landmarks, self.ml_model.important_landmark_indices
+            )
+        )
+        placement_ratios = self.ml_model.measure(landmarks)
+
+        for (
+            (mp_results, image, timestamp),
+            frame_landmarks,
+            prediction,
+            frame_placement_ratios,
+        ) in zip(frames, landmarks, predictions, placement_ratios):
+            self.detect(
+                mp_results,
+                image,
+                timestamp,
+                landmarks=frame_landmarks,
+                prediction=prediction,
+                placement_ratios=frame_placement_ratios,
+            )
+
+    def detect(
+        self,
+        mp_results,
+        image,
+        timestamp,
+        landmarks=None,
+        prediction: tuple = None,
+        placement_ratios=None,
+    ) -> None:
         """
         Make Squat Errors detection
+
+        landmarks, prediction, placement_ratios: landmarks array, model prediction and placement ratios of this frame already computed by detect_batch
         """
         try:
+            if landmarks is None:
+                landmarks = self.landmarks_buffer.convert([mp_results.pose_landmarks])[
+                    0
+                ]
+
             # * Model prediction for SQUAT counter
-            # Extract keypoints from frame for the input
-            row = extract_important_keypoints(mp_results, self.important_landmarks)
-            X = pd.DataFrame([row], columns=self.headers[1:])
+            if prediction is None:
+                # Extract keypoints from frame for the input
+                row = extract_important_keypoints(
+                    landmarks, self.ml_model.important_landmark_indices
+                )
+                prediction = self.ml_model.predict(row[np.newaxis])[0]
 
             # Make prediction and its probability
-            predicted_class = self.model.predict(X)[0]
-            prediction_probabilities = self.model.predict_proba(X)[0]
+            predicted_class, prediction_probabilities = prediction
             prediction_probability = round(
                 prediction_probabilities[prediction_probabilities.argmax()], 2
             )
@@ -279,8 +376,12 @@ class SquatDetection:
                 self.counter += 1
 
             # Analyze squat pose
+            if placement_ratios is None:
+                placement_ratios = self.ml_model.measure(landmarks)
+
             analyzed_results = analyze_foot_knee_placement(
-                results=mp_results,
+                placement_landmarks=landmarks[self.ml_model.placement_landmark_indices],
+                placement_ratios=placement_ratios,
                 stage=self.current_stage,
                 foot_shoulder_ratio_thresholds=self.FOOT_SHOULDER_RATIO_THRESHOLDS,
                 knee_foot_ratio_thresholds=self.KNEE_FOOT_RATIO_THRESHOLDS,
@@ -321,12 +422,13 @@ class SquatDetection:
                     pass
                 # Stage from correct to error
                 elif self.previous_stage["feet"] != feet_placement:
-                    self.results.append(
+                    self.evidence.add(
                         {
                             "stage": f"feet {feet_placement}",
                             "frame": image,
                             "timestamp": timestamp,
-                        }
+                        },
+                        score=analyzed_results["foot_placement_deviation"],
                     )
 
                 self.previous_stage["feet"] = feet_placement
@@ -338,12 +440,13 @@ class SquatDetection:
                     pass
                 # Stage from correct to error
                 elif self.previous_stage["knee"] != knee_placement:
-                    self.results.append(
+                    self.evidence.add(
                         {
                             "stage": f"knee {knee_placement}",
                             "frame": image,
                             "timestamp": timestamp,
-                        }
+                        },
+                        score=analyzed_results["knee_placement_deviation"],
                     )
 
                 self.previous_stage["knee"] = knee_placement
@@ -357,6 +460,9 @@ class SquatDetection:
                 self.has_error = False
 
             # Visualization
+            if image is None:
+                return
+
             # Draw landmarks and connections
             landmark_color, connection_color = get_drawing_color(self.has_error)
             mp_drawing.draw_landmarks(
@@ -0,0 +1,327 @@
+import os
+import pickle
+import tempfile
+import unittest
+import numpy as np
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+
+from .inference import (
+    BUNDLE_VERSION,
+    NumpyKNeighborsClassifier,
+    load_inference_bundle,
+    save_inference_bundle,
+)
+from .model_store import get_inference_bundle_path, remove_stale_inference_bundles
+from .onnx_models import load_keras_model
+from .utils import get_static_file_url
+
+try:
+    import sklearn
+except ImportError:
+    sklearn = None
+
+try:
+    import onnxruntime
+    import tensorflow as tf
+    import tf2onnx
+except ImportError:
+    onnxruntime = tf = tf2onnx = None
+
+
+def load_pickled_model(name: str):
+    """Shipped model, pickled by the notebooks with scikit-learn 1.1.2"""
+    with open(get_static_file_url(f"model/{name}.pkl"), "rb") as f:
+        return pickle.load(f)
+
+
+@unittest.skipUnless(sklearn, "scikit-learn is needed to unpickle the models")
+class NumpyInferenceTest(SimpleTestCase):
+    """The NumPy evaluators give the probabilities of scikit-learn on the shipped models"""
+
+    def setUp(self) -> None:
+        self.rng = np.random.default_rng(0)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.bundle_dir = temp_dir.name
+
+    def export(self, name: str, estimator):
+        """Evaluator of an estimator, through its array bundle"""
+        bundle_path = os.path.join(self.bundle_dir, f"{name}.bundle")
+        save_inference_bundle(bundle_path, estimator)
+
+        return load_inference_bundle(bundle_path)
+
+    def samples(self, estimator, count: int = 500) -> np.ndarray:
+        """Random landmark features, in the range of the normalized MediaPipe coordinates"""
+        return self.rng.uniform(-0.5, 1.5, (count, estimator.n_features_in_))
+
+    def assert_same_probabilities(self, scaler_name: str, model_name: str) -> None:
+        scaler = load_pickled_model(scaler_name)
+        model = load_pickled_model(model_name)
+        numpy_scaler = self.export(scaler_name, scaler)
+        numpy_model = self.export(model_name, model)
+
+        X = self.samples(scaler)
+        scaled = numpy_scaler.transform(X)
+        np.testing.assert_allclose(scaled, scaler.transform(X), rtol=1e-12)
+
+        np.testing.assert_array_equal(numpy_model.classes_, model.classes_)
+        np.testing.assert_allclose(
+            numpy_model.predict_proba(scaled),
+            model.predict_proba(scaled),
+            rtol=1e-9,
+            atol=1e-12,
+        )
+
+    def test_lunge_models(self):
+        self.assert_same_probabilities("lunge_input_scaler", "lunge_stage_model")
+        self.assert_same_probabilities("lunge_input_scaler", "lunge_err_model")
+
+    def test_plank_model(self):
+        self.assert_same_probabilities("plank_input_scaler", "plank_model")
+
+    def test_squat_model(self):
+        model = load_pickled_model("squat_model")
+        numpy_model = self.export("squat_model", model)
+
+        X = self.samples(model)
+        np.testing.assert_array_equal(numpy_model.classes_, model.classes_)
+        np.testing.assert_allclose(
+            numpy_model.predict_proba(X), model.predict_proba(X), rtol=1e-9, atol=1e-12
+        )
+
+    def test_bicep_curl_model(self):
+        scaler = load_pickled_model("bicep_curl_input_scaler")
+        model = load_pickled_model("bicep_curl_model")
+        numpy_model = self.export("bicep_curl_model", model)
+
+        # Random frames, then frames on training samples, at a null distance
+        X = np.concatenate(
+            [
+                self.export("bicep_curl_input_scaler", scaler).transform(
+                    self.samples(scaler)
+                ),
+                np.asarray(model._fit_X[:: max(len(model._fit_X) // 200, 1)]),
+            ]
+        )
+
+        np.testing.assert_array_equal(numpy_model.classes_, model.classes_)
+        np.testing.assert_allclose(
+            numpy_model.predict_proba(X), model.predict_proba(X), rtol=1e-9, atol=1e-12
+        )
+
+
+def create_knn_model(
+    fit_X: np.ndarray, y: np.ndarray, n_neighbors: int, **params
+) -> NumpyKNeighborsClassifier:
+    """KNN evaluator indexing training samples, whose labels y are class indices"""
+    return NumpyKNeighborsClassifier(
+        {
+            "classes": list(range(y.max() + 1)),
+            "n_neighbors": n_neighbors,
+            "weights": "uniform",
+            "metric": "euclidean",
+            "p": 2,
+            **params,
+        },
+        {**NumpyKNeighborsClassifier.build_index(fit_X), "y": y},
+    )
+
+
+class KNeighborsIndexTest(SimpleTestCase):
+    """The search in the KNN index finds the neighbors of a brute-force search"""
+
+    def setUp(self) -> None:
+        self.rng = np.random.default_rng(0)
+
+    def brute_force_distances(self, model, fit_X, X) -> np.ndarray:
+        """Distances from each query to every training sample, computed as the index computes them"""
+        return model.reduce_distances(np.abs(X[:, np.newaxis] - fit_X))
+
+    def assert_nearest_neighbors(self, model, fit_X, X, epsilon: float = 0.0) -> None:
+        """Neighbors are the closest training samples, any of them among samples at the same distance"""
+        k = model.params["n_neighbors"]
+        distances, indices = model.kneighbors(X)
+        all_distances = self.brute_force_distances(model, fit_X, X)
+        exact_distances = np.sort(all_distances, axis=1)[:, :k]
+
+        for row in range(len(X)):
+            self.assertEqual(len(set(indices[row])), k)
+            np.testing.assert_array_equal(
+                distances[row], all_distances[row, indices[row]]
+            )
+            self.assertTrue(np.all(np.diff(distances[row]) >= 0))
+
+            if epsilon:
+                self.assertLessEqual(
+                    distances[row, -1], exact_distances[row, -1] * (1 + epsilon)
+                )
+                continue
+
+            np.testing.assert_array_equal(distances[row], exact_distances[row])
+            # Samples closer than the k-th neighbor are all found, ties only at its distance
+            closer = np.flatnonzero(all_distances[row] < distances[row, -1])
+            self.assertTrue(set(closer) <= set(indices[row]))
+
+    def test_random_samples(self):
+        fit_X = self.rng.normal(size=(2000, 6))
+        y = self.rng.integers(0, 3, len(fit_X))
+        X = np.concatenate([self.rng.normal(size=(200, 6)), fit_X[:50]])
+
+        for metric, p in [("euclidean", 2), ("manhattan", 1), ("minkowski", 3)]:
+            model = create_knn_model(fit_X, y, 5, metric=metric, p=p)
+            self.assert_nearest_neighbors(model, fit_X, X)
+
+    def test_equal_distances(self):
+        # Samples of a small integer grid, many of them at the same distance of a query
+        fit_X = self.rng.integers(0, 4, (1500, 3)).astype(np.float64)
+        y = self.rng.integers(0, 3, len(fit_X))
+        X = self.rng.integers(-1, 5, (300, 3)).astype(np.float64)
+
+        for metric, p in [("euclidean", 2), ("manhattan", 1)]:
+            model = create_knn_model(fit_X, y, 7, metric=metric, p=p)
+            self.assert_nearest_neighbors(model, fit_X, X)
+
+    def test_duplicate_samples(self):
+        # Each sample repeated 3 times with its label, spread over different leaves
+        samples = self.rng.normal(size=(400, 4))
+        labels = self.rng.integers(0, 3, len(samples))
+        order = self.rng.permutation(len(samples) * 3)
+        fit_X = np.tile(samples, (3, 1))[order]
+        y = np.tile(labels, 3)[order]
+
+        for weights in ["uniform", "distance"]:
+            model = create_knn_model(fit_X, y, 3, weights=weights)
+            self.assert_nearest_neighbors(model, fit_X, samples)
+
+            # The 3 copies of a sample are its only neighbors at a null distance
+            distances, _ = model.kneighbors(samples)
+            np.testing.assert_array_equal(distances, 0.0)
+            np.testing.assert_array_equal(
+                model.predict_proba(samples), np.eye(3)[labels]
+            )
+
+    def test_epsilon(self):
+        fit_X = self.rng.normal(size=(2000, 6))
+        y = self.rng.integers(0, 3, len(fit_X))
+        X = self.rng.normal(size=(200, 6))
+
+        model = create_knn_model(fit_X, y, 5, epsilon=0.5)
+        self.assert_nearest_neighbors(model, fit_X, X, epsilon=0.5)
+
+    def test_brute_force_probabilities(self):
+        fit_X = self.rng.normal(size=(1000, 5))
+        y = self.rng.integers(0, 4, len(fit_X))
+        X = self.rng.normal(size=(200, 5))
+
+        for weights in ["uniform", "distance"]:
+            model = create_knn_model(fit_X, y, 6, weights=weights)
+            all_distances = self.brute_force_distances(model, fit_X, X)
+            nearest = np.argsort(all_distances, axis=1, kind="stable")[:, :6]
+            distances = np.take_along_axis(all_distances, nearest, axis=1)
+            votes = (
+                1.0 / distances if weights == "distance" else np.ones_like(distances)
+            )
+
+            expected = np.zeros((len(X), 4))
+            for row in range(len(X)):
+                np.add.at(expected[row], y[nearest[row]], votes[row])
+            expected /= expected.sum(axis=1)[:, np.newaxis]
+
+            np.testing.assert_allclose(model.predict_proba(X), expected, rtol=1e-12)
+
+
+class ModelStoreTest(SimpleTestCase):
+    def test_remove_stale_inference_bundles(self):
+        with tempfile.TemporaryDirectory() as store_dir, override_settings(
+            MODEL_STORE_DIR=store_dir
+        ):
+            model_path = os.path.join(store_dir, "plank_model.pkl")
+            open(model_path, "wb").close()
+
+            mtime_ns = os.stat(model_path).st_mtime_ns
+            kept = [
+                os.path.basename(get_inference_bundle_path(model_path)),
+                # Another model whose name starts with the same characters
+                f"plank_model_v2-{mtime_ns}.v{BUNDLE_VERSION}.bundle",
+                "plank_model.joblib",
+            ]
+            stale = [
+                # Previous version of the pickle
+                f"plank_model-{mtime_ns - 1}.v{BUNDLE_VERSION}.bundle",
+                # Older bundle layout
+                f"plank_model-{mtime_ns}.v{BUNDLE_VERSION - 1}.bundle",
+            ]
+            for name in kept + stale:
+                os.makedirs(os.path.join(store_dir, name), exist_ok=True)
+
+            remove_stale_inference_bundles(model_path)
+
+            remaining = os.listdir(store_dir)
+            for name in kept:
+                self.assertIn(name, remaining)
+            for name in stale:
+                self.assertNotIn(name, remaining)
+
+
+# Keras models pickled by the notebooks, served in place of the scikit-learn models with DL_MODELS
+CORE_DIR = os.path.join(settings.BASE_DIR, "..", "..", "core")
+
+
+@unittest.skipUnless(
+    onnxruntime and tf2onnx, "onnxruntime, tensorflow and tf2onnx are needed"
+)
+class OnnxModelTest(SimpleTestCase):
+    """The ONNX versions of the Keras models give the probabilities of Keras"""
+
+    def setUp(self) -> None:
+        self.rng = np.random.default_rng(0)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.store_dir = temp_dir.name
+
+    def assert_same_probabilities(self, keras_model_path: str, classes: list) -> None:
+        with open(keras_model_path, "rb") as f:
+            model = pickle.load(f)
+
+        with override_settings(MODEL_STORE_DIR=self.store_dir):
+            onnx_model = load_keras_model(keras_model_path, classes)
+
+            # More frames than a batch of ONNX_MAX_BATCH_SIZE
+            X = self.rng.uniform(-0.5, 1.5, (500,) + tuple(model.input_shape[1:]))
+            proba = onnx_model.predict_proba(X)
+
+        np.testing.assert_array_equal(onnx_model.classes_, classes)
+        np.testing.assert_allclose(
+            proba, model.predict(X.astype(np.float32), verbose=0), rtol=1e-4, atol=1e-6
+        )
+
+    def test_keras_model(self):
+        model = tf.keras.Sequential(
+            [
+                tf.keras.layers.Input(shape=(68,)),
+                tf.keras.layers.Dense(32, activation="relu"),
+                tf.keras.layers.Dropout(0.5),
+                tf.keras.layers.Dense(3, activation="softmax"),
+            ]
+        )
+        keras_model_path = os.path.join(self.store_dir, "model_dp.pkl")
+        with open(keras_model_path, "wb") as f:
+            pickle.dump(model, f)
+
+        self.assert_same_probabilities(keras_model_path, ["I", "M", "D"])
+
+    def test_notebook_models(self):
+        models = [
+            ("lunge_model/model/dp/stage_lunge_dp.pkl", ["I", "M", "D"]),
+            ("plank_model/model/plank_dp.pkl", ["C", "H", "L"]),
+        ]
+
+        for path, classes in models:
+            keras_model_path = os.path.join(CORE_DIR, path)
+            if not os.path.exists(keras_model_path):
+                continue
+
+            with self.subTest(path):
+                self.assert_same_probabilities(keras_model_path, classes)
@@ -3,7 +3,6 @@ import cv2
 import numpy as np
 import datetime
 import os
-import math
 from django.conf import settings
 
 # Drawing helpers
@@ -11,66 +10,61 @@ mp_drawing = mp.solutions.drawing_utils
 mp_pose = mp.solutions.pose
 
 # * Mediapipe Utils Functions
-def calculate_angle(point1: list, point2: list, point3: list) -> float:
-    """Calculate the angle between 3 points
+def get_landmark_indices(landmark_names: list) -> np.ndarray:
+    """Convert names of MediaPipe Pose landmarks to their indices
 
     Args:
-        point1 (list): Point 1 coordinate
-        point2 (list): Point 2 coordinate
-        point3 (list): Point 3 coordinate
+        landmark_names (list): list of landmarks' names, e.g. "LEFT_SHOULDER"
 
     Returns:
-        float: angle in degree
+        np.ndarray: indices of the landmarks
     """
-    point1 = np.array(point1)
-    point2 = np.array(point2)
-    point3 = np.array(point3)
+    return np.array([mp_pose.PoseLandmark[lm].value for lm in landmark_names])
 
-    # Calculate algo
-    angleInRad = np.arctan2(point3[1] - point2[1], point3[0] - point2[0]) - np.arctan2(
-        point1[1] - point2[1], point1[0] - point2[0]
-    )
-    angleInDeg = np.abs(angleInRad * 180.0 / np.pi)
 
-    angleInDeg = angleInDeg if angleInDeg <= 180 else 360 - angleInDeg
-    return angleInDeg
+class LandmarksBuffer:
+    """Preallocated array receiving MediaPipe Pose landmarks of consecutive frames
 
+    Landmarks of a frame are converted once to a (33, 4) block of x, y, z and visibility,
+    then shared by every consumer of the frame.
+    """
 
-def calculate_distance(pointX: list, pointY: list) -> float:
-    """Calculate distance between 2 points in a frame
+    def __init__(self, capacity: int = 1) -> None:
+        self.array = np.empty((capacity, len(mp_pose.PoseLandmark), 4), np.float32)
 
-    Args:
-        pointX (list): First point coordinate
-        pointY (list): Second point coordinate
+    def convert(self, pose_landmarks_list: list) -> np.ndarray:
+        """Convert landmarks of consecutive frames. The returned array is overwritten on the next call
 
-    Returns:
-        float: _description_
-    """
+        Args:
+            pose_landmarks_list (list): MediaPipe Pose landmarks of each frame
 
-    x1, y1 = pointX
-    x2, y2 = pointY
+        Returns:
+            np.ndarray: Array of shape (frames, 33, 4)
+        """
+        frames = len(pose_landmarks_list)
+        if frames > len(self.array):
+            self.array = np.empty((frames,) + self.array.shape[1:], np.float32)
 
-    return math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+        for index, pose_landmarks in enumerate(pose_landmarks_list):
+            self.array[index] = [
+                (lm.x, lm.y, lm.z, lm.visibility) for lm in pose_landmarks.landmark
+            ]
 
+        return self.array[:frames]
 
-def extract_important_keypoints(results, important_landmarks: list) -> list:
+
+def extract_important_keypoints(landmarks, landmark_indices) -> np.ndarray:
     """Extract important landmarks' data from MediaPipe output
 
     Args:
-        results : MediaPipe Pose output
-        important_landmarks (list): list of important landmarks
+        landmarks (np.ndarray): Landmarks of frames, shape (33, 4) or (frames, 33, 4)
+        landmark_indices (np.ndarray): indices of important landmarks
 
     Returns:
-        list: list of important landmarks' data from MediaPipe output
+        np.ndarray: important landmarks' data, one row per frame
     """
-    landmarks = results.pose_landmarks.landmark
-
-    data = []
-    for lm in important_landmarks:
-        keypoint = landmarks[mp_pose.PoseLandmark[lm].value]
-        data.append([keypoint.x, keypoint.y, keypoint.z, keypoint.visibility])
-
-    return np.array(data).flatten().tolist()
+    keypoints = landmarks[..., landmark_indices, :]
+    return keypoints.reshape(keypoints.shape[:-2] + (-1,))
 
 
 def get_drawing_color(error: bool) -> tuple:
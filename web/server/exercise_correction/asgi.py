@@ -2,6 +2,7 @@
 ASGI config for exercise_correction project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests are handled by Django, WebSocket connections by the live error detection.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
@@ -13,4 +14,17 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "exercise_correction.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up
+from stream_video.realtime import realtime_detection
+from stream_video.warmup import preload_server
+
+preload_server()
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        return await realtime_detection(scope, receive, send)
+
+    return await django_application(scope, receive, send)
@@ -127,6 +127,236 @@ MEDIA_URL = "/media/"
 
 MEDIA_ROOT = os.path.join(BASE_DIR, "static/media")
 
+# Video analysis
+# Number of uploaded videos analyzed at the same time by each worker process (manage.py run_video_jobs),
+# run apart from the web server processes
+VIDEO_JOB_WORKERS = 2
+
+# Worker processes used to analyse parts of a long video in parallel, for each video analyzed at the same
+# time: the CPUs are shared by the VIDEO_JOB_WORKERS videos
+EXERCISE_DETECTION_WORKERS = max((os.cpu_count() or 1) // VIDEO_JOB_WORKERS, 1)
+
+# Videos shorter than this (in seconds) per worker are analysed in a single process
+EXERCISE_DETECTION_MIN_CHUNK_SECONDS = 60
+
+# Seconds analysed before each part of a video so the exercise stage carries over
+EXERCISE_DETECTION_CHUNK_WARMUP_SECONDS = 3
+
+# Profiles of MediaPipe Pose: model_complexity (0: lite, 1: full, 2: heavy), smoothing of the landmarks
+# between frames and the min confidences of the pose detection and of its tracking
+POSE_PROFILES = {
+    "fast": {
+        "model_complexity": 0,
+        "smooth_landmarks": True,
+        "min_detection_confidence": 0.5,
+        "min_tracking_confidence": 0.5,
+    },
+    "balanced": {
+        "model_complexity": 1,
+        "smooth_landmarks": True,
+        "min_detection_confidence": 0.8,
+        "min_tracking_confidence": 0.8,
+    },
+    "accurate": {
+        "model_complexity": 2,
+        "smooth_landmarks": True,
+        "min_detection_confidence": 0.8,
+        "min_tracking_confidence": 0.8,
+    },
+}
+
+# Profile used when a request does not choose one
+POSE_DEFAULT_PROFILE = "balanced"
+
+# Profiles by exercise type, used when a request does not choose one, e.g. {"plank": "fast"}
+POSE_EXERCISE_PROFILES = {}
+
+# Max number of idle MediaPipe Pose graphs of each profile kept for the next analyses
+POSE_POOL_MAX_IDLE = 4
+
+# Graphs of the default profile built when a server process warms up
+POSE_POOL_WARM_UP = 2
+
+# Exercises whose models are loaded when the server starts, the other ones on their first analysis
+MODEL_WARM_UP = ["plank", "bicep_curl", "squat", "lunge"]
+
+# Load the models of MODEL_WARM_UP when the server application is imported. With gunicorn --preload
+# it happens before the workers are forked, which then share the memory of the models copy-on-write
+MODEL_PRELOAD = True
+
+# Models converted from the pickles of static/model to uncompressed joblib files, whose arrays are memory-mapped
+MODEL_STORE_DIR = os.path.join(MEDIA_ROOT, "model_store")
+
+# mmap mode of the model arrays: "c" maps the file read-only and copies a page only if a process writes
+# to it, "r" fails on any write. None to unpickle a private copy of the models in each process
+MODEL_MMAP_MODE = "c"
+
+# Evaluation of the models: "numpy" exports them once to array bundles in MODEL_STORE_DIR, evaluated
+# with NumPy alone, "sklearn" serves the unpickled scikit-learn models
+MODEL_INFERENCE_ENGINE = "numpy"
+
+# Approximate search of the KNN index: the k-th neighbor found is at most (1 + KNN_INDEX_EPSILON) times
+# farther than the exact one, fewer leaves are visited. 0 for an exact search
+KNN_INDEX_EPSILON = 0.0
+
+# Deep learning models served with ONNX Runtime in place of models of static/model: file name of the
+# replaced model -> Keras model pickled by the notebooks (path relative to static/model) and its classes
+# in the order of its output. Each Keras model is converted once to ONNX in MODEL_STORE_DIR, which needs
+# tensorflow and tf2onnx. Same input scaler as the replaced model. E.g.
+# "lunge_stage_model.pkl": {"path": "stage_lunge_dp.pkl", "classes": ["I", "M", "D"]}
+DL_MODELS = {}
+
+# Threads running the operators of a deep learning model, per server process. With more than 1, disable
+# MODEL_PRELOAD: the thread pool of a model loaded before the workers are forked does not run in them
+ONNX_INTRA_OP_THREADS = 1
+
+# Max number of frames per run of a deep learning model
+ONNX_MAX_BATCH_SIZE = 64
+
+# ONNX opset of the converted Keras models
+ONNX_OPSET = 13
+
+# Size videos are analyzed at, whatever the resolution of the uploaded video: frames are scaled down to
+# max_pixels pixels and to a shorter side of short_side pixels (None to ignore a limit), never scaled up.
+# Pose estimation time and landmark quality follow the number of pixels
+RESOLUTION_DEFAULT_POLICY = {"max_pixels": 768 * 432, "short_side": None}
+
+# Policies by MediaPipe Pose model_complexity (0: lite, 1: full, 2: heavy), override the default policy
+RESOLUTION_MODEL_COMPLEXITY_POLICIES = {
+    0: {"max_pixels": 640 * 360},
+    2: {"max_pixels": 960 * 540},
+}
+
+# Policies by exercise type, override the other policies, e.g. {"plank": {"short_side": 480}}
+RESOLUTION_POLICIES = {}
+
+# Number of frames classified together by a single model prediction
+EXERCISE_DETECTION_BATCH_SIZE = 16
+
+# Threads saving evidence frames of errors as JPEG images, shared by all analyses of a process
+EVIDENCE_ENCODER_WORKERS = 2
+
+# Max bytes of evidence frames of an analysis waiting to be saved, the analysis waits above it
+EVIDENCE_MAX_MEMORY = 64 * 1024**2
+
+# Errors kept as evidence for each error type: the max_count best scored ones (classifier confidence
+# or deviation from the limits), errors closer than min_gap seconds count as a single occurrence
+EVIDENCE_DEFAULT_POLICY = {"max_count": 3, "min_gap": 2}
+
+# Policies of specific error types, e.g. {"knee over toe": {"max_count": 5, "min_gap": 1}}
+EVIDENCE_POLICIES = {}
+
+# Pose landmarks of analyzed videos, reused when the same video is analyzed again
+POSE_CACHE_DIR = os.path.join(MEDIA_ROOT, "pose_cache")
+
+# Max total size of the pose cache in bytes, least recently used videos are evicted first. 0 disables the cache
+POSE_CACHE_MAX_SIZE = 2 * 1024**3
+
+# Max number of uploaded videos waiting to be analyzed, more uploads are rejected
+VIDEO_JOB_MAX_PENDING = 16
+
+# Number of seconds the result of an analysis is kept after it is finished
+VIDEO_JOB_RESULT_TTL = 60 * 60
+
+# Uploaded videos waiting to be analyzed
+VIDEO_JOB_UPLOAD_DIR = os.path.join(MEDIA_ROOT, "uploads")
+
+# Video jobs and their queue, shared by the web and worker processes
+VIDEO_JOB_DIR = os.path.join(MEDIA_ROOT, "jobs")
+
+# Number of seconds a worker waits before looking at an empty queue again
+VIDEO_JOB_POLL_INTERVAL = 1
+
+# Number of seconds a job stays claimed by a worker which stopped renewing its claim (crashed or killed),
+# the job is then queued again
+VIDEO_JOB_CLAIM_LEASE = 60
+
+# Number of times a job is claimed before it fails, when its workers keep stopping while processing it
+VIDEO_JOB_MAX_ATTEMPTS = 2
+
+# Decode uploaded videos and estimate their pose landmarks while they are received, the analysis
+# then replays them from the pose cache. Needs ffmpeg, ffprobe and the pose cache
+UPLOAD_STREAMING_INGEST = True
+
+# Number of uploads whose pose landmarks are estimated at the same time by a video job worker, on
+# threads apart from the analyses. Each one runs ffmpeg and a MediaPipe Pose graph
+UPLOAD_INGEST_WORKERS = 2
+
+# Max bytes of the start of an uploaded video read to find its size and frame rate
+UPLOAD_INGEST_PROBE_SIZE = 8 * 1024**2
+
+# Max number of seconds the analysis of an uploaded video waits for its ingest to estimate more
+# landmarks, the analysis then estimates them itself
+UPLOAD_INGEST_TIMEOUT = 60
+
+# Max size of a video sent by a resumable upload
+UPLOAD_SESSION_MAX_SIZE = 2 * 1024**3
+
+# Number of seconds an unfinished resumable upload is kept without receiving any chunk
+UPLOAD_SESSION_TTL = 60 * 60
+
+# Encoder of analyzed videos. backend: "ffmpeg" (an ffmpeg process fed raw frames), "opencv" (cv2.VideoWriter
+# with fourcc) or "auto" (ffmpeg if it is installed). With ffmpeg: codec, preset, crf or bitrate (e.g. "2M"),
+# threads (0 lets ffmpeg decide) and faststart, which writes the moov atom first so playback starts right away
+VIDEO_ENCODER = {
+    "backend": os.environ.get("VIDEO_ENCODER_BACKEND", "auto"),
+    "fourcc": "avc1",
+    "codec": "libx264",
+    "preset": "veryfast",
+    "crf": 23,
+    "bitrate": None,
+    "threads": 0,
+    "faststart": True,
+}
+
+# Decoder of videos. backend: "ffmpeg" (an ffmpeg process scaling and converting frames to RGB while
+# decoding, with frame accurate seeking), "opencv" (cv2.VideoCapture) or "auto" (ffmpeg if it is installed).
+# threads: decoding threads of ffmpeg, 0 lets ffmpeg decide
+VIDEO_DECODER = {
+    "backend": os.environ.get("VIDEO_DECODER_BACKEND", "auto"),
+    "threads": 0,
+}
+
+# Format of analyzed videos: "mp4" can be played once the analysis is finished, "hls" also writes an
+# HLS playlist of fragmented MP4 segments during the analysis so playback starts right away (needs ffmpeg)
+VIDEO_OUTPUT_FORMAT = os.environ.get("VIDEO_OUTPUT_FORMAT", "mp4")
+
+# Duration of an HLS segment in seconds, the delay before the first analyzed frames can be played
+HLS_SEGMENT_SECONDS = 2
+
+# Playlists and segments of analyzed videos, one folder per video
+HLS_DIR = os.path.join(MEDIA_ROOT, "hls")
+
+# Number of seconds the playlist of an analyzed video is kept after its last segment is written,
+# it can still be played after the MP4 video is saved. Removed by the video job workers
+HLS_OUTPUT_TTL = 60 * 60
+
+# Size of the chunks read from files streamed by Python
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Max number of ranges of a Range request, the whole file is sent for more
+STREAM_MAX_RANGES = 16
+
+# Let the web server send streamed files instead of Python:
+# internal location of the static folder for nginx X-Accel-Redirect, e.g. "/protected-static/"
+STREAM_ACCEL_REDIRECT_PREFIX = os.environ.get("STREAM_ACCEL_REDIRECT_PREFIX")
+
+# Or X-Sendfile with the absolute path of the file, for Apache mod_xsendfile or lighttpd
+STREAM_SENDFILE = os.environ.get("STREAM_SENDFILE") == "1"
+
+# Max size of the body of the landmarks API, read apart from the DATA_UPLOAD_MAX_MEMORY_SIZE of the other
+# endpoints: landmarks of a 10 minutes video at 30 fps take about 10MB
+LANDMARKS_MAX_BODY_SIZE = 32 * 1024**2
+
+# Max number of live detection sessions (WebSocket connections) at the same time
+REALTIME_MAX_SESSIONS = 4
+
+# Live frames waiting longer than this (in seconds) to be processed are dropped
+REALTIME_MAX_FRAME_LATENCY = 0.2
+
+# Live frames wider than this are downscaled before pose estimation
+REALTIME_MAX_FRAME_WIDTH = 640
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "exercise_correction.settings")
 
 application = get_wsgi_application()
+
+# Imported once Django is set up
+from stream_video.warmup import preload_server
+
+preload_server()
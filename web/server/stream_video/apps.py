@@ -1,5 +1,12 @@
-import sys
 from django.apps import AppConfig
+from django.core.signals import request_started
+
+
+def warm_up_on_request(**kwargs):
+    """Warm the server process up from its first request, whatever the server running it"""
+    from .warmup import start_worker_warm_up
+
+    start_worker_warm_up()
 
 
 class StreamVideoConfig(AppConfig):
@@ -7,9 +14,4 @@ class StreamVideoConfig(AppConfig):
     name = "stream_video"
 
     def ready(self):
-        if "runserver" not in sys.argv:
-            return True
-
-        from detection.main import load_machine_learning_models
-
-        load_machine_learning_models()
+        request_started.connect(warm_up_on_request, dispatch_uid="stream_video_warm_up")
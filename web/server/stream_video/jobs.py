@@ -0,0 +1,485 @@
+import os
+import json
+import time
+import uuid
+import tempfile
+import threading
+import traceback
+from django.conf import settings
+
+
+class JobQueueFull(Exception):
+    """Too many jobs are waiting to be processed"""
+
+
+class VideoJob:
+    """Background processing of an uploaded video, with its progress and result
+
+    Jobs are saved by a VideoJobStore, shared by the web processes answering their endpoints
+    and the worker processes running them.
+    """
+
+    QUEUED = "queued"
+    PROCESSING = "processing"
+    DONE = "done"
+    FAILED = "failed"
+
+    # Attributes saved to the job file
+    FIELDS = [
+        "id",
+        "params",
+        "owns_upload",
+        "can_render",
+        "deferred_job_id",
+        "status",
+        "attempts",
+        "stage",
+        "frames_done",
+        "total_frames",
+        "result",
+        "error",
+        "finished_at",
+        "playlist_url",
+    ]
+
+    def __init__(
+        self, store, job_id: str, params: dict, can_render: bool = False
+    ) -> None:
+        """
+        Args:
+            store (VideoJobStore): Store saving the job
+            job_id (str): Id of the job
+            params (dict): What to process, see process_video_job: exercise type, video, render, pose profile
+            can_render (bool, optional): The video can be rendered by a follow-up job, see VideoJobStore.submit_deferred. Defaults to False.
+        """
+        self.store = store
+        self.id = job_id
+        self.params = params
+        # The upload is removed with the job, unless a follow-up job has taken it over
+        self.owns_upload = True
+        self.can_render = can_render
+        self.deferred_job_id = None
+        # Queue entry of the job while a worker processes it
+        self.claim_entry = None
+
+        self.status = self.QUEUED
+        # Number of times a worker claimed the job
+        self.attempts = 0
+        self.stage = None
+        self.frames_done = 0
+        self.total_frames = 0
+        self.result = None
+        self.error = None
+        # Wall clock time, compared across processes
+        self.finished_at = None
+        # URL of the HLS playlist of the video, playable while the job is processing
+        self.playlist_url = None
+
+    @classmethod
+    def from_record(cls, store, record: dict):
+        job = cls(store, record["id"], record["params"])
+        for field in cls.FIELDS:
+            # Fields added since the job was saved keep their default
+            setattr(job, field, record.get(field, getattr(job, field)))
+
+        return job
+
+    def to_record(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (self.DONE, self.FAILED)
+
+    def report_progress(self, stage: str, frames_done: int, total_frames: int) -> None:
+        """Progress callback of exercise_detection"""
+        self.stage = stage
+        self.frames_done = frames_done
+        self.total_frames = total_frames
+        self.store.save(self)
+
+    def report_playlist(self, playlist_url: str) -> None:
+        """Set the playlist of the analyzed video, before its frames are written"""
+        self.playlist_url = playlist_url
+        self.store.save(self)
+
+    def run(self, func) -> None:
+        """Process the job and save its result
+
+        Args:
+            func (callable): Called with the job to process it, its return value is the result of the job
+        """
+        self.status = self.PROCESSING
+        self.store.save(self)
+
+        try:
+            self.result = func(self)
+            self.status = self.DONE
+        except Exception as e:
+            traceback.print_exc()
+            self.status = self.FAILED
+            self.error = f"Error: {e}"
+
+        self.finished_at = time.time()
+        self.store.save(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "frames_done": self.frames_done,
+            "total_frames": self.total_frames,
+            "playlist_url": self.playlist_url,
+            "error": self.error,
+        }
+
+
+class VideoJobStore:
+    """Jobs saved as JSON files in a directory shared by the web and worker processes
+
+    A queued job has an entry in the queue directory. A worker claims it by moving the entry to
+    the claimed directory, the move is atomic so each job is processed by a single worker.
+    The claim lasts claim_lease seconds, renewed by the worker while it processes the job, the
+    job of a worker which stopped is queued again (see requeue_stale_claims).
+    Finished jobs are kept for result_ttl seconds, as are jobs no worker processes.
+    """
+
+    # Suffix of a claim being taken over from a stopped worker
+    STALE_SUFFIX = ".stale"
+
+    def __init__(
+        self,
+        directory: str,
+        max_pending: int,
+        result_ttl: float,
+        claim_lease: float = 60,
+        max_attempts: int = 2,
+    ) -> None:
+        """
+        Args:
+            directory (str): Folder of the job files
+            max_pending (int): Max number of jobs waiting for a worker
+            result_ttl (float): Number of seconds a finished job is kept
+            claim_lease (float, optional): Number of seconds a claim lasts without being renewed. Defaults to 60.
+            max_attempts (int, optional): Number of claims of a job before it fails. Defaults to 2.
+        """
+        self.directory = directory
+        self.queue_dir = os.path.join(directory, "queue")
+        self.claimed_dir = os.path.join(directory, "claimed")
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.claim_lease = claim_lease
+        self.max_attempts = max_attempts
+
+        os.makedirs(self.queue_dir, exist_ok=True)
+        os.makedirs(self.claimed_dir, exist_ok=True)
+
+    def get_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def create(
+        self,
+        params: dict,
+        can_render: bool = False,
+        job_id: str = None,
+        owns_upload: bool = True,
+    ) -> VideoJob:
+        """Save a new job, processed once it is enqueued
+
+        Args:
+            params (dict): What to process, see VideoJob
+            can_render (bool, optional): See VideoJob. Defaults to False.
+            job_id (str, optional): Id of the job. Defaults to None, a new id.
+            owns_upload (bool, optional): The upload is removed with the job. Defaults to True.
+
+        Raises:
+            JobQueueFull: Too many jobs are waiting to be processed
+            FileExistsError: A job with this id exists
+
+        Returns:
+            VideoJob: The new job
+        """
+        if len(os.listdir(self.queue_dir)) >= self.max_pending:
+            raise JobQueueFull("Too many videos are waiting to be processed")
+
+        job = VideoJob(self, job_id or uuid.uuid4().hex, params, can_render=can_render)
+        job.owns_upload = owns_upload
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(job.to_record(), f)
+
+            # Linked exclusively, a job id is only used once
+            os.link(temp_path, self.get_path(job.id))
+        finally:
+            os.remove(temp_path)
+
+        return job
+
+    def enqueue(self, job: VideoJob) -> None:
+        """Let the workers process a created job, oldest jobs first"""
+        entry = os.path.join(self.queue_dir, f"{time.time_ns()}-{job.id}")
+        open(entry, "x").close()
+
+    def get_entries(self, directory: str, job_id: str) -> list:
+        """Entries of a job in the queue or claimed directory"""
+        return [
+            entry
+            for entry in os.listdir(directory)
+            if entry.split("-", 1)[-1] == job_id
+        ]
+
+    def save(self, job: VideoJob) -> None:
+        """Save a job, written aside then moved in place so readers never see a partial file"""
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(job.to_record(), f)
+            os.replace(temp_path, self.get_path(job.id))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def load(self, job_id: str) -> VideoJob:
+        """Read a job, None if it does not exist"""
+        if not job_id or not all(c.isalnum() or c == "_" for c in job_id):
+            return None
+
+        try:
+            with open(self.get_path(job_id)) as f:
+                return VideoJob.from_record(self, json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def get(self, job_id: str) -> VideoJob:
+        """Get a job by its id, None if it does not exist or has expired"""
+        job = self.load(job_id)
+        if job and self.is_expired(job):
+            self.remove(job)
+            return None
+
+        return job
+
+    def claim(self) -> VideoJob:
+        """Claim the oldest queued job for this worker, see renew
+
+        Returns:
+            VideoJob: The claimed job, None if no job is queued
+        """
+        for entry in sorted(os.listdir(self.queue_dir)):
+            try:
+                os.rename(
+                    os.path.join(self.queue_dir, entry),
+                    os.path.join(self.claimed_dir, entry),
+                )
+            except FileNotFoundError:
+                # Claimed by another worker
+                continue
+
+            job = self.load(entry.split("-", 1)[1])
+            if job:
+                job.claim_entry = entry
+                job.attempts += 1
+                self.save(job)
+                self.renew(job)
+                return job
+
+            os.remove(os.path.join(self.claimed_dir, entry))
+
+        return None
+
+    def renew(self, job: VideoJob) -> None:
+        """Extend the claim of a job being processed for claim_lease seconds
+
+        The time of the claim is the modification time of its entry.
+        """
+        if not job.claim_entry:
+            return
+
+        try:
+            os.utime(os.path.join(self.claimed_dir, job.claim_entry))
+        except FileNotFoundError:
+            print(f"Claim of job {job.id} expired, the job was taken over")
+
+    def release(self, job: VideoJob) -> None:
+        """Remove the claim of a processed job"""
+        if job.claim_entry:
+            try:
+                os.remove(os.path.join(self.claimed_dir, job.claim_entry))
+            except FileNotFoundError:
+                pass
+            job.claim_entry = None
+
+    def requeue_stale_claims(self) -> None:
+        """Queue again the jobs whose claim was not renewed for claim_lease seconds, their worker
+        stopped. A job claimed max_attempts times fails, it may be the one stopping the workers"""
+        now = time.time()
+
+        for entry in os.listdir(self.claimed_dir):
+            claim_path = os.path.join(self.claimed_dir, entry)
+            stale_path = f"{claim_path}{self.STALE_SUFFIX}"
+
+            try:
+                if now - os.path.getmtime(claim_path) <= self.claim_lease:
+                    continue
+
+                if entry.endswith(self.STALE_SUFFIX):
+                    # Left by a process which stopped while taking a claim over
+                    os.remove(claim_path)
+                    continue
+
+                # Taken over by a single process
+                os.rename(claim_path, stale_path)
+            except FileNotFoundError:
+                # Renewed by its worker or taken over by another process
+                continue
+
+            job = self.load(entry.split("-", 1)[1])
+            if not job or job.is_finished:
+                os.remove(stale_path)
+                continue
+
+            if job.attempts >= self.max_attempts:
+                print(f"Job {job.id} failed, its worker stopped")
+                job.status = VideoJob.FAILED
+                job.error = "Error: The worker processing the video stopped"
+                job.finished_at = time.time()
+                self.save(job)
+                os.remove(stale_path)
+            else:
+                print(f"Job {job.id} queued again, its worker stopped")
+                job.status = VideoJob.QUEUED
+                job.stage = None
+                self.save(job)
+                os.rename(
+                    stale_path,
+                    os.path.join(self.queue_dir, f"{time.time_ns()}-{job.id}"),
+                )
+
+    def submit_deferred(self, job: VideoJob) -> VideoJob:
+        """Queue the render job of a finished analysis-only job, only once
+
+        The render job takes over the upload of the job, so the video outlives the job.
+
+        Raises:
+            JobQueueFull: Too many jobs are waiting to be processed
+
+        Returns:
+            VideoJob: The render job, None if the job cannot be rendered
+        """
+        if not job.can_render:
+            return None
+
+        # The id of the render job is derived from the job: it is created once, whatever the process
+        render_job_id = f"{job.id}_render"
+
+        try:
+            render_job = self.create(
+                {**job.params, "render": True}, job_id=render_job_id
+            )
+        except FileExistsError:
+            return self.get(render_job_id)
+
+        job.deferred_job_id = render_job.id
+        job.owns_upload = False
+        self.save(job)
+        self.enqueue(render_job)
+
+        return render_job
+
+    def is_expired(self, job: VideoJob) -> bool:
+        if job.is_finished:
+            return time.time() - job.finished_at > self.result_ttl
+
+        # Never processed, e.g. its queue entry was not created or no worker processes the store.
+        # Jobs being processed are saved as they progress and their claim renewed.
+        try:
+            updated_at = os.path.getmtime(self.get_path(job.id))
+        except FileNotFoundError:
+            return False
+
+        return time.time() - updated_at > self.result_ttl and not self.is_claimed(job)
+
+    def is_claimed(self, job: VideoJob) -> bool:
+        """A worker holds a claim of the job which has not expired"""
+        for entry in self.get_entries(self.claimed_dir, job.id):
+            try:
+                claimed_at = os.path.getmtime(os.path.join(self.claimed_dir, entry))
+            except FileNotFoundError:
+                continue
+
+            if time.time() - claimed_at <= self.claim_lease:
+                return True
+
+        return False
+
+    def remove(self, job: VideoJob) -> None:
+        """Remove a job and the upload it owns"""
+        upload_path = job.params.get("upload_path")
+        if job.owns_upload and upload_path and os.path.exists(upload_path):
+            os.remove(upload_path)
+
+        for entry in self.get_entries(self.queue_dir, job.id):
+            try:
+                os.remove(os.path.join(self.queue_dir, entry))
+            except FileNotFoundError:
+                pass
+
+        if os.path.exists(self.get_path(job.id)):
+            os.remove(self.get_path(job.id))
+
+    def remove_expired_jobs(self) -> None:
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".json"):
+                continue
+
+            job = self.load(os.path.splitext(file_name)[0])
+            if not job or not self.is_expired(job):
+                continue
+
+            try:
+                self.remove(job)
+            except Exception:
+                traceback.print_exc()
+
+
+VIDEO_JOB_STORE = None
+INGEST_JOB_STORE = None
+_video_job_store_lock = threading.Lock()
+
+
+def get_video_job_store() -> VideoJobStore:
+    """Job store of the process, created on first use"""
+    global VIDEO_JOB_STORE
+
+    with _video_job_store_lock:
+        if VIDEO_JOB_STORE is None:
+            VIDEO_JOB_STORE = VideoJobStore(
+                settings.VIDEO_JOB_DIR,
+                max_pending=settings.VIDEO_JOB_MAX_PENDING,
+                result_ttl=settings.VIDEO_JOB_RESULT_TTL,
+                claim_lease=settings.VIDEO_JOB_CLAIM_LEASE,
+                max_attempts=settings.VIDEO_JOB_MAX_ATTEMPTS,
+            )
+
+    return VIDEO_JOB_STORE
+
+
+def get_ingest_job_store() -> VideoJobStore:
+    """Store of the ingests of the uploads (see PoseIngest), created on first use"""
+    global INGEST_JOB_STORE
+
+    with _video_job_store_lock:
+        if INGEST_JOB_STORE is None:
+            INGEST_JOB_STORE = VideoJobStore(
+                os.path.join(settings.VIDEO_JOB_DIR, "ingests"),
+                max_pending=settings.VIDEO_JOB_MAX_PENDING,
+                result_ttl=settings.VIDEO_JOB_RESULT_TTL,
+                claim_lease=settings.VIDEO_JOB_CLAIM_LEASE,
+                max_attempts=settings.VIDEO_JOB_MAX_ATTEMPTS,
+            )
+
+    return INGEST_JOB_STORE
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from detection.ingest import streaming_ingest_enabled
+from stream_video.jobs import get_ingest_job_store, get_video_job_store
+from stream_video.worker import VideoJobWorker
+
+
+class Command(BaseCommand):
+    help = "Process the queued video jobs and upload ingests, apart from the web server processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=settings.VIDEO_JOB_WORKERS,
+            help="Number of videos processed at the same time",
+        )
+        parser.add_argument(
+            "--ingest-threads",
+            type=int,
+            default=settings.UPLOAD_INGEST_WORKERS,
+            help="Number of uploads whose pose landmarks are estimated at the same time",
+        )
+
+    def handle(self, *args, **options):
+        ingest_threads = options["ingest_threads"] if streaming_ingest_enabled() else 0
+        worker = VideoJobWorker(
+            get_video_job_store(),
+            threads=options["threads"],
+            poll_interval=settings.VIDEO_JOB_POLL_INTERVAL,
+            ingest_store=get_ingest_job_store() if ingest_threads else None,
+            ingest_threads=ingest_threads,
+        )
+
+        self.stdout.write(
+            f"Processing video jobs with {options['threads']} threads, "
+            f"upload ingests with {ingest_threads} threads"
+        )
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            worker.stop()
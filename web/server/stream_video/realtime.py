@@ -0,0 +1,226 @@
+import json
+import time
+import asyncio
+import threading
+import traceback
+import cv2
+import numpy as np
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+from detection.main import EXERCISE_DETECTION_CLASSES, create_exercise_detection
+from detection.pose_graphs import UnknownPoseProfile, get_pose_options, get_pose_pool
+
+REALTIME_DETECTION_PATH = "/ws/detection"
+
+# WebSocket close codes
+CLOSE_POLICY_VIOLATION = 1008
+CLOSE_TRY_AGAIN_LATER = 1013
+
+# Number of open sessions, only changed from the event loop
+active_sessions = 0
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Threads running pose estimation and error detection, one per session at most"""
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.REALTIME_MAX_SESSIONS,
+                thread_name_prefix="realtime-detection",
+            )
+
+    return _executor
+
+
+class RealtimeSession:
+    """Pose estimation and error detection state of a live session
+
+    Frames are processed one at a time, in the order they are received.
+    """
+
+    def __init__(self, exercise_type: str, pose_options: dict) -> None:
+        self.exercise_detection = create_exercise_detection(exercise_type)
+        self.pose_options = pose_options
+        self.pose = get_pose_pool().acquire(pose_options)
+
+        self.started_at = time.monotonic()
+        self.frames = 0
+        self.dropped_frames = 0
+
+    def process(self, data: bytes, received_at: float) -> dict:
+        """Detect errors on a compressed frame
+
+        Args:
+            data (bytes): Frame encoded as JPEG, PNG or WebP
+            received_at (float): time.monotonic() when the frame was received
+
+        Returns:
+            dict: Feedback of the frame
+        """
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Cannot decode frame")
+
+        # Downscale large frames, pose estimation time grows with the frame size
+        width = image.shape[1]
+        if width > settings.REALTIME_MAX_FRAME_WIDTH:
+            image = cv2.resize(
+                image,
+                (
+                    settings.REALTIME_MAX_FRAME_WIDTH,
+                    int(image.shape[0] * settings.REALTIME_MAX_FRAME_WIDTH / width),
+                ),
+                interpolation=cv2.INTER_AREA,
+            )
+
+        self.frames += 1
+        timestamp = int(received_at - self.started_at)
+
+        # Recolor image from BGR to RGB for mediapipe
+        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image_rgb.flags.writeable = False
+        results = self.pose.process(image_rgb)
+
+        # Errors are counted whether they are kept as evidence or not
+        evidence = self.exercise_detection.evidence
+        previous_counts = dict(evidence.detected_counts)
+
+        # Nothing is drawn and no evidence frame is kept in a live session
+        if results.pose_landmarks:
+            self.exercise_detection.detect(results, None, timestamp)
+
+        # Errors detected on this frame
+        errors = []
+        for error_type, count in evidence.detected_counts.items():
+            errors += [error_type] * (count - previous_counts.get(error_type, 0))
+
+        return {
+            "frame": self.frames,
+            "timestamp": timestamp,
+            "has_pose": results.pose_landmarks is not None,
+            **self.exercise_detection.get_state(),
+            "errors": errors,
+            "error_counts": dict(evidence.detected_counts),
+            "dropped_frames": self.dropped_frames,
+            "latency": round((time.monotonic() - received_at) * 1000),
+        }
+
+    def close(self) -> None:
+        get_pose_pool().release(self.pose, self.pose_options)
+
+
+async def realtime_detection(scope, receive, send) -> None:
+    """ASGI application of the live error detection WebSocket
+
+    Query: type, the exercise type, and profile (optional), the MediaPipe Pose profile
+    Binary messages are compressed frames, each processed frame gets a JSON feedback message.
+    Frames received while a frame is processed replace each other, only the latest one is kept,
+    and it is dropped if it waited longer than REALTIME_MAX_FRAME_LATENCY.
+    """
+    global active_sessions
+
+    message = await receive()
+    if message["type"] != "websocket.connect":
+        return
+
+    query = parse_qs(scope.get("query_string", b"").decode())
+    exercise_type = query.get("type", [None])[0]
+    if (
+        scope["path"].rstrip("/") != REALTIME_DETECTION_PATH
+        or exercise_type not in EXERCISE_DETECTION_CLASSES
+    ):
+        await send({"type": "websocket.close", "code": CLOSE_POLICY_VIOLATION})
+        return
+
+    try:
+        pose_options = get_pose_options(exercise_type, query.get("profile", [None])[0])
+    except UnknownPoseProfile:
+        await send({"type": "websocket.close", "code": CLOSE_POLICY_VIOLATION})
+        return
+
+    if active_sessions >= settings.REALTIME_MAX_SESSIONS:
+        await send({"type": "websocket.close", "code": CLOSE_TRY_AGAIN_LATER})
+        return
+
+    active_sessions += 1
+    try:
+        await run_session(exercise_type, pose_options, receive, send)
+    finally:
+        active_sessions -= 1
+
+
+async def run_session(exercise_type: str, pose_options: dict, receive, send) -> None:
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+
+    await send({"type": "websocket.accept"})
+    session = await loop.run_in_executor(
+        executor, RealtimeSession, exercise_type, pose_options
+    )
+
+    connected = True
+    pending_frame = None
+    frame_received = asyncio.Event()
+
+    async def process_frames():
+        nonlocal pending_frame
+
+        while True:
+            await frame_received.wait()
+            frame_received.clear()
+            if not connected:
+                return
+
+            data, received_at = pending_frame
+            pending_frame = None
+
+            # Feedback on a stale frame is useless, wait for a newer one
+            if time.monotonic() - received_at > settings.REALTIME_MAX_FRAME_LATENCY:
+                session.dropped_frames += 1
+                continue
+
+            try:
+                feedback = await loop.run_in_executor(
+                    executor, session.process, data, received_at
+                )
+            except Exception as e:
+                traceback.print_exc()
+                feedback = {"error": f"Error: {e}"}
+
+            if not connected:
+                return
+            await send({"type": "websocket.send", "text": json.dumps(feedback)})
+
+    processor = asyncio.ensure_future(process_frames())
+    try:
+        while True:
+            message = await receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            data = message.get("bytes")
+            if not data:
+                continue
+
+            # The client is ahead of the detection, drop the waiting frame
+            if pending_frame is not None:
+                session.dropped_frames += 1
+
+            pending_frame = (data, time.monotonic())
+            frame_received.set()
+    finally:
+        connected = False
+        frame_received.set()
+
+        try:
+            await processor
+        except Exception:
+            traceback.print_exc()
+
+        await loop.run_in_executor(executor, session.close)
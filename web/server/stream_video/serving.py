@@ -0,0 +1,195 @@
+import os
+import re
+import uuid
+import mimetypes
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+RANGE_SPEC_RE = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+def parse_range_header(header: str, size: int) -> list:
+    """Byte ranges requested by a Range header, sorted and with overlapping ranges merged
+
+    Args:
+        header (str): Value of the Range header, e.g. "bytes=0-499, -500"
+        size (int): Size of the file
+
+    Returns:
+        list: (first byte, last byte) of each range. None if the whole file is served instead
+            (no header, malformed header or too many ranges). Empty if no range is satisfiable.
+    """
+    if not header:
+        return None
+
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+
+    specs = specs.split(",")
+    if len(specs) > settings.STREAM_MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        match = RANGE_SPEC_RE.match(spec)
+        if not match or match.groups() == ("", ""):
+            return None
+
+        first, last = match.groups()
+        if not first:
+            # Suffix range, the last bytes of the file
+            if int(last) == 0 or size == 0:
+                continue
+            ranges.append((max(size - int(last), 0), size - 1))
+            continue
+
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(int(last), size - 1) if last else size - 1))
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def iter_file_range(file, start: int, end: int):
+    """Read the bytes from start to end (included) of an open file by chunks of STREAM_CHUNK_SIZE"""
+    file.seek(start)
+    remaining = end - start + 1
+
+    while remaining > 0:
+        data = file.read(min(settings.STREAM_CHUNK_SIZE, remaining))
+        if not data:
+            break
+
+        remaining -= len(data)
+        yield data
+
+
+def iter_file_ranges(path: str, parts: list):
+    """Stream multiple parts of a file, a part is either bytes or a (start, end) range of the file"""
+    with open(path, "rb") as file:
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                yield from iter_file_range(file, *part)
+
+
+def serve_file(request, path: str, url_path: str, content_type: str = None):
+    """Serve a file with Range and conditional requests support
+
+    If STREAM_ACCEL_REDIRECT_PREFIX (nginx) or STREAM_SENDFILE (Apache, lighttpd) is set, the web
+    server is told to send the file itself. Otherwise full responses are sent with
+    wsgi.file_wrapper, which uses sendfile() on servers supporting it, and partial responses
+    are read by chunks of STREAM_CHUNK_SIZE.
+
+    Args:
+        request (): Django request
+        path (str): Absolute path of the file
+        url_path (str): Path of the file relative to the static folder, used by X-Accel-Redirect
+        content_type (str, optional): Defaults to None, guessed from the file name.
+
+    Returns:
+        HttpResponse: 200, 206, 304, 412 or 416 response
+    """
+    if not content_type:
+        content_type, _ = mimetypes.guess_type(path)
+        content_type = content_type or "application/octet-stream"
+
+    if settings.STREAM_ACCEL_REDIRECT_PREFIX:
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = (
+            settings.STREAM_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + url_path
+        )
+        return response
+
+    if settings.STREAM_SENDFILE:
+        response = HttpResponse(content_type=content_type)
+        response["X-Sendfile"] = path
+        return response
+
+    stat = os.stat(path)
+    size = stat.st_size
+    last_modified = int(stat.st_mtime)
+    etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+
+    def set_headers(response):
+        response["Accept-Ranges"] = "bytes"
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        return response
+
+    conditional_response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified
+    )
+    if conditional_response is not None:
+        return set_headers(conditional_response)
+
+    ranges = parse_range_header(request.META.get("HTTP_RANGE"), size)
+
+    # The ranges are only valid for the version of the file the client has
+    if_range = request.META.get("HTTP_IF_RANGE", "").strip()
+    if (
+        if_range
+        and if_range != etag
+        and parse_http_date_safe(if_range) != last_modified
+    ):
+        ranges = None
+
+    if ranges is None:
+        response = FileResponse(open(path, "rb"), content_type=content_type)
+        response.block_size = settings.STREAM_CHUNK_SIZE
+        return set_headers(response)
+
+    if not ranges:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return set_headers(response)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            iter_file_ranges(path, [(start, end)]),
+            status=206,
+            content_type=content_type,
+        )
+        response["Content-Length"] = end - start + 1
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return set_headers(response)
+
+    # Multiple ranges are sent as the parts of a multipart/byteranges body
+    boundary = uuid.uuid4().hex
+    parts = []
+    for start, end in ranges:
+        parts.append(
+            (
+                f"\r\n--{boundary}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+            ).encode()
+        )
+        parts.append((start, end))
+    parts.append(f"\r\n--{boundary}--\r\n".encode())
+
+    response = StreamingHttpResponse(
+        iter_file_ranges(path, parts),
+        status=206,
+        content_type=f"multipart/byteranges; boundary={boundary}",
+    )
+    response["Content-Length"] = sum(
+        len(part) if isinstance(part, bytes) else part[1] - part[0] + 1
+        for part in parts
+    )
+    return set_headers(response)
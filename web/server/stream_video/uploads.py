@@ -0,0 +1,371 @@
+import os
+import json
+import time
+import fcntl
+import uuid
+import tempfile
+import threading
+import traceback
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from detection.ingest import PARTIAL_UPLOAD_SUFFIX, partial_upload_path
+
+
+class UploadFileHandler(FileUploadHandler):
+    """Write an uploaded video to its upload path while it is received
+
+    The bytes are written to the partial file of the upload (see partial_upload_path), moved to
+    the upload path once complete, so the ingest of the video reads them as they arrive. The
+    video is not handed to the next upload handlers.
+    """
+
+    def __init__(
+        self, upload_path: str, field_name: str = "file", on_start=None, request=None
+    ) -> None:
+        """
+        Args:
+            upload_path (str): Path of the upload once it is complete
+            field_name (str, optional): Form field of the video. Defaults to "file".
+            on_start (callable, optional): Called once the partial file is created. Defaults to None.
+        """
+        super().__init__(request)
+        self.upload_path = upload_path
+        self.field_name = field_name
+        self.on_start = on_start
+        self.file = None
+        self.received = False
+
+    def new_file(self, field_name, *args, **kwargs) -> None:
+        super().new_file(field_name, *args, **kwargs)
+
+        # Only the first file of the field is written
+        if field_name != self.field_name or self.received or self.file:
+            return
+
+        os.makedirs(os.path.dirname(self.upload_path), exist_ok=True)
+        self.file = open(partial_upload_path(self.upload_path), "wb")
+        if self.on_start:
+            self.on_start()
+
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data: bytes, start: int) -> bytes:
+        if not self.file:
+            return raw_data
+
+        self.file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size: int):
+        if not self.file:
+            return None
+
+        self.file.close()
+        self.file = None
+        self.received = True
+        os.replace(partial_upload_path(self.upload_path), self.upload_path)
+
+        return UploadedFile(
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+        )
+
+    def upload_interrupted(self) -> None:
+        if self.file:
+            self.file.close()
+            self.file = None
+            remove_partial_upload(self.upload_path)
+
+
+def remove_partial_upload(upload_path: str) -> None:
+    """Remove an unfinished upload, its ingest stops"""
+    path = partial_upload_path(upload_path)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class UploadOffsetMismatch(Exception):
+    """A chunk starts after the bytes received so far"""
+
+
+class UploadSession:
+    """Video uploaded by consecutive chunks, resumed from the received offset after a failure
+
+    The bytes are appended to the partial file of the upload (see partial_upload_path), which
+    is moved to the upload path once every byte is received. The size of the partial file is
+    the received offset, so any process sharing the upload directory resumes the upload.
+    """
+
+    # Attributes saved to the session file
+    FIELDS = [
+        "id",
+        "exercise_type",
+        "render",
+        "size",
+        "name_to_save",
+        "path",
+        "ingest_job_id",
+        "pose_profile",
+    ]
+
+    def __init__(
+        self,
+        exercise_type: str,
+        render: bool,
+        size: int,
+        name_to_save: str,
+        path: str,
+        ingest_job_id: str = None,
+        pose_profile: str = None,
+    ) -> None:
+        """
+        Args:
+            exercise_type (str): exercise type
+            render (bool): Render the analyzed video, see upload_video
+            size (int): Size of the video in bytes
+            name_to_save (str): Name of the analyzed video
+            path (str): Path of the upload once it is complete
+            ingest_job_id (str, optional): Ingest job of the video, see process_ingest_job. Defaults to None.
+            pose_profile (str, optional): Profile of MediaPipe Pose of the analysis. Defaults to None.
+        """
+        self.id = uuid.uuid4().hex
+        self.exercise_type = exercise_type
+        self.render = render
+        self.size = size
+        self.name_to_save = name_to_save
+        self.path = path
+        self.ingest_job_id = ingest_job_id
+        self.pose_profile = pose_profile
+
+    @classmethod
+    def from_record(cls, record: dict):
+        session = cls(
+            record["exercise_type"],
+            record["render"],
+            record["size"],
+            record["name_to_save"],
+            record["path"],
+        )
+        for field in cls.FIELDS:
+            setattr(session, field, record[field])
+
+        return session
+
+    def to_record(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @property
+    def received(self) -> int:
+        """Number of bytes received so far"""
+        try:
+            return os.path.getsize(partial_upload_path(self.path))
+        except FileNotFoundError:
+            return self.size if os.path.exists(self.path) else 0
+
+    @property
+    def is_complete(self) -> bool:
+        return self.received == self.size
+
+    def write(self, start: int, stream) -> int:
+        """Append a chunk of the video read from a stream, its bytes already received are skipped
+
+        Bytes read before the stream fails are kept, the upload is resumed after them. Chunks of
+        the same upload are written one at a time, whatever the process receiving them.
+
+        Args:
+            start (int): Offset of the chunk in the video
+            stream (): File-like object of the chunk
+
+        Raises:
+            UploadOffsetMismatch: The chunk starts after the received bytes
+
+        Returns:
+            int: Number of bytes received so far
+        """
+        partial_path = partial_upload_path(self.path)
+
+        try:
+            # Not created again once the upload is complete or discarded
+            fd = os.open(partial_path, os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            return self.received
+
+        with os.fdopen(fd, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+            # Completed by the chunk received before
+            try:
+                if os.stat(partial_path).st_ino != os.fstat(fd).st_ino:
+                    return self.received
+            except FileNotFoundError:
+                return self.received
+
+            received = os.fstat(fd).st_size
+            if start > received:
+                raise UploadOffsetMismatch(
+                    f"Expected a chunk starting at byte {received}"
+                )
+
+            skip = received - start
+
+            for data in iter(lambda: stream.read(settings.STREAM_CHUNK_SIZE), b""):
+                if skip:
+                    skipped = min(skip, len(data))
+                    data = data[skipped:]
+                    skip -= skipped
+
+                data = data[: self.size - received]
+                if not data:
+                    continue
+
+                f.write(data)
+                received += len(data)
+
+            f.flush()
+            if received == self.size:
+                os.replace(partial_path, self.path)
+
+            return received
+
+    def to_dict(self) -> dict:
+        return {
+            "session_id": self.id,
+            "offset": self.received,
+            "size": self.size,
+        }
+
+    def discard(self) -> None:
+        """Remove an unfinished upload"""
+        remove_partial_upload(self.path)
+
+
+class UploadSessionStore:
+    """Unfinished resumable uploads, saved as JSON files next to their partial files
+
+    The directory is shared by the web processes, so a chunk is received by any of them.
+    Uploads are removed once idle for ttl seconds, with the partial files left by interrupted
+    uploads.
+    """
+
+    SUFFIX = ".session.json"
+
+    def __init__(self, directory: str, ttl: float) -> None:
+        """
+        Args:
+            directory (str): Folder of the uploads
+            ttl (float): Number of seconds an upload is kept without receiving any chunk
+        """
+        self.directory = directory
+        self.ttl = ttl
+
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, session_id: str) -> str:
+        return os.path.join(self.directory, f"{session_id}{self.SUFFIX}")
+
+    def add(self, session: UploadSession) -> None:
+        """Save a new upload, its partial file must exist"""
+        self.remove_expired_sessions()
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(session.to_record(), f)
+            os.replace(temp_path, self.get_path(session.id))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def load(self, session_id: str) -> UploadSession:
+        """Read an upload, None if it does not exist"""
+        if not session_id or not session_id.isalnum():
+            return None
+
+        try:
+            with open(self.get_path(session_id)) as f:
+                return UploadSession.from_record(json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def get(self, session_id: str) -> UploadSession:
+        """Get an unfinished upload by its id, None if it does not exist or has expired"""
+        session = self.load(session_id)
+        if session and self.is_expired(session):
+            self.remove(session)
+            return None
+
+        return session
+
+    def pop(self, session_id: str) -> UploadSession:
+        """Remove a finished upload, its file is kept. Only one process gets the upload"""
+        session = self.load(session_id)
+
+        try:
+            os.remove(self.get_path(session_id))
+        except FileNotFoundError:
+            return None
+
+        return session
+
+    def get_updated_at(self, session: UploadSession) -> float:
+        """Wall clock time of the last chunk received, of the creation without any chunk"""
+        for path in [partial_upload_path(session.path), self.get_path(session.id)]:
+            try:
+                return os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+
+        return 0
+
+    def is_expired(self, session: UploadSession) -> bool:
+        return time.time() - self.get_updated_at(session) > self.ttl
+
+    def remove(self, session: UploadSession) -> None:
+        """Remove an upload and its partial file"""
+        session.discard()
+
+        if os.path.exists(self.get_path(session.id)):
+            os.remove(self.get_path(session.id))
+
+    def remove_expired_sessions(self) -> None:
+        now = time.time()
+
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+
+            try:
+                if file_name.endswith(self.SUFFIX):
+                    session = self.load(file_name[: -len(self.SUFFIX)])
+                    if session and self.is_expired(session):
+                        self.remove(session)
+                elif file_name.endswith(PARTIAL_UPLOAD_SUFFIX):
+                    # Interrupted uploads, whether they had a session or not
+                    if now - os.path.getmtime(path) > self.ttl:
+                        os.remove(path)
+            except FileNotFoundError:
+                # Removed by another process
+                continue
+            except Exception:
+                traceback.print_exc()
+
+
+UPLOAD_SESSIONS = None
+_upload_sessions_lock = threading.Lock()
+
+
+def get_upload_sessions() -> UploadSessionStore:
+    """Resumable uploads store of the process, created on first use"""
+    global UPLOAD_SESSIONS
+
+    with _upload_sessions_lock:
+        if UPLOAD_SESSIONS is None:
+            UPLOAD_SESSIONS = UploadSessionStore(
+                settings.VIDEO_JOB_UPLOAD_DIR, ttl=settings.UPLOAD_SESSION_TTL
+            )
+
+    return UPLOAD_SESSIONS
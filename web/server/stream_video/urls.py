@@ -2,6 +2,22 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
+    path("ready", views.readiness, name="readiness"),
     path("stream", views.stream_video, name="stream"),
+    path(
+        "stream/hls/<str:video_id>/<str:file_name>",
+        views.stream_hls,
+        name="stream_hls",
+    ),
     path("upload", views.upload_video, name="upload"),
+    path("upload/sessions", views.create_upload_session, name="upload_sessions"),
+    path(
+        "upload/sessions/<str:session_id>",
+        views.upload_session,
+        name="upload_session",
+    ),
+    path("landmarks", views.analyze_landmarks, name="landmarks"),
+    path("jobs/<str:job_id>", views.job_status, name="job_status"),
+    path("jobs/<str:job_id>/result", views.job_result, name="job_result"),
+    path("jobs/<str:job_id>/render", views.job_render, name="job_render"),
 ]
@@ -1,24 +1,70 @@
+import io
 import os
-import mimetypes
+import json
+import re
+import uuid
 import traceback
+import numpy as np
 from datetime import datetime
-from wsgiref.util import FileWrapper
 
 from rest_framework import status
 from rest_framework.decorators import api_view, parser_classes
-from rest_framework.parsers import MultiPartParser
-from django.http import StreamingHttpResponse
+from rest_framework.parsers import MultiPartParser, JSONParser
+from django.conf import settings
 from django.http import JsonResponse
+from django.urls import reverse
 
-from detection.main import exercise_detection
+from detection.main import (
+    EXERCISE_DETECTION_CLASSES,
+    landmarks_detection,
+)
+from detection.hls import (
+    HLS_CONTENT_TYPES,
+    PLAYLIST_NAME,
+    hls_output_dir,
+)
+from detection.ingest import partial_upload_path, streaming_ingest_enabled
+from detection.pose_cache import POSE_RECORD_DTYPE
+from detection.pose_graphs import UnknownPoseProfile, get_pose_options
 from detection.utils import get_static_file_url
+from .jobs import JobQueueFull, get_ingest_job_store, get_video_job_store
+from .serving import serve_file
+from .warmup import WORKER_WARM_UP, start_worker_warm_up
+from .uploads import (
+    UploadFileHandler,
+    UploadOffsetMismatch,
+    UploadSession,
+    get_upload_sessions,
+    remove_partial_upload,
+)
+
+CONTENT_RANGE_RE = re.compile(r"^\s*bytes\s+(\d+)-(\d+)/(\d+)\s*$")
+
+
+@api_view(["GET"])
+def readiness(request):
+    """
+    Readiness of the server process: 200 once its models and pose graphs are loaded, 503 while it warms up
+    Load state and load time of each model in the body
+    """
+    start_worker_warm_up()
+    warm_up_status = WORKER_WARM_UP.status()
+
+    return JsonResponse(
+        status=(
+            status.HTTP_200_OK
+            if warm_up_status["ready"]
+            else status.HTTP_503_SERVICE_UNAVAILABLE
+        ),
+        data=warm_up_status,
+    )
 
 
 @api_view(["GET"])
 def stream_video(request):
     """
     Query: video_name
-    Stream video get from query
+    Stream video get from query, supports Range and conditional requests
     """
     video_name = request.GET.get("video_name")
     if not video_name:
@@ -38,24 +84,178 @@ def stream_video(request):
             },
         )
 
-    # Streamed video as chunked
-    video_size = os.path.getsize(static_url)
-    content_type, _ = mimetypes.guess_type(static_url)
-    content_type = content_type or "application/octet-stream"
+    # Range requests let the player seek without downloading the whole video
+    return serve_file(request, static_url, url_path=f"media/{video_name}")
+
 
-    chunk_size = video_size // 10
+@api_view(["GET"])
+def stream_hls(request, video_id: str, file_name: str):
+    """
+    Playlist and segments of the HLS output of a video, available while the video is analyzed.
+    The playlist is not found until its first segment is written.
+    """
+    content_type = HLS_CONTENT_TYPES.get(os.path.splitext(file_name)[1])
+    path = os.path.join(hls_output_dir(video_id), file_name)
+    if (
+        not content_type
+        or video_id.startswith(".")
+        or file_name.startswith(".")
+        or not os.path.isfile(path)
+    ):
+        return JsonResponse(
+            status=status.HTTP_404_NOT_FOUND,
+            data={
+                "message": "File not found",
+            },
+        )
 
-    response = StreamingHttpResponse(
-        FileWrapper(open(static_url, "rb"), chunk_size), content_type=content_type
+    response = serve_file(
+        request,
+        path,
+        url_path=os.path.relpath(path, settings.STATICFILES_DIRS[0]),
+        content_type=content_type,
     )
-    response["Content-Length"] = video_size
-    response["Accept-Ranges"] = "bytes"
+
+    # The playlist grows until the analysis is finished
+    if file_name == PLAYLIST_NAME:
+        response["Cache-Control"] = "no-cache"
+
     return response
 
 
+def build_analysis_response(
+    host: str, exercise_type: str, name_to_save: str, results: list, other_data: list
+) -> dict:
+    """Build the response data of an analyzed video"""
+    # Convert images' path to URL
+    for index, error in enumerate(results):
+        if error["frame"]:
+            results[index]["frame"] = host + f"static/images/{error['frame']}"
+
+    response_data = {
+        "type": exercise_type,
+        "processed": True,
+        "file_name": name_to_save,
+        "details": results,
+    }
+
+    # Handle others data
+    if exercise_type in ["squat", "lunge", "bicep_curl"]:
+        response_data["counter"] = other_data[0]
+
+    return response_data
+
+
+def job_urls(request, job) -> dict:
+    """Absolute URLs of the status and result endpoints of a job"""
+    return {
+        "status_url": request.build_absolute_uri(reverse("job_status", args=[job.id])),
+        "result_url": request.build_absolute_uri(reverse("job_result", args=[job.id])),
+    }
+
+
+def new_video_name() -> str:
+    """Unique name of an analyzed video"""
+    # Convert any video to .mp4
+    now = datetime.now()
+    now = int(now.strftime("%Y%m%d%H%M%S"))
+    return f"video_{now}_{uuid.uuid4().hex[:8]}.mp4"
+
+
+def submit_ingest_job(exercise_type: str, pose_profile: str, upload_path: str) -> str:
+    """Queue the ingest estimating the pose landmarks of a video while it is uploaded, for the worker
+    processes (see process_ingest_job). Its partial file must exist
+
+    Returns:
+        str: Id of the ingest job, None if ingests are disabled or too many are waiting
+    """
+    if not streaming_ingest_enabled():
+        return None
+
+    params = {
+        "exercise_type": exercise_type,
+        "pose_profile": pose_profile,
+        "upload_path": upload_path,
+    }
+    store = get_ingest_job_store()
+
+    try:
+        job = store.create(params, owns_upload=False)
+    except JobQueueFull:
+        return None
+
+    store.enqueue(job)
+    return job.id
+
+
+def submit_video_job(
+    request,
+    exercise_type: str,
+    render: bool,
+    name_to_save: str,
+    upload_path: str,
+    ingest_job_id: str = None,
+    pose_profile: str = None,
+) -> JsonResponse:
+    """Queue the analysis of an uploaded video for the worker processes (manage.py run_video_jobs)
+
+    With an ingest job, the analysis waits for the ingest then replays the landmarks from the
+    pose cache, see wait_for_ingest.
+
+    Returns:
+        JsonResponse: The queued job, 503 if too many videos are waiting
+    """
+    params = {
+        "exercise_type": exercise_type,
+        "render": render,
+        "name_to_save": name_to_save,
+        "upload_path": upload_path,
+        "pose_profile": pose_profile,
+        "ingest_job_id": ingest_job_id,
+        "host": request.build_absolute_uri("/"),
+        "playlist_url": request.build_absolute_uri(
+            reverse(
+                "stream_hls", args=[os.path.splitext(name_to_save)[0], PLAYLIST_NAME]
+            )
+        ),
+    }
+    store = get_video_job_store()
+
+    try:
+        # Without render, the upload is kept for a render job, removed once the job expires otherwise
+        job = store.create(params, can_render=not render)
+    except JobQueueFull as e:
+        os.remove(upload_path)
+
+        return JsonResponse(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            data={
+                "error": f"Error: {e}",
+            },
+        )
+
+    store.enqueue(job)
+
+    response_data = {**job.to_dict(), **job_urls(request, job)}
+    if not render:
+        response_data["render_url"] = request.build_absolute_uri(
+            reverse("job_render", args=[job.id])
+        )
+
+    return JsonResponse(status=status.HTTP_202_ACCEPTED, data=response_data)
+
+
 @api_view(["POST"])
 @parser_classes([MultiPartParser])
 def upload_video(request):
+    """
+    Query: type, render (optional), profile (optional, a MediaPipe Pose profile: fast, balanced or accurate)
+    Queue the analysis of the uploaded video, its progress and result are given by the job endpoints.
+    With render=false, only the errors are detected: no video nor error images are saved,
+    the video can be rendered afterward by the render endpoint of the job.
+    The pose landmarks of streamable videos are estimated while they are uploaded.
+    """
+    render = request.GET.get("render", "true").lower() not in ("false", "0")
     exercise_type = request.GET.get("type")
     if not exercise_type:
         return JsonResponse(
@@ -65,48 +265,47 @@ def upload_video(request):
             },
         )
 
+    if exercise_type not in EXERCISE_DETECTION_CLASSES:
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                "message": "Not supported exercise.",
+            },
+        )
+
+    pose_profile = request.GET.get("profile")
     try:
-        if request.method == "POST":
-            video = request.FILES["file"]
-
-            # Convert any video to .mp4
-            now = datetime.now()
-            now = int(now.strftime("%Y%m%d%H%M%S"))
-            name_to_save = f"video_{now}.mp4"
-
-            # Process and Saved Video
-            results, *other_data = exercise_detection(
-                video_file_path=video.temporary_file_path(),
-                video_name_to_save=name_to_save,
-                exercise_type=exercise_type,
-                rescale_percent=40,
-            )
+        get_pose_options(exercise_type, pose_profile)
+    except UnknownPoseProfile as e:
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                "message": str(e),
+            },
+        )
 
-            # Convert images' path to URL
-            host = request.build_absolute_uri("/")
-            for index, error in enumerate(results):
-                if error["frame"]:
-                    results[index]["frame"] = host + f"static/images/{error['frame']}"
-
-            response_data = {
-                "type": exercise_type,
-                "processed": True,
-                "file_name": name_to_save,
-                "details": results,
-            }
-
-            # Handle others data
-            if exercise_type in ["squat", "lunge", "bicep_curl"]:
-                response_data["counter"] = other_data[0]
-
-            return JsonResponse(
-                status=status.HTTP_200_OK,
-                data=response_data,
-            )
+    name_to_save = new_video_name()
+    upload_path = os.path.join(settings.VIDEO_JOB_UPLOAD_DIR, name_to_save)
+    ingest_job_ids = []
+
+    # The upload handlers must be set before the body is read
+    request.upload_handlers.insert(
+        0,
+        UploadFileHandler(
+            upload_path,
+            on_start=lambda: ingest_job_ids.append(
+                submit_ingest_job(exercise_type, pose_profile, upload_path)
+            ),
+        ),
+    )
 
+    try:
+        request.FILES["file"]
     except Exception as e:
-        print(f"Error Video Processing: {e}")
-        # traceback.print_exc()
+        print(f"Error Video Upload: {e}")
+        remove_partial_upload(upload_path)
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
 
         return JsonResponse(
             status=status.HTTP_400_BAD_REQUEST,
@@ -114,3 +313,372 @@ def upload_video(request):
                 "error": f"Error: {e}",
             },
         )
+
+    return submit_video_job(
+        request,
+        exercise_type,
+        render,
+        name_to_save,
+        upload_path,
+        ingest_job_id=ingest_job_ids[0] if ingest_job_ids else None,
+        pose_profile=pose_profile,
+    )
+
+
+@api_view(["POST"])
+@parser_classes([JSONParser])
+def create_upload_session(request):
+    """
+    Query: type, render (optional), profile (optional)
+    Start a resumable upload of a video of {"size": number of bytes}, its chunks are sent to the returned upload_url.
+    """
+    render = request.GET.get("render", "true").lower() not in ("false", "0")
+    exercise_type = request.GET.get("type")
+    if not exercise_type:
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                "message": "Exercise type has not given",
+            },
+        )
+
+    if exercise_type not in EXERCISE_DETECTION_CLASSES:
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                "message": "Not supported exercise.",
+            },
+        )
+
+    pose_profile = request.GET.get("profile")
+    try:
+        get_pose_options(exercise_type, pose_profile)
+    except UnknownPoseProfile as e:
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                "message": str(e),
+            },
+        )
+
+    size = request.data.get("size")
+    if (
+        not isinstance(size, int)
+        or size <= 0
+        or size > settings.UPLOAD_SESSION_MAX_SIZE
+    ):
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                "message": f"Size must be a number of bytes up to {settings.UPLOAD_SESSION_MAX_SIZE}",
+            },
+        )
+
+    name_to_save = new_video_name()
+    upload_path = os.path.join(settings.VIDEO_JOB_UPLOAD_DIR, name_to_save)
+    os.makedirs(settings.VIDEO_JOB_UPLOAD_DIR, exist_ok=True)
+    open(partial_upload_path(upload_path), "wb").close()
+
+    session = UploadSession(
+        exercise_type,
+        render,
+        size,
+        name_to_save,
+        upload_path,
+        ingest_job_id=submit_ingest_job(exercise_type, pose_profile, upload_path),
+        pose_profile=pose_profile,
+    )
+    get_upload_sessions().add(session)
+
+    return JsonResponse(
+        status=status.HTTP_201_CREATED,
+        data={
+            **session.to_dict(),
+            "upload_url": request.build_absolute_uri(
+                reverse("upload_session", args=[session.id])
+            ),
+        },
+    )
+
+
+@api_view(["GET", "PUT"])
+def upload_session(request, session_id: str):
+    """
+    GET: Number of bytes received so far, the offset to resume the upload from
+    PUT: Next chunk of the video as the raw body, with a Content-Range: bytes <first>-<last>/<size> header.
+    The analysis is queued once the last byte is received.
+    """
+    sessions = get_upload_sessions()
+    session = sessions.get(session_id)
+    if not session:
+        return JsonResponse(
+            status=status.HTTP_404_NOT_FOUND,
+            data={
+                "message": "Upload not found",
+            },
+        )
+
+    if request.method == "GET":
+        return JsonResponse(status=status.HTTP_200_OK, data=session.to_dict())
+
+    match = CONTENT_RANGE_RE.match(request.META.get("HTTP_CONTENT_RANGE", ""))
+    if not match or int(match.group(3)) != session.size:
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                "message": f"Content-Range must be bytes <first>-<last>/{session.size}",
+            },
+        )
+
+    try:
+        session.write(int(match.group(1)), request.stream or io.BytesIO())
+    except UploadOffsetMismatch as e:
+        return JsonResponse(
+            status=status.HTTP_409_CONFLICT,
+            data={
+                **session.to_dict(),
+                "message": str(e),
+            },
+        )
+    except Exception as e:
+        # The bytes received before the failure are kept, the client resumes from the offset
+        print(f"Error Video Upload: {e}")
+
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                **session.to_dict(),
+                "error": f"Error: {e}",
+            },
+        )
+
+    if not session.is_complete or not sessions.pop(session.id):
+        return JsonResponse(status=status.HTTP_200_OK, data=session.to_dict())
+
+    return submit_video_job(
+        request,
+        session.exercise_type,
+        session.render,
+        session.name_to_save,
+        session.path,
+        ingest_job_id=session.ingest_job_id,
+        pose_profile=session.pose_profile,
+    )
+
+
+def read_landmarks_body(request) -> bytes:
+    """Read the body of a landmarks API request, larger than the DATA_UPLOAD_MAX_MEMORY_SIZE of
+    the other endpoints
+
+    Returns:
+        bytes: The body, None if it is over LANDMARKS_MAX_BODY_SIZE
+    """
+    max_size = settings.LANDMARKS_MAX_BODY_SIZE
+
+    try:
+        content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        content_length = 0
+
+    if content_length > max_size:
+        return None
+
+    stream = request.stream
+    body = stream.read(max_size + 1) if stream else b""
+
+    return body if len(body) <= max_size else None
+
+
+def parse_landmarks(content_type: str, body: bytes) -> tuple:
+    """Read the timestamps and landmarks of the frames sent to the landmarks API
+
+    Raises:
+        ValueError: Malformed frames
+
+    Returns:
+        tuple: Timestamps, shape (frames,), and landmarks, shape (frames, 33, 4)
+    """
+    # Binary body: a record of a little-endian int32 timestamp and 33 x 4 float32 per frame
+    if content_type == "application/octet-stream":
+        records = np.frombuffer(body, dtype=POSE_RECORD_DTYPE)
+        return records["timestamp"], records["landmarks"]
+
+    data = json.loads(body or b"{}")
+    if not isinstance(data, dict):
+        raise ValueError("the body must be a JSON object")
+
+    timestamps = data.get("timestamps")
+    frames = data.get("landmarks")
+    if not isinstance(timestamps, list) or not isinstance(frames, list):
+        raise ValueError("timestamps and landmarks must be lists")
+
+    if len(timestamps) != len(frames):
+        raise ValueError("timestamps and landmarks must have the same length")
+
+    # Frames without pose are given as null
+    landmarks = np.full(
+        (len(frames),) + POSE_RECORD_DTYPE["landmarks"].shape, np.nan, np.float32
+    )
+    for index, frame_landmarks in enumerate(frames):
+        if frame_landmarks is not None:
+            landmarks[index] = frame_landmarks
+
+    return np.array(timestamps, dtype=np.float64), landmarks
+
+
+@api_view(["POST"])
+@parser_classes([JSONParser])
+def analyze_landmarks(request):
+    """
+    Query: type
+    Analyze pose landmarks estimated by the client, as JSON {"timestamps": [...], "landmarks": [33 x [x, y, z, visibility] or null, ...]}
+    or as an application/octet-stream body of binary records
+    """
+    exercise_type = request.GET.get("type")
+    if not exercise_type:
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                "message": "Exercise type has not given",
+            },
+        )
+
+    if exercise_type not in EXERCISE_DETECTION_CLASSES:
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                "message": "Not supported exercise.",
+            },
+        )
+
+    body = read_landmarks_body(request)
+    if body is None:
+        return JsonResponse(
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            data={
+                "message": f"Landmarks must be at most {settings.LANDMARKS_MAX_BODY_SIZE} bytes",
+            },
+        )
+
+    try:
+        timestamps, landmarks = parse_landmarks(request.content_type, body)
+    except (ValueError, TypeError) as e:
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                "error": f"Error: Malformed landmarks, {e}",
+            },
+        )
+
+    try:
+        results, *other_data = landmarks_detection(
+            exercise_type=exercise_type, timestamps=timestamps, landmarks=landmarks
+        )
+    except Exception as e:
+        print(f"Error Landmarks Processing: {e}")
+
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                "error": f"Error: {e}",
+            },
+        )
+
+    return JsonResponse(
+        status=status.HTTP_200_OK,
+        data=build_analysis_response(
+            request.build_absolute_uri("/"), exercise_type, None, results, other_data
+        ),
+    )
+
+
+@api_view(["GET"])
+def job_status(request, job_id: str):
+    """
+    Status and progress of a video analysis job
+    """
+    job = get_video_job_store().get(job_id)
+    if not job:
+        return JsonResponse(
+            status=status.HTTP_404_NOT_FOUND,
+            data={
+                "message": "Job not found",
+            },
+        )
+
+    return JsonResponse(status=status.HTTP_200_OK, data=job.to_dict())
+
+
+@api_view(["GET"])
+def job_result(request, job_id: str):
+    """
+    Result of a video analysis job, the job status while it is not finished
+    """
+    job = get_video_job_store().get(job_id)
+    if not job:
+        return JsonResponse(
+            status=status.HTTP_404_NOT_FOUND,
+            data={
+                "message": "Job not found",
+            },
+        )
+
+    if job.status == job.DONE:
+        return JsonResponse(status=status.HTTP_200_OK, data=job.result)
+
+    if job.status == job.FAILED:
+        return JsonResponse(
+            status=status.HTTP_400_BAD_REQUEST,
+            data={
+                "error": job.error,
+            },
+        )
+
+    return JsonResponse(status=status.HTTP_202_ACCEPTED, data=job.to_dict())
+
+
+@api_view(["POST"])
+def job_render(request, job_id: str):
+    """
+    Render the video of an analysis-only job, queued once, the render job is returned on later calls
+    """
+    store = get_video_job_store()
+    job = store.get(job_id)
+    if not job:
+        return JsonResponse(
+            status=status.HTTP_404_NOT_FOUND,
+            data={
+                "message": "Job not found",
+            },
+        )
+
+    if job.status != job.DONE:
+        return JsonResponse(
+            status=status.HTTP_409_CONFLICT,
+            data={
+                "message": "The analysis of the video is not done",
+            },
+        )
+
+    try:
+        render_job = store.submit_deferred(job)
+    except JobQueueFull as e:
+        return JsonResponse(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            data={
+                "error": f"Error: {e}",
+            },
+        )
+
+    if not render_job:
+        return JsonResponse(
+            status=status.HTTP_409_CONFLICT,
+            data={
+                "message": "The video of this job cannot be rendered",
+            },
+        )
+
+    return JsonResponse(
+        status=status.HTTP_202_ACCEPTED,
+        data={**render_job.to_dict(), **job_urls(request, render_job)},
+    )
@@ -0,0 +1,80 @@
+import gc
+import os
+import threading
+import traceback
+from django.conf import settings
+
+from detection.main import MODEL_REGISTRY, load_machine_learning_models
+from detection.pose_graphs import get_pose_options, get_pose_pool
+
+
+def preload_server() -> None:
+    """Load the models when the server application is imported, see MODEL_PRELOAD
+
+    Pose graphs are not built here: they are not safe to use in a forked worker.
+    """
+    if not settings.MODEL_PRELOAD:
+        return
+
+    load_machine_learning_models(settings.MODEL_WARM_UP)
+
+    # The preloaded objects live as long as the server, keep the garbage collector from
+    # writing to their pages so that the forked workers keep sharing them
+    gc.freeze()
+
+
+class WorkerWarmUp:
+    """Warm-up of a server process, run once in background: models then pose graphs
+
+    The process is ready once it is done. A warm-up started before the process was forked
+    does not run in the fork, which starts its own.
+    """
+
+    def __init__(self) -> None:
+        self.pid = None
+        self.done = False
+        self.error = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start the warm-up of the process if it is not yet"""
+        if self.pid == os.getpid():
+            return
+
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+
+            self.pid = os.getpid()
+            self.done = False
+            self.error = None
+
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self) -> None:
+        try:
+            load_machine_learning_models(settings.MODEL_WARM_UP)
+            get_pose_pool().warm_up(get_pose_options(), settings.POSE_POOL_WARM_UP)
+            self.done = True
+        except Exception as e:
+            traceback.print_exc()
+            self.error = f"Error: {e}"
+
+    @property
+    def is_ready(self) -> bool:
+        return self.pid == os.getpid() and self.done
+
+    def status(self) -> dict:
+        return {
+            "ready": self.is_ready,
+            "error": self.error if self.pid == os.getpid() else None,
+            "models": MODEL_REGISTRY.status(),
+        }
+
+
+WORKER_WARM_UP = WorkerWarmUp()
+
+
+def start_worker_warm_up(**kwargs) -> None:
+    """Start the warm-up of the process, also usable as a request_started receiver"""
+    WORKER_WARM_UP.start()
@@ -0,0 +1,226 @@
+import os
+import time
+import threading
+import traceback
+from django.conf import settings
+
+from detection.hls import hls_output_enabled, remove_expired_hls_outputs
+from detection.ingest import PoseIngest
+from detection.main import (
+    exercise_detection,
+    get_exercise_resolution_policy,
+    load_machine_learning_models,
+)
+from detection.pose_graphs import get_pose_options
+from .jobs import VideoJob, VideoJobStore, get_ingest_job_store
+from .views import build_analysis_response
+
+
+def process_video_job(job: VideoJob) -> dict:
+    """Analyze the uploaded video of a job, the upload is removed once it is not needed anymore
+
+    Returns:
+        dict: Response data of the analyzed video
+    """
+    params = job.params
+    render = params["render"]
+
+    if params.get("ingest_job_id"):
+        wait_for_ingest(job, get_ingest_job_store(), params["ingest_job_id"])
+
+    # Frames are written to the playlist while analyzing
+    if render and hls_output_enabled():
+        job.report_playlist(params["playlist_url"])
+
+    try:
+        # Process and Saved Video
+        results, *other_data = exercise_detection(
+            video_file_path=params["upload_path"],
+            video_name_to_save=params["name_to_save"],
+            exercise_type=params["exercise_type"],
+            progress=job.report_progress,
+            render=render,
+            pose_profile=params["pose_profile"],
+        )
+    except Exception:
+        # Nothing to render from a failed analysis
+        job.can_render = False
+        remove_upload(job)
+        raise
+
+    # After an analysis-only job, the upload is kept for its render job
+    if render or not job.can_render:
+        remove_upload(job)
+
+    return build_analysis_response(
+        params["host"],
+        params["exercise_type"],
+        params["name_to_save"] if render else None,
+        results,
+        other_data,
+    )
+
+
+def wait_for_ingest(job: VideoJob, store: VideoJobStore, ingest_job_id: str) -> None:
+    """Wait while the ingest of the upload estimates its landmarks, the analysis then replays them
+
+    An ingest not started yet, or without progress for UPLOAD_INGEST_TIMEOUT seconds, is not
+    waited for: the analysis estimates the landmarks itself.
+    """
+    frames_done = None
+    progress_at = time.monotonic()
+
+    while True:
+        ingest_job = store.get(ingest_job_id)
+        if not ingest_job or ingest_job.status != VideoJob.PROCESSING:
+            return
+
+        if ingest_job.frames_done != frames_done:
+            frames_done = ingest_job.frames_done
+            progress_at = time.monotonic()
+            job.report_progress("ingesting", frames_done, 0)
+        elif time.monotonic() - progress_at > settings.UPLOAD_INGEST_TIMEOUT:
+            print(f"Ingest {ingest_job_id} makes no progress, not waited for")
+            return
+
+        time.sleep(settings.VIDEO_JOB_POLL_INTERVAL)
+
+
+def process_ingest_job(job: VideoJob) -> dict:
+    """Estimate the landmarks of an upload while it is received, see PoseIngest
+
+    Returns:
+        dict: Whether the landmarks are published to the pose cache
+    """
+    params = job.params
+    pose_options = get_pose_options(params["exercise_type"], params["pose_profile"])
+    ingest = PoseIngest(
+        params["upload_path"],
+        resolution_policy=get_exercise_resolution_policy(
+            params["exercise_type"], pose_options
+        ),
+        pose_options=pose_options,
+        idle_timeout=settings.UPLOAD_SESSION_TTL,
+    )
+
+    published = ingest.run(
+        on_frames_done=lambda frames_done: job.report_progress(
+            "ingesting", frames_done, 0
+        )
+    )
+
+    return {"published": published, "frames": ingest.frames}
+
+
+def remove_upload(job: VideoJob) -> None:
+    if job.owns_upload and os.path.exists(job.params["upload_path"]):
+        os.remove(job.params["upload_path"])
+
+    job.owns_upload = False
+
+
+class VideoJobWorker:
+    """Process the queued jobs of a VideoJobStore, in a process of its own apart from the web server
+
+    The ingests of the uploads are processed on threads of their own, so they never wait for
+    the analyses, which may wait for them. Several workers, on one or more machines sharing
+    VIDEO_JOB_DIR, can process the same stores.
+    """
+
+    def __init__(
+        self,
+        store: VideoJobStore,
+        threads: int,
+        poll_interval: float,
+        ingest_store: VideoJobStore = None,
+        ingest_threads: int = 0,
+    ) -> None:
+        """
+        Args:
+            store (VideoJobStore): Jobs to process
+            threads (int): Number of jobs processed at the same time
+            poll_interval (float): Number of seconds between 2 looks at the queue while it is empty
+            ingest_store (VideoJobStore, optional): Ingests to process, see process_ingest_job. Defaults to None.
+            ingest_threads (int, optional): Number of ingests processed at the same time. Defaults to 0.
+        """
+        self.store = store
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.ingest_store = ingest_store
+        self.ingest_threads = ingest_threads if ingest_store else 0
+        self.stopped = threading.Event()
+        # Jobs being processed by the threads, with their store, their claims are renewed
+        self.claimed_jobs = set()
+        self._claimed_jobs_lock = threading.Lock()
+
+    def run(self) -> None:
+        """Process jobs until stop() is called"""
+        load_machine_learning_models(settings.MODEL_WARM_UP)
+
+        threads = [
+            threading.Thread(
+                target=self._process_jobs,
+                args=(self.store, process_video_job),
+                name=f"video-job-{index}",
+            )
+            for index in range(self.threads)
+        ] + [
+            threading.Thread(
+                target=self._process_jobs,
+                args=(self.ingest_store, process_ingest_job),
+                name=f"ingest-job-{index}",
+            )
+            for index in range(self.ingest_threads)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while not self.stopped.wait(self.poll_interval):
+                self._renew_claims()
+
+                for store in [self.store, self.ingest_store]:
+                    if store:
+                        store.requeue_stale_claims()
+                        store.remove_expired_jobs()
+                remove_expired_hls_outputs(settings.HLS_OUTPUT_TTL)
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+    def stop(self) -> None:
+        """Stop claiming jobs, the jobs being processed are finished"""
+        self.stopped.set()
+
+    def _process_jobs(self, store: VideoJobStore, process_job) -> None:
+        while not self.stopped.is_set():
+            try:
+                job = store.claim()
+            except Exception:
+                traceback.print_exc()
+                job = None
+
+            if not job:
+                self.stopped.wait(self.poll_interval)
+                continue
+
+            with self._claimed_jobs_lock:
+                self.claimed_jobs.add((store, job))
+
+            try:
+                job.run(process_job)
+            finally:
+                with self._claimed_jobs_lock:
+                    self.claimed_jobs.discard((store, job))
+                store.release(job)
+
+    def _renew_claims(self) -> None:
+        with self._claimed_jobs_lock:
+            claimed_jobs = list(self.claimed_jobs)
+
+        for store, job in claimed_jobs:
+            try:
+                store.renew(job)
+            except Exception:
+                traceback.print_exc()